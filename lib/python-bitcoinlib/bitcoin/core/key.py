@@ -31,6 +31,32 @@ def _check_result (val, func, args):
 ssl.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
 ssl.EC_KEY_new_by_curve_name.errcheck = _check_result
 
+# Everything that returns or takes a pointer needs to be declared as such,
+# otherwise ctypes truncates pointers to a C int on 64-bit platforms.
+ssl.BN_new.restype = ctypes.c_void_p
+ssl.BN_bin2bn.restype = ctypes.c_void_p
+ssl.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p]
+ssl.BN_CTX_new.restype = ctypes.c_void_p
+ssl.BN_CTX_free.argtypes = [ctypes.c_void_p]
+ssl.BN_clear_free.argtypes = [ctypes.c_void_p]
+ssl.EC_KEY_free.argtypes = [ctypes.c_void_p]
+ssl.EC_KEY_get0_group.restype = ctypes.c_void_p
+ssl.EC_KEY_get0_group.argtypes = [ctypes.c_void_p]
+ssl.EC_KEY_get0_public_key.restype = ctypes.c_void_p
+ssl.EC_KEY_get0_public_key.argtypes = [ctypes.c_void_p]
+ssl.EC_KEY_set_private_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+ssl.EC_KEY_set_public_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+ssl.EC_KEY_set_conv_form.argtypes = [ctypes.c_void_p, ctypes.c_int]
+ssl.EC_POINT_new.restype = ctypes.c_void_p
+ssl.EC_POINT_new.argtypes = [ctypes.c_void_p]
+ssl.EC_POINT_free.argtypes = [ctypes.c_void_p]
+ssl.EC_POINT_mul.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+                             ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+ssl.ECDH_compute_key.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p,
+                                 ctypes.c_void_p, ctypes.c_void_p]
+ssl.EC_POINT_oct2point.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_char_p,
+                                   ctypes.c_size_t, ctypes.c_void_p]
+
 class CECKey:
     """Wrapper around OpenSSL's EC_KEY"""
 
@@ -52,13 +78,25 @@ class CECKey:
         ctx = ssl.BN_CTX_new()
         if not ssl.EC_POINT_mul(group, pub_key, priv_key, None, None, ctx):
             raise ValueError("Could not derive public key from the supplied secret.")
-        ssl.EC_POINT_mul(group, pub_key, priv_key, None, None, ctx)
         ssl.EC_KEY_set_private_key(self.k, priv_key)
         ssl.EC_KEY_set_public_key(self.k, pub_key)
         ssl.EC_POINT_free(pub_key)
         ssl.BN_CTX_free(ctx)
+        ssl.BN_clear_free(priv_key)
         return self.k
 
+    def set_private_secretbytes(self, secret):
+        """Set only the private key from a 32-byte secret
+
+        The public key is left as is, for callers that already know it and
+        set it with set_pubkey(), saving a scalar multiplication.
+        """
+        priv_key = ssl.BN_bin2bn(secret, 32, None)
+        try:
+            return ssl.EC_KEY_set_private_key(self.k, priv_key)
+        finally:
+            ssl.BN_clear_free(priv_key)
+
     def set_privkey(self, key):
         self.mb = ctypes.create_string_buffer(key)
         return ssl.d2i_ECPrivateKey(ctypes.byref(self.k), ctypes.byref(ctypes.pointer(self.mb)), len(key))
@@ -88,6 +126,30 @@ class CECKey:
             raise Exception('CKey.get_ecdh_key(): ECDH_compute_key() failed')
         return ecdh_keybuffer.raw
 
+    def get_raw_ecdh_keys(self, other_pubkeys):
+        """Return the raw ECDH keys for many serialized pubkeys
+
+        Every pubkey is decoded into the same EC_POINT, rather than into an
+        EC_KEY of its own. None is returned in place of any pubkey that
+        doesn't decode to a point on the curve.
+        """
+        group = ssl.EC_KEY_get0_group(self.k)
+        point = ssl.EC_POINT_new(group)
+        ctx = ssl.BN_CTX_new()
+        ecdh_keybuffer = ctypes.create_string_buffer(32)
+        try:
+            r = []
+            for other_pubkey in other_pubkeys:
+                if (not ssl.EC_POINT_oct2point(group, point, other_pubkey, len(other_pubkey), ctx)
+                        or ssl.ECDH_compute_key(ecdh_keybuffer, 32, point, self.k, None) != 32):
+                    r.append(None)
+                else:
+                    r.append(ecdh_keybuffer.raw)
+            return r
+        finally:
+            ssl.BN_CTX_free(ctx)
+            ssl.EC_POINT_free(point)
+
     def get_ecdh_key(self, other_pubkey, kdf=lambda k: hashlib.sha256(k).digest()):
         # FIXME: be warned it's not clear what the kdf should be as a default
         r = self.get_raw_ecdh_key(other_pubkey)
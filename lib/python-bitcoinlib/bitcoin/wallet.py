@@ -70,12 +70,19 @@ class CKey(object):
     is_compressed - True if compressed
 
     """
-    def __init__(self, secret, compressed=True):
+    def __init__(self, secret, compressed=True, pubkey=None):
         self._cec_key = bitcoin.core.key.CECKey()
-        self._cec_key.set_secretbytes(self)
-        self._cec_key.set_compressed(compressed)
+        if pubkey is None:
+            self._cec_key.set_secretbytes(self)
+            self._cec_key.set_compressed(compressed)
+            pubkey = self._cec_key.get_pubkey()
+        else:
+            # Already known to the caller, who must make sure it matches;
+            # saves deriving it from the secret.
+            self._cec_key.set_private_secretbytes(self)
+            self._cec_key.set_compressed(compressed)
 
-        self.pub = bitcoin.core.key.CPubKey(self._cec_key.get_pubkey(), self._cec_key)
+        self.pub = bitcoin.core.key.CPubKey(pubkey, self._cec_key)
 
         return self
 
@@ -105,16 +112,19 @@ class CBitcoinSecret(bitcoin.base58.CBase58Data, CKey):
     """A base58-encoded secret key"""
 
     @classmethod
-    def from_secret_bytes(cls, secret, compressed=True):
-        """Create a secret key from a 32-byte secret"""
+    def from_secret_bytes(cls, secret, compressed=True, pubkey=None):
+        """Create a secret key from a 32-byte secret
+
+        pubkey - The serialized pubkey of the secret, if already known
+        """
         self = cls.from_bytes(secret + b'\x01' if compressed else b'',
                               bitcoin.params.BASE58_PREFIXES['SECRET_KEY'])
-        self.__init__(None)
+        self.__init__(None, pubkey)
         return self
 
-    def __init__(self, s):
+    def __init__(self, s, _pubkey=None):
         if self.nVersion != bitcoin.params.BASE58_PREFIXES['SECRET_KEY']:
             raise CBitcoinSecretError('Not a base58-encoded secret key: got nVersion=%d; expected nVersion=%d' % \
                                       (self.nVersion, bitcoin.params.BASE58_PREFIXES['SECRET_KEY']))
 
-        CKey.__init__(self, self[0:32], len(self) > 32 and bord(self[32]) == 1)
+        CKey.__init__(self, self[0:32], len(self) > 32 and bord(self[32]) == 1, _pubkey)
@@ -1,6 +1,12 @@
 # Distributed under the MIT/X11 software license, see the accompanying
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 
+import collections
+import hashlib
+import itertools
+import os
+import threading
+
 import bitcoin.base58
 import bitcoin.core
 import bitcoin.core.key
@@ -8,10 +14,141 @@ import bitcoin.wallet
 
 import bitcoin.core.script as script
 
+import stealthaddress.ecc
+import stealthaddress.metrics
+import stealthaddress.prefix
+
 
 class StealthAddressError(ValueError):
     pass
 
+
+# Payments to stealth addresses are announced with a notification output of the
+# form:
+#
+#     OP_RETURN <version || nonce || ephemeral pubkey>
+#
+# where version is a single byte, the nonce four bytes, and the ephemeral
+# pubkey a 33-byte compressed pubkey. The prefix of a notification is the first
+# four bytes of the Hash() of its scriptPubKey, interpreted as a big-endian
+# integer; the payer grinds the nonce until the prefix matches the prefix of
+# the stealth address being paid.
+NOTIFICATION_VERSION = 6
+NOTIFICATION_DATA_SIZE = 1 + 4 + 33
+
+def make_notification_scriptPubKey(ephem_pubkey, nonce=0):
+    """Make a notification scriptPubKey for an ephemeral pubkey and nonce"""
+    if len(ephem_pubkey) != 33:
+        raise StealthAddressError('Ephemeral pubkey must be compressed')
+    return script.CScript([script.OP_RETURN,
+                           bytes([NOTIFICATION_VERSION])
+                           + nonce.to_bytes(4, 'big')
+                           + ephem_pubkey])
+
+# Every notification scriptPubKey is exactly OP_RETURN, a direct push of the
+# notification data, then the data itself; recognizing one is a matter of
+# comparing bytes, without parsing the script.
+NOTIFICATION_SCRIPT_SIZE = 2 + NOTIFICATION_DATA_SIZE
+_NOTIFICATION_HEAD = bytes([script.OP_RETURN, NOTIFICATION_DATA_SIZE, NOTIFICATION_VERSION])
+
+def parse_notification_scriptPubKey(scriptPubKey):
+    """Parse a notification scriptPubKey
+
+    Returns (nonce, ephem_pubkey) or None if scriptPubKey is not a
+    notification. Only the canonical form make_notification_scriptPubKey()
+    creates is recognized.
+    """
+    if len(scriptPubKey) != NOTIFICATION_SCRIPT_SIZE or scriptPubKey[0:3] != _NOTIFICATION_HEAD:
+        return None
+    return (int.from_bytes(scriptPubKey[3:7], 'big'), bytes(scriptPubKey[7:]))
+
+def notification_prefix(scriptPubKey):
+    """Return the prefix of a notification scriptPubKey as an integer"""
+    return int.from_bytes(bitcoin.core.Hash(scriptPubKey)[0:4], 'big')
+
+def extract_notifications(tx):
+    """Extract every notification in a transaction
+
+    Returns a list of (n, ephem_pubkey, prefix), n being the index of the
+    notification output. Outputs are matched on their raw bytes; see
+    parse_notification_scriptPubKey().
+    """
+    r = []
+    Hash = bitcoin.core.Hash
+    for n, txout in enumerate(tx.vout):
+        spk = txout.scriptPubKey
+        if len(spk) == NOTIFICATION_SCRIPT_SIZE and spk[0:3] == _NOTIFICATION_HEAD:
+            r.append((n, bytes(spk[7:]), int.from_bytes(Hash(spk)[0:4], 'big')))
+    return r
+
+def iter_block_notifications(txs):
+    """Extract every notification in a CBlock or iterable of CTransaction's
+
+    Yields (i, n, ephem_pubkey, prefix), i being the index of the transaction
+    the notification is in; see extract_notifications().
+    """
+    if isinstance(txs, bitcoin.core.CBlock):
+        txs = txs.vtx
+    for i, tx in enumerate(txs):
+        for n, ephem_pubkey, prefix in extract_notifications(tx):
+            yield (i, n, ephem_pubkey, prefix)
+
+def notification_prefix_target(stealth_addr):
+    """Return (mask, target) such that prefix & mask == target matches stealth_addr"""
+    prefix_length = min(stealth_addr.prefix_length, 32)
+    mask = (0xffffffff << (32 - prefix_length)) & 0xffffffff
+    target = int.from_bytes(stealth_addr.prefix[0:4].ljust(4, b'\x00'), 'big') & mask
+    return (mask, target)
+
+def grind_notification_scriptPubKey(stealth_addr, ephem_pubkey, start_nonce=0, max_nonce=0xffffffff):
+    """Find a notification scriptPubKey whose prefix matches stealth_addr
+
+    Tries nonces from start_nonce to max_nonce inclusive; returns the
+    scriptPubKey, or None if no nonce matched.
+    """
+    if not stealth_addr.prefix_length:
+        return make_notification_scriptPubKey(ephem_pubkey, start_nonce)
+
+    # Build the scriptPubKey bytes directly; this loop runs 2**prefix_length
+    # times on average.
+    ephem_pubkey = bytes(ephem_pubkey)
+    mask, target = notification_prefix_target(stealth_addr)
+    Hash = bitcoin.core.Hash
+    for nonce in range(start_nonce, max_nonce + 1):
+        buf = _NOTIFICATION_HEAD + nonce.to_bytes(4, 'big') + ephem_pubkey
+        if int.from_bytes(Hash(buf)[0:4], 'big') & mask == target:
+            return script.CScript(buf)
+    return None
+
+class _PayeeScriptCache(object):
+    """Bounded, thread-safe LRU cache of (stealth_addr, shared_secret) -> payee scripts"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._scripts = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._scripts.move_to_end(key)
+            except KeyError:
+                return None
+            return self._scripts[key]
+
+    def put(self, key, scripts):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._scripts[key] = scripts
+            while len(self._scripts) > self.maxsize:
+                self._scripts.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._scripts.clear()
+
+
 class StealthAddress(bitcoin.wallet.CBitcoinAddress):
     """A Stealth Address"""
 
@@ -21,6 +158,11 @@ class StealthAddress(bitcoin.wallet.CBitcoinAddress):
     MAX_SPEND_PUBKEYS = 15
     REUSE_SCAN_FOR_SPEND_OPTION = 1 << 0
 
+    # Payee scripts recently derived by make_payee_scriptPubKey(s)(), so that
+    # checking the same candidate again, say once in the mempool and once in a
+    # block, doesn't redo the derivation.
+    payee_scriptPubKey_cache = _PayeeScriptCache(65536)
+
     @property
     def reuse_scan_for_spend(self):
         """Return True if the scan pubkey is reused as a spend pubkey"""
@@ -35,8 +177,31 @@ class StealthAddress(bitcoin.wallet.CBitcoinAddress):
         """
         return int(self.prefix_length / 8) + (1 if self.prefix_length % 8 else 0)
 
-    def __init__(self, s):
-        """Initialize from address string"""
+    def matches_prefix(self, prefix):
+        """Return True if a notification prefix matches this address's prefix
+
+        Only the first 32 bits of the address's prefix can be matched; any
+        further bits are ignored.
+        """
+        prefix_length = min(self.prefix_length, 32)
+        if not prefix_length:
+            return True
+        mask = (0xffffffff << (32 - prefix_length)) & 0xffffffff
+        addr_prefix = int.from_bytes(self.prefix[0:4].ljust(4, b'\x00'), 'big')
+        return (prefix & mask) == (addr_prefix & mask)
+
+    def __new__(cls, s, validate=True):
+        return super(StealthAddress, cls).__new__(cls, s)
+
+    def __init__(self, s, validate=True):
+        """Initialize from address string
+
+        If validate is False only the layout of the address is parsed and
+        checked; the pubkeys are left as bytes and are not checked for
+        validity. The first access of scan_pubkey, spend_pubkeys or
+        all_spend_pubkeys, or an explicit call to validate(), finishes the
+        job and raises StealthAddressError if a pubkey is invalid.
+        """
 
         # Note that we don't actually have to do anything with our argument;
         # __new__() already did the heavy-lifting. We just need to take the
@@ -47,10 +212,8 @@ class StealthAddress(bitcoin.wallet.CBitcoinAddress):
             raise StealthAddressError('Stealth address truncated at options')
 
         i = 1
-        try:
-            self.scan_pubkey = bitcoin.core.key.CPubKey(self[i:i+33])
-            self.scan_pubkey[32] # force a failure if scan_pubkey is too short
-        except IndexError:
+        self._scan_pubkey_bytes = self[i:i+33]
+        if len(self._scan_pubkey_bytes) < 33:
             raise StealthAddressError('Stealth address truncated at scan_pubkey')
 
         i += 33
@@ -61,16 +224,12 @@ class StealthAddress(bitcoin.wallet.CBitcoinAddress):
             raise StealthAddressError('Stealth address truncated at n')
         i += 1
 
-        try:
-            self.spend_pubkeys = []
-            for j in range(n):
-                self.spend_pubkeys.append(bitcoin.core.key.CPubKey(self[i:i+33]))
-                self.spend_pubkeys[-1][32] # force a failure if spend_pubkey is too short
-                i += 33
-
-        except IndexError:
-            raise StealthAddressError('Stealth address truncated at spend pubkeys')
-
+        self._spend_pubkeys_bytes = []
+        for j in range(n):
+            self._spend_pubkeys_bytes.append(self[i:i+33])
+            if len(self._spend_pubkeys_bytes[-1]) < 33:
+                raise StealthAddressError('Stealth address truncated at spend pubkeys')
+            i += 33
 
         try:
             self.m = self[i]
@@ -95,41 +254,88 @@ class StealthAddress(bitcoin.wallet.CBitcoinAddress):
         # Additional data at the end of an address *is* allowed for forwards
         # compatibility with new options.
 
+        if validate:
+            self.validate()
+        else:
+            self._check_spend_pubkeys(self._scan_pubkey_bytes, self._spend_pubkeys_bytes)
+
+    # Attributes that are only set once the pubkeys have been validated
+    _VALIDATED_ATTRIBUTES = frozenset(('scan_pubkey', 'spend_pubkeys', 'all_spend_pubkeys'))
+
+    def __getattr__(self, name):
+        # Only called if normal attribute lookup fails, so costs nothing once
+        # validated.
+        if name in self._VALIDATED_ATTRIBUTES:
+            self.validate()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    @property
+    def is_validated(self):
+        """Return True if the pubkeys have been validated"""
+        return 'scan_pubkey' in self.__dict__
+
+    def validate(self):
+        """Validate the pubkeys
+
+        Does nothing if already validated. Raises StealthAddressError if a
+        pubkey is invalid.
+        """
+        if self.is_validated:
+            return
+
+        scan_pubkey = bitcoin.core.key.CPubKey(self._scan_pubkey_bytes)
+        spend_pubkeys = [bitcoin.core.key.CPubKey(spend_pubkey)
+                         for spend_pubkey in self._spend_pubkeys_bytes]
+
         # Check pubkeys after reading all data; we want to display truncation
         # errors first.
-        if not self.scan_pubkey.is_fullyvalid:
+        if not scan_pubkey.is_fullyvalid:
             raise StealthAddressError('Invalid scan pubkey')
 
-        for spend_pubkey in self.spend_pubkeys:
+        for spend_pubkey in spend_pubkeys:
             if not spend_pubkey.is_fullyvalid:
                 raise StealthAddressError('Invalid spend pubkey %s' %
                                           bitcoin.core.b2x(spend_pubkey))
 
+        all_spend_pubkeys = self._check_spend_pubkeys(scan_pubkey, spend_pubkeys)
+
+        self.spend_pubkeys = spend_pubkeys
+        self.all_spend_pubkeys = all_spend_pubkeys
+        self.scan_pubkey = scan_pubkey
+
+    def _check_spend_pubkeys(self, scan_pubkey, spend_pubkeys):
+        """Check the spend pubkeys are canonical; returns all_spend_pubkeys
+
+        Works equally well on bytes as on CPubKey's.
+        """
         # Check if spend_pubkeys were in sorted order; we don't want to make
         # stealth addresses mutable without a good reason.
-        if not sorted(self.spend_pubkeys) == self.spend_pubkeys:
+        if not sorted(spend_pubkeys) == spend_pubkeys:
             raise StealthAddressError('Spend pubkeys not in canonical sorted order')
 
         # Check for duplicates
-        self.all_spend_pubkeys = set()
+        all_spend_pubkeys = set()
         if self.reuse_scan_for_spend:
-            self.all_spend_pubkeys.add(self.scan_pubkey)
+            all_spend_pubkeys.add(scan_pubkey)
 
-        for spend_pubkey in self.spend_pubkeys:
-            if spend_pubkey in self.all_spend_pubkeys:
+        for spend_pubkey in spend_pubkeys:
+            if spend_pubkey in all_spend_pubkeys:
                 raise StealthAddressError('Duplicate spend pubkey %s' % bitcoin.core.b2x(spend_pubkey))
-            self.all_spend_pubkeys.add(spend_pubkey)
+            all_spend_pubkeys.add(spend_pubkey)
 
-        if not self.all_spend_pubkeys:
+        if not all_spend_pubkeys:
             raise StealthAddressError('No spend pubkeys specified!')
 
-        if len(self.all_spend_pubkeys) > self.MAX_SPEND_PUBKEYS:
+        if len(all_spend_pubkeys) > self.MAX_SPEND_PUBKEYS:
             raise StealthAddressError('Too many spend pubkeys; got %d, max allowed is %d' % \
-                                      (len(self.all_spend_pubkeys), self.MAX_SPEND_PUBKEYS))
+                                      (len(all_spend_pubkeys), self.MAX_SPEND_PUBKEYS))
 
-        if not (0 < self.m <= len(self.all_spend_pubkeys)):
+        if not (0 < self.m <= len(all_spend_pubkeys)):
             raise StealthAddressError('m must be 0 < m <= # of spend pubkeys (including scan pubkey, if reused as spend)')
 
+        return all_spend_pubkeys
+
 
     @classmethod
     def from_pubkeys(cls, scan_pubkey, spend_pubkeys=(),
@@ -149,12 +355,9 @@ class StealthAddress(bitcoin.wallet.CBitcoinAddress):
         if not (0 <= prefix_length <= 255):
             raise StealthAddressError('Invalid prefix length; must be between 0 and 255 inclusive; got %r' % prefix_length)
 
-        if self.prefix_length_in_bytes != len(prefix):
+        if int(prefix_length / 8) + (1 if prefix_length % 8 else 0) != len(prefix):
             raise StealthAddressError('prefix_length does not match given prefix')
 
-        self.prefix_length = prefix_length
-        self.prefix = prefix
-
         if not scan_pubkey.is_compressed:
             raise StealthAddressError('scan_pubkey must be compressed')
         for spend_pubkey in spend_pubkeys:
@@ -176,52 +379,138 @@ class StealthAddress(bitcoin.wallet.CBitcoinAddress):
             if reuse_scan_for_spend:
                 m += 1
         if not (0 < m <= cls.MAX_SPEND_PUBKEYS):
-            raise StealthAddressError('m must be in range 0 < m <= MAX_SPEND_PUBKEYS; got %d' % n)
+            raise StealthAddressError('m must be in range 0 < m <= MAX_SPEND_PUBKEYS; got %d' % m)
 
-        # As we're encoding the address data directly and passing it through
-        # the usual machinery __init__() will be called, which has all the
-        # validation and instance attribute initialization machinery.
+        # As we're encoding the address data directly we call __init__()
+        # ourselves, which has all the validation and instance attribute
+        # initialization machinery.
         buf = (bytes([option_flags])
                + scan_pubkey
                + bytes([len(spend_pubkeys)])
                + b''.join(spend_pubkeys)
-               + bytes([m]))
+               + bytes([m])
+               + bytes([prefix_length])
+               + prefix)
 
-        return cls.from_bytes(buf, cls.BASE58_PREFIX)
+        self = cls.from_bytes(buf, cls.BASE58_PREFIX)
+        self.__init__(None)
+        return self
 
 
     def to_scriptPubKey(self):
         raise NotImplementedError("You can not turn a StealthAddress directly into a scriptPubKey")
 
 
+    @staticmethod
+    def derive_tweak(shared_secret):
+        """Derive the tweak added to spend keys from the shared secret"""
+        tweak = int.from_bytes(hashlib.sha256(shared_secret).digest(), 'big')
+        if not (0 < tweak < stealthaddress.ecc.N):
+            raise StealthAddressError('Shared secret gives an out of range tweak')
+        return tweak
+
     @staticmethod
     def derive_pubkey(spend_pubkey, shared_secret):
-        """Derive a pubkey from a spend pubkey and the shared secret"""
-        # FIXME: Need to implement ECC addition
-        return bitcoin.core.key.CPubKey(spend_pubkey)
+        """Derive a pubkey from a spend pubkey and the shared secret
 
-    def make_payee_scriptPubKey(self, shared_secret):
-        """Make the payee's scriptPubKey based on the shared secret
+        The derived pubkey is spend_pubkey + SHA256(shared_secret)*G
+        """
+        tweak = StealthAddress.derive_tweak(shared_secret)
+        try:
+            point = stealthaddress.ecc.add_mul_G(stealthaddress.ecc.decompress(spend_pubkey), tweak)
+            return bitcoin.core.key.CPubKey(stealthaddress.ecc.compress(point))
+        except stealthaddress.ecc.ECCError as err:
+            raise StealthAddressError('Can not derive pubkey: %s' % err)
 
-        Returns (scriptPubKey, redeemScript). If P2SH is not used, redeemScript
-        will be set to None.
+    @staticmethod
+    def _derive_pubkey_bytes(pairs):
+        """Derive compressed pubkeys, as bytes, for (spend_pubkey, shared_secret) pairs"""
+        try:
+            points = stealthaddress.ecc.add_mul_G_batch(
+                        [(stealthaddress.ecc.decompress(spend_pubkey), StealthAddress.derive_tweak(shared_secret))
+                         for spend_pubkey, shared_secret in pairs])
+            return [stealthaddress.ecc.compress(point) for point in points]
+        except stealthaddress.ecc.ECCError as err:
+            raise StealthAddressError('Can not derive pubkey: %s' % err)
+
+    @staticmethod
+    def derive_pubkeys(pairs):
+        """Derive many pubkeys at once
+
+        pairs - Iterable of (spend_pubkey, shared_secret)
+
+        Returns a list of CPubKey's, as derive_pubkey() would. A single
+        modular inversion is shared by the whole batch, which makes this
+        several times faster per pubkey than calling derive_pubkey()
+        repeatedly.
+        """
+        return [bitcoin.core.key.CPubKey(pubkey)
+                for pubkey in StealthAddress._derive_pubkey_bytes(pairs)]
+
+    @staticmethod
+    def derive_secret(spend_secret, shared_secret):
+        """Derive the secret key of a derived pubkey
+
+        The derived secret is spend_secret + SHA256(shared_secret) mod n, the
+        secret key of derive_pubkey(spend_secret.pub, shared_secret).
+        Returns a CBitcoinSecret.
         """
+        return StealthAddress.derive_secrets([(spend_secret, shared_secret)])[0]
+
+    @staticmethod
+    def derive_secrets(pairs):
+        """Derive many secret keys at once
+
+        pairs - Iterable of (spend_secret, shared_secret), spend_secret being
+                a compressed CBitcoinSecret
 
-        if len(self.all_spend_pubkeys) == 1:
-            spend_pubkey = list(self.all_spend_pubkeys)[0]
-            derived_pubkey = self.derive_pubkey(spend_pubkey, shared_secret)
+        Returns a list of CBitcoinSecret's, as derive_secret() would. The
+        pubkeys are derived as spend_pubkey + tweak*G, from public values
+        only and in a single batch, so OpenSSL is only handed the finished
+        keys.
+        """
+        secrets = []
+        points = []
+        spend_points = {}
+        for spend_secret, shared_secret in pairs:
+            if not isinstance(spend_secret, bitcoin.wallet.CBitcoinSecret):
+                raise StealthAddressError('Spend secret must be a CBitcoinSecret; got %r' % type(spend_secret))
+            spend_pubkey = bytes(spend_secret.pub)
+            spend_point = spend_points.get(spend_pubkey)
+            if spend_point is None:
+                try:
+                    spend_point = spend_points[spend_pubkey] = stealthaddress.ecc.decompress(spend_pubkey)
+                except stealthaddress.ecc.ECCError as err:
+                    raise StealthAddressError('Can not decode spend pubkey: %s' % err)
+
+            tweak = StealthAddress.derive_tweak(shared_secret)
+            secret = (int.from_bytes(spend_secret[0:32], 'big') + tweak) % stealthaddress.ecc.N
+            if not secret:
+                raise StealthAddressError('Derived secret is zero')
+            secrets.append(secret)
+            points.append((spend_point, tweak))
 
+        try:
+            pubkeys = [stealthaddress.ecc.compress(point)
+                       for point in stealthaddress.ecc.add_mul_G_batch(points)]
+        except stealthaddress.ecc.ECCError as err:
+            raise StealthAddressError('Can not derive pubkey: %s' % err)
+        return [bitcoin.wallet.CBitcoinSecret.from_secret_bytes(secret.to_bytes(32, 'big'), pubkey=pubkey)
+                for secret, pubkey in zip(secrets, pubkeys)]
+
+    def _make_payee_scriptPubKey_from_derived(self, derived_pubkeys):
+        """Make the payee's scriptPubKey from the derived spend pubkeys"""
+        if len(derived_pubkeys) == 1:
             scriptPubKey = script.CScript([script.OP_DUP, script.OP_HASH160,
-                                           bitcoin.core.Hash160(derived_pubkey),
+                                           bitcoin.core.Hash160(derived_pubkeys[0]),
                                            script.OP_EQUALVERIFY, script.OP_CHECKSIG])
 
             return (scriptPubKey, None)
 
-        elif len(self.all_spend_pubkeys) > 1:
-            derived_pubkeys = sorted([self.derive_pubkey(spend_pubkey, shared_secret)
-                                        for spend_pubkey in self.all_spend_pubkeys])
+        elif len(derived_pubkeys) > 1:
+            derived_pubkeys = sorted(derived_pubkeys)
 
-            redeemScript = script.CScript([self.n]
+            redeemScript = script.CScript([self.m]
                                           + derived_pubkeys
                                           + [len(derived_pubkeys), script.OP_CHECKMULTISIG])
 
@@ -231,26 +520,509 @@ class StealthAddress(bitcoin.wallet.CBitcoinAddress):
         else:
             assert False
 
+    def _get_spend_points(self):
+        """Return all spend pubkeys decoded to curve points, in sorted order
+
+        Decoded once per address and kept.
+        """
+        try:
+            return self._spend_points
+        except AttributeError:
+            try:
+                self._spend_points = [stealthaddress.ecc.decompress(spend_pubkey)
+                                      for spend_pubkey in sorted(self.all_spend_pubkeys)]
+            except stealthaddress.ecc.ECCError as err:
+                raise StealthAddressError('Can not decode spend pubkey: %s' % err)
+            return self._spend_points
+
+    @staticmethod
+    def make_payee_scriptPubKeys(items, cache=True, metrics=None):
+        """Make the payee scriptPubKeys for many addresses at once
+
+        items   - Iterable of (stealth_addr, shared_secret)
+        cache   - Use payee_scriptPubKey_cache; pointless if the shared
+                  secrets are known to be fresh, as when paying.
+        metrics - Optional Metrics registry counting the derivations done,
+                  memo hits excluded
+
+        Returns a list of (scriptPubKey, redeemScript), as
+        make_payee_scriptPubKey() would. Derivations not already cached are
+        done in a single batch.
+        """
+        items = list(items)
+        r = [None] * len(items)
+
+        misses = []
+        pairs = []
+        for i, item in enumerate(items):
+            if cache:
+                r[i] = StealthAddress.payee_scriptPubKey_cache.get(item)
+                if r[i] is not None:
+                    continue
+            stealth_addr, shared_secret = item
+            misses.append(i)
+            tweak = StealthAddress.derive_tweak(shared_secret)
+            pairs.extend((point, tweak) for point in stealth_addr._get_spend_points())
+
+        if metrics is not None:
+            metrics.incr('derive', len(pairs))
+        try:
+            derived_pubkeys = [stealthaddress.ecc.compress(point)
+                               for point in stealthaddress.ecc.add_mul_G_batch(pairs)]
+        except stealthaddress.ecc.ECCError as err:
+            raise StealthAddressError('Can not derive pubkey: %s' % err)
+
+        j = 0
+        for i in misses:
+            stealth_addr = items[i][0]
+            k = j + len(stealth_addr._get_spend_points())
+            r[i] = stealth_addr._make_payee_scriptPubKey_from_derived(derived_pubkeys[j:k])
+            j = k
+            if cache:
+                StealthAddress.payee_scriptPubKey_cache.put(items[i], r[i])
+
+        return r
 
-    def pay(self, tx_template=None):
-        pass
+    def make_payee_scriptPubKey(self, shared_secret):
+        """Make the payee's scriptPubKey based on the shared secret
+
+        Returns (scriptPubKey, redeemScript). If P2SH is not used, redeemScript
+        will be set to None.
+        """
+        return self.make_payee_scriptPubKeys([(self, shared_secret)])[0]
+
+
+    def pay(self, nValue, tx_template=None):
+        """Make a transaction paying nValue to this address
+
+        See pay()
+        """
+        return pay([(self, nValue)], tx_template)
 
 
 class StealthScanSecret(bitcoin.base58.CBase58Data):
-    """Stealth address with the scan secret key used to find stealth payments"""
+    """Stealth address with the scan secret key used to find stealth payments
+
+    Attributes:
+
+    scan_secret  - The 32-byte scan secret
+    stealth_addr - The StealthAddress the scan secret is for
+    """
     BASE58_PREFIX = 254
 
-    def __new__(cls, scan_secret, stealth_addr):
-        self = cls.from_bytes(scan_secret + stealth_addr, BASE58_PREFIX)
+    @classmethod
+    def from_secret_bytes(cls, scan_secret, stealth_addr):
+        """Create from a 32-byte scan secret and a StealthAddress"""
+        self = cls.from_bytes(scan_secret + stealth_addr, cls.BASE58_PREFIX)
+        self.__init__(None)
         return self
 
+    def __init__(self, s):
+        if len(self) < 32:
+            raise StealthAddressError('Stealth scan secret truncated at scan_secret')
+        self.scan_secret = self[0:32]
+
+        self.stealth_addr = StealthAddress.from_bytes(self[32:], StealthAddress.BASE58_PREFIX)
+        self.stealth_addr.__init__(None)
+
+        self._cec_key = bitcoin.core.key.CECKey()
+        self._cec_key.set_secretbytes(self.scan_secret)
+        self._cec_key.set_compressed(True)
+        if self._cec_key.get_pubkey() != self.stealth_addr.scan_pubkey:
+            raise StealthAddressError('Scan secret does not match scan pubkey')
+
+    @property
+    def scan_pubkey(self):
+        return self.stealth_addr.scan_pubkey
+
+    def scan_ecdh_many(self, ephem_pubkeys):
+        """Return the shared secrets for many ephemeral pubkeys
+
+        ephem_pubkeys - Iterable of pubkeys, as bytes or CPubKey's
+
+        Returns a list with the 32-byte shared secret of every pubkey, or None
+        in place of any invalid pubkey. No CPubKey is needed per pubkey.
+        """
+        return self._cec_key.get_raw_ecdh_keys(bytes(ephem_pubkey) for ephem_pubkey in ephem_pubkeys)
+
+    def ecdh(self, ephem_pubkey):
+        """Return the shared secret for an ephemeral pubkey
+
+        Raises StealthAddressError if the pubkey is invalid.
+        """
+        shared_secret = self.scan_ecdh_many((ephem_pubkey,))[0]
+        if shared_secret is None:
+            raise StealthAddressError('Invalid ephemeral pubkey')
+        return shared_secret
+
+
+class StealthPayment(object):
+    """A payment to a stealth address found by recover()
+
+    Attributes:
 
-def recover(tx, stealth_scan_secrets):
+    outpoint            - COutPoint of the payee output
+    nValue              - Value of the payee output
+    scriptPubKey        - The payee scriptPubKey
+    redeemScript        - P2SH redeemScript, or None if P2SH is not used
+    ephem_pubkey        - Ephemeral pubkey from the notification output
+    shared_secret       - Shared secret derived from the ephemeral pubkey
+    stealth_scan_secret - The StealthScanSecret that found the payment
+    """
+    __slots__ = ['outpoint', 'nValue', 'scriptPubKey', 'redeemScript',
+                 'ephem_pubkey', 'shared_secret', 'stealth_scan_secret']
+
+    def __init__(self, outpoint, nValue, scriptPubKey, redeemScript,
+                 ephem_pubkey, shared_secret, stealth_scan_secret):
+        self.outpoint = outpoint
+        self.nValue = nValue
+        self.scriptPubKey = scriptPubKey
+        self.redeemScript = redeemScript
+        self.ephem_pubkey = ephem_pubkey
+        self.shared_secret = shared_secret
+        self.stealth_scan_secret = stealth_scan_secret
+
+    @property
+    def stealth_addr(self):
+        return self.stealth_scan_secret.stealth_addr
+
+    def __repr__(self):
+        return 'StealthPayment(%r, %d, %r)' % (self.outpoint, self.nValue, self.stealth_addr)
+
+
+class StealthScanner(object):
+    """Scan transactions for payments to many stealth addresses at once
+
+    Notifications are first filtered by prefix with a PrefixIndex, so only
+    addresses whose prefix matches are considered at all. The candidates are
+    then grouped by scan pubkey; for every notification only one ECDH
+    operation is done per distinct scan pubkey, regardless of how many
+    stealth addresses share it.
+
+    If an ecdh_executor, such as a stealthaddress.ecdhpool.ECDHExecutor, is
+    given scan() hands it the ECDH operations of every matching notification
+    in a batch of transactions at once.
+
+    If a stealthaddress.metrics.Metrics registry is given the work and time
+    of every stage is recorded in it.
+    """
+
+    # Number of transactions prefix-filtered at once by scan()
+    PREFILTER_CHUNK_SIZE = 4096
+
+    def __init__(self, stealth_scan_secrets, ecdh_executor=None, metrics=None):
+        self.ecdh_executor = ecdh_executor
+        self.metrics = stealthaddress.metrics.DISABLED if metrics is None else metrics
+        self.prefix_index = stealthaddress.prefix.PrefixIndex()
+        for stealth_scan_secret in stealth_scan_secrets:
+            self.add(stealth_scan_secret)
+
+    def add(self, stealth_scan_secret):
+        """Add a StealthScanSecret to scan for"""
+        self.prefix_index.add(stealth_scan_secret.stealth_addr, stealth_scan_secret)
+
+    def scan_notification(self, ephem_pubkey, prefix, shared_secrets=None):
+        """Find the payee scripts a notification could be paying
+
+        ephem_pubkey   - Ephemeral pubkey of the notification, as bytes
+        prefix         - Prefix of the notification
+        shared_secrets - Optional dict of (scan_pubkey, ephem_pubkey) ->
+                         shared secret already computed; see ecdh_many()
+
+        Yields (stealth_scan_secret, ephem_pubkey, shared_secret,
+        scriptPubKey, redeemScript) for every candidate address, with
+        ephem_pubkey as a CPubKey. A payment exists if the transaction has an
+        output with that scriptPubKey.
+        """
+        return self._scan_candidates(ephem_pubkey, self.prefix_index.candidates(prefix), shared_secrets)
+
+    def _scan_candidates(self, ephem_pubkey, candidates, shared_secrets=None):
+        """scan_notification(), given the candidates of its prefix"""
+        if not candidates:
+            return
+
+        ephem_pubkey = bitcoin.core.key.CPubKey(ephem_pubkey)
+        if not ephem_pubkey.is_fullyvalid:
+            return
+        if shared_secrets is None:
+            shared_secrets = {}
+
+        scan_groups = {}
+        for stealth_scan_secret in candidates:
+            scan_groups.setdefault(stealth_scan_secret.scan_pubkey, []).append(stealth_scan_secret)
+
+        # One ECDH per scan pubkey, then derive the payee scripts of every
+        # candidate in a single batch.
+        metrics = self.metrics
+        items = []
+        for scan_pubkey, scan_group in scan_groups.items():
+            shared_secret = shared_secrets.get((scan_pubkey, ephem_pubkey))
+            if shared_secret is None:
+                metrics.incr('ecdh')
+                with metrics.timer('ecdh'):
+                    shared_secret = scan_group[0].ecdh(ephem_pubkey)
+            for stealth_scan_secret in scan_group:
+                items.append((stealth_scan_secret, shared_secret))
+        with metrics.timer('derive'):
+            payee_scripts = StealthAddress.make_payee_scriptPubKeys(
+                    ((stealth_scan_secret.stealth_addr, shared_secret)
+                     for stealth_scan_secret, shared_secret in items),
+                    metrics=metrics)
+
+        for (stealth_scan_secret, shared_secret), (scriptPubKey, redeemScript) in zip(items, payee_scripts):
+            yield (stealth_scan_secret, ephem_pubkey, shared_secret, scriptPubKey, redeemScript)
+
+    def ecdh_many(self, txs):
+        """Compute the shared secrets every notification in txs needs
+
+        One ECDH per notification and distinct candidate scan pubkey, done in
+        a single batch by the ecdh_executor. Returns a dict suitable for the
+        shared_secrets argument of scan_tx() and scan_notification().
+        """
+        return self._ecdh_many(self._prefilter(txs))
+
+    def _ecdh_many(self, matched):
+        """ecdh_many(), given the (tx, hits) list _prefilter() returns"""
+        keys = []
+        items = []
+        seen = set()
+        for tx, hits in matched:
+            for ephem_pubkey, candidates in hits:
+                for stealth_scan_secret in candidates:
+                    key = (stealth_scan_secret.scan_pubkey, ephem_pubkey)
+                    if key not in seen:
+                        seen.add(key)
+                        keys.append(key)
+                        items.append((stealth_scan_secret.scan_secret, ephem_pubkey))
+        self.metrics.incr('ecdh', len(items))
+        with self.metrics.timer('ecdh'):
+            shared_secrets = self.ecdh_executor.map(items)
+        return {key: shared_secret
+                for key, shared_secret in zip(keys, shared_secrets)
+                if shared_secret is not None}
+
+    def scan_tx(self, tx, txid=None, shared_secrets=None):
+        """Scan a single transaction, yielding StealthPayment's
+
+        shared_secrets - Optional precomputed shared secrets; see ecdh_many()
+        """
+        hits = [(ephem_pubkey, self.prefix_index.candidates(prefix))
+                for n, ephem_pubkey, prefix in extract_notifications(tx)]
+        return self._scan_tx(tx, hits, txid, shared_secrets)
+
+    def _scan_tx(self, tx, hits, txid=None, shared_secrets=None):
+        """scan_tx(), given the (ephem_pubkey, candidates) of its notifications"""
+        if not hits:
+            return
+
+        outputs = {}
+        for n, txout in enumerate(tx.vout):
+            outputs.setdefault(txout.scriptPubKey, []).append(n)
+
+        if txid is None:
+            txid = bitcoin.core.Hash(tx.serialize())
+
+        metrics = self.metrics
+        for ephem_pubkey_bytes, candidates in hits:
+            for stealth_scan_secret, ephem_pubkey, shared_secret, scriptPubKey, redeemScript \
+                    in self._scan_candidates(ephem_pubkey_bytes, candidates, shared_secrets):
+                metrics.incr('script_comparisons')
+                for n in outputs.get(scriptPubKey, ()):
+                    metrics.incr('payments')
+                    yield StealthPayment(bitcoin.core.COutPoint(txid, n),
+                                         tx.vout[n].nValue,
+                                         scriptPubKey, redeemScript,
+                                         ephem_pubkey, shared_secret,
+                                         stealth_scan_secret)
+
+    def scan(self, txs):
+        """Scan transactions, yielding StealthPayment's
+
+        txs may be a CTransaction, a CBlock, or an iterable of CTransaction's.
+        Prefixes are matched once per chunk of transactions, by _prefilter(),
+        and the candidates it finds are used by the ECDH and derivation
+        steps as they are.
+        """
+        if isinstance(txs, bitcoin.core.CTransaction):
+            txs = (txs,)
+        elif isinstance(txs, bitcoin.core.CBlock):
+            txs = txs.vtx
+
+        txs = iter(txs)
+        while True:
+            chunk = list(itertools.islice(txs, self.PREFILTER_CHUNK_SIZE))
+            if not chunk:
+                break
+            matched = self._prefilter(chunk)
+            shared_secrets = None
+            if self.ecdh_executor is not None and matched:
+                shared_secrets = self._ecdh_many(matched)
+            for tx, hits in matched:
+                for payment in self._scan_tx(tx, hits, shared_secrets=shared_secrets):
+                    yield payment
+
+    def prefilter(self, txs):
+        """Return the transactions with a notification matching some address prefix
+
+        The prefixes of every notification in txs are matched in one go; see
+        PrefixIndex.candidates_many()
+        """
+        return [tx for tx, hits in self._prefilter(txs)]
+
+    def _prefilter(self, txs):
+        """Match the prefixes of every notification in txs
+
+        Returns a list of (tx, hits) for the transactions with at least one
+        match, hits being the (ephem_pubkey, candidates) of every matching
+        notification in the transaction.
+        """
+        metrics = self.metrics
+        with metrics.timer('prefilter'):
+            notifications = []
+            prefixes = []
+            for i, n, ephem_pubkey, prefix in iter_block_notifications(txs):
+                notifications.append((i, ephem_pubkey))
+                prefixes.append(prefix)
+
+            hits = 0
+            matched = {}
+            for (i, ephem_pubkey), candidates in zip(notifications, self.prefix_index.candidates_many(prefixes)):
+                if candidates:
+                    hits += 1
+                    matched.setdefault(i, []).append((ephem_pubkey, candidates))
+
+        if metrics.enabled:
+            metrics.incr('outputs_examined', sum(len(tx.vout) for tx in txs))
+            metrics.incr('notifications', len(prefixes))
+            metrics.incr('prefix_hits', hits)
+        return [(txs[i], matched[i]) for i in sorted(matched)]
+
+
+def recover(txs, stealth_scan_secrets):
     """Recover payments to stealth addresses
 
-    tx                   - candidate transaction
+    txs                  - CTransaction, CBlock, or iterable of CTransaction's
     stealth_scan_secrets - iterable of StealthScanSecret's
 
-    Most efficient if the stealth_addresses all share the same scanpubkey.
+    Returns an iterator of StealthPayment's. Most efficient if the stealth
+    addresses share scan pubkeys; one ECDH operation is done per notification
+    and distinct scan pubkey.
+    """
+    return StealthScanner(stealth_scan_secrets).scan(txs)
+
+
+def recover_spend_keys(payments, spend_secrets):
+    """Derive the secret keys needed to spend payments
+
+    payments      - Iterable of StealthPayment's
+    spend_secrets - Iterable of CBitcoinSecret's for the spend pubkeys of
+                    the payments' addresses; for addresses reusing the scan
+                    key for spending, include the scan key
+
+    Every derivation is done in one batch; see StealthAddress.derive_secrets().
+    Returns a list with, for every payment, the list of derived
+    CBitcoinSecret's for the spend pubkeys a secret was given for, in spend
+    pubkey order. Raises StealthAddressError if none was given for some
+    payment.
     """
+    spend_secrets = {bytes(spend_secret.pub): spend_secret for spend_secret in spend_secrets}
+
+    counts = []
+    pairs = []
+    for payment in payments:
+        n = 0
+        for spend_pubkey in sorted(payment.stealth_addr.all_spend_pubkeys):
+            spend_secret = spend_secrets.get(bytes(spend_pubkey))
+            if spend_secret is not None:
+                pairs.append((spend_secret, payment.shared_secret))
+                n += 1
+        if not n:
+            raise StealthAddressError('No spend secret given for %r' % payment)
+        counts.append(n)
+
+    secrets = StealthAddress.derive_secrets(pairs)
+    r = []
+    i = 0
+    for n in counts:
+        r.append(secrets[i:i+n])
+        i += n
+    return r
+
+
+def make_ephem_keys(count):
+    """Make count random ephemeral keys
+
+    Returns a list of (ephem_secret, ephem_pubkey) tuples, with both as bytes.
+    The pubkeys are computed by OpenSSL; the secrets never go through the
+    variable-time arithmetic of stealthaddress.ecc.
+    """
+    cec_key = bitcoin.core.key.CECKey()
+    cec_key.set_compressed(True)
+    r = []
+    while len(r) < count:
+        ephem_secret = os.urandom(32)
+        if 0 < int.from_bytes(ephem_secret, 'big') < stealthaddress.ecc.N:
+            cec_key.set_secretbytes(ephem_secret)
+            r.append((ephem_secret, cec_key.get_pubkey()))
+    return r
+
+def pay(payments, tx_template=None, ephem_keys=None, grinder=None):
+    """Make a transaction paying many stealth addresses
+
+    payments    - Iterable of (StealthAddress, nValue)
+    tx_template - Transaction to add the outputs to; its inputs and outputs
+                  are copied, it isn't modified.
+    ephem_keys  - Iterable of (ephem_secret, ephem_pubkey) to use, one per
+                  payment; random keys are made if not given.
+    grinder     - Optional stealthaddress.grind.Grinder to grind prefixes
+                  with, for addresses with long prefixes
+
+    Every payment gets a notification output, with a nonce ground to match
+    the address prefix if it has one, followed by the payee output. Ephemeral
+    keys and shared secrets are computed by OpenSSL; payee pubkeys, which
+    only involve public values, in a batch sharing a single modular
+    inversion.
+
+    Returns a new CTransaction.
+    """
+    payments = list(payments)
+    if ephem_keys is None:
+        ephem_keys = make_ephem_keys(len(payments))
+    else:
+        ephem_keys = list(ephem_keys)
+        if len(ephem_keys) != len(payments):
+            raise StealthAddressError('Need one ephemeral key per payment; got %d for %d payments' %
+                                      (len(ephem_keys), len(payments)))
+
+    # ECDH is done by OpenSSL, as for scanning; one EC_KEY is reused for
+    # every ephemeral secret.
+    cec_key = bitcoin.core.key.CECKey()
+    items = []
+    for (stealth_addr, nValue), (ephem_secret, ephem_pubkey) in zip(payments, ephem_keys):
+        if not (0 < int.from_bytes(ephem_secret, 'big') < stealthaddress.ecc.N):
+            raise StealthAddressError('Ephemeral secret out of range')
+        cec_key.set_private_secretbytes(ephem_secret)
+        shared_secret = cec_key.get_raw_ecdh_keys([bytes(stealth_addr.scan_pubkey)])[0]
+        if shared_secret is None:
+            raise StealthAddressError('Invalid scan pubkey in %s' % stealth_addr)
+        items.append((stealth_addr, shared_secret))
+    payee_scripts = StealthAddress.make_payee_scriptPubKeys(items, cache=False)
+
+    if tx_template is None:
+        tx_template = bitcoin.core.CTransaction()
+    vout = list(tx_template.vout)
+
+    for (stealth_addr, nValue), (ephem_secret, ephem_pubkey), (scriptPubKey, redeemScript) \
+            in zip(payments, ephem_keys, payee_scripts):
+        if grinder is not None:
+            notification = grinder.grind(stealth_addr, ephem_pubkey)
+        else:
+            notification = grind_notification_scriptPubKey(stealth_addr, ephem_pubkey)
+        if notification is None:
+            raise StealthAddressError('No nonce matches the prefix of %s' % stealth_addr)
+
+        vout.append(bitcoin.core.CTxOut(0, notification))
+        vout.append(bitcoin.core.CTxOut(nValue, scriptPubKey))
 
+    return bitcoin.core.CTransaction(list(tx_template.vin), vout,
+                                     tx_template.nLockTime, tx_template.nVersion)
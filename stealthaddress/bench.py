@@ -0,0 +1,213 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Benchmarks of the stealth address hot paths
+
+Run with:
+
+    python3 -m stealthaddress.bench [--output results.json]
+
+Every benchmark runs against a synthetic corpus derived from fixed seeds, so
+results are comparable between runs and machines. Results are written as
+JSON, with throughput in operations per second.
+
+To catch regressions, compare against earlier results:
+
+    python3 -m stealthaddress.bench --baseline results.json --threshold 0.2
+
+exits with status 1 if any benchmark is more than 20% slower than in the
+baseline.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import bitcoin.core
+import bitcoin.core.key
+
+import stealthaddress
+from stealthaddress.ecc import compress, mul_G
+
+DEFAULT_SCAN_KEY_COUNTS = (1, 100, 10000)
+DEFAULT_REPEAT = 3
+
+# Prefix length of the addresses in the recover corpus. Without a prefix
+# every notification would need one ECDH per scan key.
+RECOVER_PREFIX_LENGTH = 8
+
+def make_secret(seed):
+    """Return a deterministic (secret, compressed pubkey bytes) from a seed"""
+    secret = bitcoin.core.Hash(seed)
+    return secret, compress(mul_G(int.from_bytes(secret, 'big')))
+
+def make_stealth_addrs(count, prefix_length=0, seed=b'bench'):
+    """Return count deterministic (scan_secret, StealthAddress)"""
+    r = []
+    for i in range(count):
+        scan_secret, scan_pubkey = make_secret(seed + b'scan%d' % i)
+        prefix = bitcoin.core.Hash(seed + b'prefix%d' % i)[0:(prefix_length + 7) // 8]
+        addr = stealthaddress.StealthAddress.from_pubkeys(bitcoin.core.key.CPubKey(scan_pubkey),
+                                                           prefix_length=prefix_length, prefix=prefix)
+        r.append((scan_secret, addr))
+    return r
+
+def make_recover_corpus(scan_key_count, payment_count=20, seed=b'bench'):
+    """Return (stealth_scan_secrets, block) for the recover benchmark
+
+    The block pays payment_count of the addresses, spread evenly, plus as many
+    transactions with no notification at all.
+    """
+    addrs = make_stealth_addrs(scan_key_count, RECOVER_PREFIX_LENGTH, seed)
+    secrets = [stealthaddress.StealthScanSecret.from_secret_bytes(scan_secret, addr)
+               for scan_secret, addr in addrs]
+
+    vtx = []
+    for i in range(payment_count):
+        addr = addrs[i * scan_key_count // payment_count][1]
+        ephem_key = make_secret(seed + b'ephem%d' % i)
+        vtx.append(stealthaddress.pay([(addr, 1)], ephem_keys=[ephem_key]))
+        vtx.append(bitcoin.core.CTransaction(vout=[bitcoin.core.CTxOut(i, b'\x51')]))
+
+    block = bitcoin.core.CBlock(hashPrevBlock=b'\x00'*32, hashMerkleRoot=b'\x00'*32,
+                                nTime=0, nBits=0, nNonce=0, vtx=vtx)
+    return secrets, block
+
+def timeit(f, ops, repeat=DEFAULT_REPEAT):
+    """Call f() repeat times; return the best time per call
+
+    f() must do ops operations per call.
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return {'ops': ops,
+            'seconds': best,
+            'ops_per_sec': ops / best if best else float('inf')}
+
+
+def bench_parse(count=1000):
+    addr_strs = [str(addr) for scan_secret, addr in make_stealth_addrs(count)]
+    return lambda: [stealthaddress.StealthAddress(s) for s in addr_strs], count
+
+def bench_from_pubkeys(count=1000):
+    scan_pubkeys = [bitcoin.core.key.CPubKey(make_secret(b'bench%d' % i)[1]) for i in range(count)]
+    return lambda: [stealthaddress.StealthAddress.from_pubkeys(p) for p in scan_pubkeys], count
+
+def bench_derive_pubkey(count=1000):
+    spend_pubkey = bitcoin.core.key.CPubKey(make_secret(b'bench-spend')[1])
+    shared_secrets = [bitcoin.core.Hash(b'bench-shared%d' % i) for i in range(count)]
+    return lambda: [stealthaddress.StealthAddress.derive_pubkey(spend_pubkey, s)
+                    for s in shared_secrets], count
+
+def bench_make_payee_scriptPubKey(count=1000):
+    addr = make_stealth_addrs(1)[0][1]
+    shared_secrets = [bitcoin.core.Hash(b'bench-shared%d' % i) for i in range(count)]
+    def f():
+        # Start from an empty memo, otherwise only the first repeat does any work
+        stealthaddress.StealthAddress.payee_scriptPubKey_cache.clear()
+        return [addr.make_payee_scriptPubKey(s) for s in shared_secrets]
+    return f, count
+
+def bench_make_payee_scriptPubKeys(count=1000):
+    addr = make_stealth_addrs(1)[0][1]
+    shared_secrets = [bitcoin.core.Hash(b'bench-shared%d' % i) for i in range(count)]
+    # Bypass the memo, otherwise only the first repeat does any work
+    return lambda: stealthaddress.StealthAddress.make_payee_scriptPubKeys(
+                        ((addr, s) for s in shared_secrets), cache=False), count
+
+def bench_pay(count=100):
+    addrs = [addr for scan_secret, addr in make_stealth_addrs(count)]
+    return lambda: stealthaddress.pay([(addr, 1) for addr in addrs]), count
+
+def bench_recover(scan_key_count):
+    secrets, block = make_recover_corpus(scan_key_count)
+    def f():
+        # Block scans see fresh shared secrets; don't time memo hits
+        stealthaddress.StealthAddress.payee_scriptPubKey_cache.clear()
+        payments = list(stealthaddress.recover(block, secrets))
+        assert len(payments) == len(block.vtx) // 2
+    return f, len(block.vtx)
+
+BENCHMARKS = (('parse', bench_parse),
+              ('from_pubkeys', bench_from_pubkeys),
+              ('derive_pubkey', bench_derive_pubkey),
+              ('make_payee_scriptPubKey', bench_make_payee_scriptPubKey),
+              ('make_payee_scriptPubKeys', bench_make_payee_scriptPubKeys),
+              ('pay', bench_pay))
+
+def run(scan_key_counts=DEFAULT_SCAN_KEY_COUNTS, repeat=DEFAULT_REPEAT, names=None):
+    """Run the benchmarks, returning the results as a JSON-able dict
+
+    names - Only run benchmarks whose name starts with one of these
+    """
+    def selected(name):
+        return names is None or any(name.startswith(n) for n in names)
+
+    benchmarks = [(name, f) for name, f in BENCHMARKS]
+    benchmarks += [('recover_%d' % n, (lambda n=n: bench_recover(n))) for n in scan_key_counts]
+
+    results = {}
+    for name, setup in benchmarks:
+        if selected(name):
+            f, ops = setup()
+            results[name] = timeit(f, ops, repeat)
+
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'benchmarks': results}
+
+def compare(results, baseline, threshold):
+    """Return the benchmarks more than threshold slower than in baseline
+
+    A list of (name, ops_per_sec, baseline_ops_per_sec). Benchmarks missing
+    from either side are ignored.
+    """
+    regressions = []
+    for name, r in sorted(results['benchmarks'].items()):
+        b = baseline['benchmarks'].get(name)
+        if b is not None and r['ops_per_sec'] < b['ops_per_sec'] * (1 - threshold):
+            regressions.append((name, r['ops_per_sec'], b['ops_per_sec']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the stealth address hot paths')
+    parser.add_argument('--output', '-o', help='Write JSON results to this file instead of stdout')
+    parser.add_argument('--scan-keys', default=','.join(str(n) for n in DEFAULT_SCAN_KEY_COUNTS),
+                        help='Comma-separated numbers of scan keys to benchmark recover with')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--only', action='append', help='Only run benchmarks starting with this name')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Fractional slowdown relative to the baseline that counts as a regression')
+    args = parser.parse_args(argv)
+
+    results = run([int(n) for n in args.scan_keys.split(',') if n], args.repeat, args.only)
+
+    out = json.dumps(results, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(out + '\n')
+    else:
+        print(out)
+
+    if args.baseline:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)
+        regressions = compare(results, baseline, args.threshold)
+        for name, ops_per_sec, baseline_ops_per_sec in regressions:
+            print('%s regressed: %.1f ops/s, baseline %.1f ops/s' %
+                  (name, ops_per_sec, baseline_ops_per_sec), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
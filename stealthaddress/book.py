@@ -0,0 +1,206 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Compact storage for large numbers of stealth addresses
+
+A StealthAddress instance carries a list of CPubKey's, a set, and an OpenSSL
+EC_KEY per pubkey; several KB per address. StealthAddressBook instead stores
+addresses in two contiguous buffers:
+
+    records - One fixed-width record per address: options, scan pubkey, n, m,
+              prefix length, the first four bytes of the prefix, and the
+              offset of the rest of the address in the heap.
+    heap    - The spend pubkeys, the full prefix, and any trailing data of
+              every address, back to back.
+
+StealthAddress instances are only created on demand. Lookups by scan pubkey
+and by prefix go through hash tables chained through compact arrays.
+
+Books can be saved to a file and loaded back with mmap, in which case the
+buffers are not read into memory at all.
+"""
+
+import array
+import mmap
+import struct
+
+import stealthaddress
+import stealthaddress.prefix
+
+MAGIC = b'STEALTHBOOK\x00'
+VERSION = 1
+
+_HEADER = struct.Struct('<12sIQQ')
+_RECORD = struct.Struct('<B33sBBB4sQH')
+
+class StealthAddressBookError(Exception):
+    pass
+
+class StealthAddressBook(object):
+    """Array-backed collection of stealth addresses
+
+    Addresses are referred to by index, in the order they were added.
+    """
+
+    def __init__(self, stealth_addrs=()):
+        self._records = bytearray()
+        self._heap = bytearray()
+        self._mmap = None
+        self._count = 0
+        self._reset_indexes()
+
+        for stealth_addr in stealth_addrs:
+            self.add(stealth_addr)
+
+    def _reset_indexes(self):
+        # first 8 bytes of scan pubkey x coordinate -> first index
+        self._by_scan_pubkey = {}
+        # prefix length -> {prefix: first index}
+        self._by_prefix = {}
+        # Next index with the same key, or -1
+        self._scan_pubkey_next = array.array('q')
+        self._prefix_next = array.array('q')
+
+    @staticmethod
+    def _scan_pubkey_key(scan_pubkey):
+        return int.from_bytes(scan_pubkey[1:9], 'big')
+
+    @staticmethod
+    def _prefix_key(prefix_length, prefix4):
+        prefix_length = min(prefix_length, stealthaddress.prefix.MAX_PREFIX_LENGTH)
+        return (prefix_length,
+                int.from_bytes(prefix4, 'big') >> (stealthaddress.prefix.MAX_PREFIX_LENGTH - prefix_length))
+
+    def _index(self, i):
+        options, scan_pubkey, n, m, prefix_length, prefix4, heap_offset, tail_len = \
+                _RECORD.unpack_from(self._records, i * _RECORD.size)
+
+        key = self._scan_pubkey_key(scan_pubkey)
+        self._scan_pubkey_next.append(self._by_scan_pubkey.get(key, -1))
+        self._by_scan_pubkey[key] = i
+
+        prefix_length, prefix = self._prefix_key(prefix_length, prefix4)
+        bucket = self._by_prefix.setdefault(prefix_length, {})
+        self._prefix_next.append(bucket.get(prefix, -1))
+        bucket[prefix] = i
+
+    def add(self, stealth_addr):
+        """Add a StealthAddress, returning its index"""
+        if self._mmap is not None:
+            # Loaded from a file; switch to private, growable buffers. The
+            # mapping itself goes away once nothing references it.
+            self._records = bytearray(self._records)
+            self._heap = bytearray(self._heap)
+            self._mmap = None
+
+        n = stealth_addr[34]
+        i = 35 + n*33
+        m, prefix_length = stealth_addr[i], stealth_addr[i+1]
+        tail_start = i + 2 + stealth_addr.prefix_length_in_bytes
+        tail_len = len(stealth_addr) - tail_start
+
+        self._records += _RECORD.pack(stealth_addr[0], stealth_addr[1:34], n, m, prefix_length,
+                                      stealth_addr.prefix[0:4].ljust(4, b'\x00'),
+                                      len(self._heap), tail_len)
+        self._heap += stealth_addr[35:i]
+        self._heap += stealth_addr[i+2:]
+
+        self._index(self._count)
+        self._count += 1
+        return self._count - 1
+
+    def __len__(self):
+        return self._count
+
+    def raw(self, i):
+        """Return the address data of address i as bytes"""
+        if not (0 <= i < self._count):
+            raise IndexError('address index out of range')
+        options, scan_pubkey, n, m, prefix_length, prefix4, heap_offset, tail_len = \
+                _RECORD.unpack_from(self._records, i * _RECORD.size)
+        prefix_len_bytes = prefix_length // 8 + (1 if prefix_length % 8 else 0)
+        spend_end = heap_offset + n*33
+        return (bytes([options]) + scan_pubkey + bytes([n])
+                + bytes(self._heap[heap_offset:spend_end])
+                + bytes([m, prefix_length])
+                + bytes(self._heap[spend_end:spend_end + prefix_len_bytes + tail_len]))
+
+    def __getitem__(self, i):
+        """Return address i as a StealthAddress
+
+        The pubkeys are validated lazily; see StealthAddress.validate()
+        """
+        if i < 0:
+            i += self._count
+        stealth_addr = stealthaddress.StealthAddress.from_bytes(self.raw(i),
+                                                                stealthaddress.StealthAddress.BASE58_PREFIX)
+        stealth_addr.__init__(None, validate=False)
+        return stealth_addr
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def scan_pubkey(self, i):
+        """Return the scan pubkey of address i as bytes"""
+        return _RECORD.unpack_from(self._records, i * _RECORD.size)[1]
+
+    def find_by_scan_pubkey(self, scan_pubkey):
+        """Return the indexes of all addresses with a scan pubkey"""
+        r = []
+        i = self._by_scan_pubkey.get(self._scan_pubkey_key(scan_pubkey), -1)
+        while i != -1:
+            if self.scan_pubkey(i) == scan_pubkey:
+                r.append(i)
+            i = self._scan_pubkey_next[i]
+        r.reverse()
+        return r
+
+    def find_by_prefix(self, prefix):
+        """Return the indexes of all addresses matching a notification prefix
+
+        See stealthaddress.prefix.PrefixIndex.candidates()
+        """
+        r = []
+        for prefix_length, bucket in self._by_prefix.items():
+            i = bucket.get(prefix >> (stealthaddress.prefix.MAX_PREFIX_LENGTH - prefix_length), -1)
+            while i != -1:
+                r.append(i)
+                i = self._prefix_next[i]
+        r.sort()
+        return r
+
+    def save(self, path):
+        """Save to a file that load() can memory-map"""
+        with open(path, 'wb') as fd:
+            fd.write(_HEADER.pack(MAGIC, VERSION, self._count, len(self._heap)))
+            fd.write(self._records)
+            fd.write(self._heap)
+
+    @classmethod
+    def load(cls, path):
+        """Load a book saved with save()
+
+        The file is memory-mapped read-only; only the lookup indexes are built
+        in memory.
+        """
+        self = cls()
+        with open(path, 'rb') as fd:
+            self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count, heap_size = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise StealthAddressBookError('Not a stealth address book')
+        if version != VERSION:
+            raise StealthAddressBookError('Unsupported stealth address book version %d' % version)
+        records_end = _HEADER.size + count * _RECORD.size
+        if len(self._mmap) != records_end + heap_size:
+            raise StealthAddressBookError('Stealth address book truncated')
+
+        view = memoryview(self._mmap)
+        self._records = view[_HEADER.size:records_end]
+        self._heap = view[records_end:]
+        self._count = count
+        for i in range(count):
+            self._index(i)
+        return self
@@ -0,0 +1,107 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Cache of parsed stealth addresses
+
+Parsing a stealth address decodes base58, checks the checksum, and validates
+every pubkey through OpenSSL. StealthAddressCache keeps the parsed instances
+of recently used address strings so hot addresses are only parsed once.
+
+Cached instances are shared between callers; don't modify them.
+"""
+
+import collections
+import threading
+
+import stealthaddress
+
+DEFAULT_MAXSIZE = 4096
+
+class StealthAddressCache(object):
+    """Bounded, thread-safe cache of StealthAddress instances by address string
+
+    maxsize  - Maximum number of addresses cached
+    eviction - 'lru' to evict the least recently used address, or 'fifo' to
+               evict the least recently added one; the latter avoids
+               reordering on every hit.
+    cls      - Class used to parse addresses
+
+    Attributes:
+
+    hits      - Number of lookups answered from the cache
+    misses    - Number of lookups that had to parse the address
+    evictions - Number of addresses evicted to stay within maxsize
+    """
+
+    EVICTION_POLICIES = ('lru', 'fifo')
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, eviction='lru', cls=stealthaddress.StealthAddress):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1; got %r' % maxsize)
+        if eviction not in self.EVICTION_POLICIES:
+            raise ValueError('Unknown eviction policy %r' % eviction)
+
+        self.maxsize = maxsize
+        self.eviction = eviction
+        self.cls = cls
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._addrs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, s):
+        """Return the parsed StealthAddress for address string s
+
+        Raises the same exceptions as parsing would; invalid addresses are
+        never cached.
+        """
+        with self._lock:
+            try:
+                addr = self._addrs[s]
+            except KeyError:
+                pass
+            else:
+                self.hits += 1
+                if self.eviction == 'lru':
+                    self._addrs.move_to_end(s)
+                return addr
+            self.misses += 1
+
+        # Parse outside the lock so a slow parse doesn't block other lookups.
+        # Two threads may both parse the same address; the second result
+        # wins, which is harmless.
+        addr = self.cls(s)
+
+        with self._lock:
+            self._addrs[s] = addr
+            while len(self._addrs) > self.maxsize:
+                self._addrs.popitem(last=False)
+                self.evictions += 1
+        return addr
+
+    __call__ = get
+
+    def __contains__(self, s):
+        with self._lock:
+            return s in self._addrs
+
+    def __len__(self):
+        with self._lock:
+            return len(self._addrs)
+
+    def clear(self):
+        """Empty the cache; counters are left alone"""
+        with self._lock:
+            self._addrs.clear()
+
+    def stats(self):
+        """Return a dict of the cache counters"""
+        with self._lock:
+            return {'size': len(self._addrs),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
@@ -0,0 +1,245 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Resumable stealth scans
+
+A ScanSession keeps track of how far every scan key has been scanned, and the
+payments found so far, in a checkpoint file. A crashed scan resumes from the
+last checkpoint rather than from genesis, and scan keys added to an existing
+session are backfilled on their own without rescanning the others.
+
+The checkpoint file contains scan secrets and is created readable by the owner
+only.
+"""
+
+import json
+import os
+
+import bitcoin.core
+import bitcoin.core.key
+import bitcoin.core.script
+from bitcoin.core import b2lx, b2x, x
+
+import stealthaddress
+
+DEFAULT_CHECKPOINT_INTERVAL = 1000
+
+class ScanSessionError(Exception):
+    pass
+
+def _payment_to_json(height, block_hash, payment):
+    return {'height': height,
+            'block_hash': b2x(block_hash),
+            'txid': b2x(payment.outpoint.hash),
+            'n': payment.outpoint.n,
+            'nValue': payment.nValue,
+            'scriptPubKey': b2x(payment.scriptPubKey),
+            'redeemScript': None if payment.redeemScript is None else b2x(payment.redeemScript),
+            'ephem_pubkey': b2x(payment.ephem_pubkey),
+            'shared_secret': b2x(payment.shared_secret),
+            'stealth_scan_secret': str(payment.stealth_scan_secret)}
+
+def _payment_from_json(d, stealth_scan_secrets):
+    payment = stealthaddress.StealthPayment(
+                bitcoin.core.COutPoint(x(d['txid']), d['n']), d['nValue'],
+                bitcoin.core.script.CScript(x(d['scriptPubKey'])),
+                None if d['redeemScript'] is None else bitcoin.core.script.CScript(x(d['redeemScript'])),
+                bitcoin.core.key.CPubKey(x(d['ephem_pubkey'])),
+                x(d['shared_secret']),
+                stealth_scan_secrets[d['stealth_scan_secret']])
+    return (d['height'], x(d['block_hash']), payment)
+
+def _write_atomic(path, data):
+    """Atomically replace the file at path with data
+
+    The data is fsync'd before the rename, and the directory after, so a crash
+    leaves either the old or the new file, never a partial one.
+    """
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class ScanSession(object):
+    """A checkpointed, resumable stealth scan
+
+    Attributes:
+
+    height   - Height of the last block scanned for at least one scan key, or
+               -1 if nothing has been scanned
+    block_hash - Hash of that block
+    cursors  - Dict of StealthScanSecret -> height of the last block scanned
+               for it
+    payments - List of (height, block_hash, StealthPayment) found so far
+
+    Feed blocks in order to scan() starting from next_height. Newly added scan
+    keys are scanned from genesis until they catch up with the rest, and only
+    they are scanned for blocks the others have already seen.
+    """
+
+    def __init__(self, path, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+
+        self.height = -1
+        self.block_hash = None
+        self.cursors = {}
+        self.payments = []
+
+        # frozenset of StealthScanSecret's -> StealthScanner; only the most
+        # recently used set is kept, as it changes only during backfills.
+        self._scanners = {}
+
+        # (height, block_hash) of the last block scanned by this instance, to
+        # check that blocks fed during a backfill connect too.
+        self._last_block = None
+
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'r') as fd:
+            state = json.load(fd)
+
+        self.height = state['height']
+        self.block_hash = None if state['block_hash'] is None else x(state['block_hash'])
+
+        stealth_scan_secrets = {}
+        for secret_str, cursor in state['cursors'].items():
+            stealth_scan_secret = stealthaddress.StealthScanSecret(secret_str)
+            stealth_scan_secrets[secret_str] = stealth_scan_secret
+            self.cursors[stealth_scan_secret] = cursor
+
+        self.payments = [_payment_from_json(d, stealth_scan_secrets) for d in state['payments']]
+
+    def checkpoint(self):
+        """Write the session state to disk"""
+        state = {'height': self.height,
+                 'block_hash': None if self.block_hash is None else b2x(self.block_hash),
+                 'cursors': {str(secret): cursor for secret, cursor in self.cursors.items()},
+                 'payments': [_payment_to_json(*p) for p in self.payments]}
+        _write_atomic(self.path, json.dumps(state).encode('utf8'))
+
+    def add(self, stealth_scan_secret):
+        """Add a scan key to the session
+
+        Does nothing if the session already covers it.
+        """
+        self.cursors.setdefault(stealth_scan_secret, -1)
+
+    @property
+    def next_height(self):
+        """Height of the next block that needs to be scanned"""
+        if not self.cursors:
+            return self.height + 1
+        return min(self.cursors.values()) + 1
+
+    def _scanner(self, stealth_scan_secrets):
+        key = frozenset(stealth_scan_secrets)
+        try:
+            return self._scanners[key]
+        except KeyError:
+            scanner = stealthaddress.StealthScanner(stealth_scan_secrets)
+            self._scanners = {key: scanner}
+            return scanner
+
+    def scan_block(self, height, block):
+        """Scan a single block
+
+        Only the scan keys that haven't seen the block yet are used. Returns a
+        list of StealthPayment's found.
+
+        Raises ScanSessionError if the block doesn't connect to the previous
+        block scanned, for instance after a reorg or when fed the wrong chain.
+        """
+        pending = []
+        for stealth_scan_secret, cursor in self.cursors.items():
+            if cursor < height - 1:
+                raise ScanSessionError('Block at height %d skips blocks for scan key %s, last scanned at height %d' %
+                                       (height, stealth_scan_secret.stealth_addr, cursor))
+            elif cursor == height - 1:
+                pending.append(stealth_scan_secret)
+
+        block_hash = bitcoin.core.Hash(block.get_header().serialize())
+        if height == self.height + 1 and self.block_hash is not None:
+            prev_hash = self.block_hash
+        elif self._last_block is not None and height == self._last_block[0] + 1:
+            prev_hash = self._last_block[1]
+        else:
+            prev_hash = None
+        if prev_hash is not None and block.hashPrevBlock != prev_hash:
+            raise ScanSessionError('Block %s at height %d does not connect to block %s' %
+                                   (b2lx(block_hash), height, b2lx(prev_hash)))
+        if height == self.height and block_hash != self.block_hash:
+            raise ScanSessionError('Block %s at height %d is not the block %s already scanned there' %
+                                   (b2lx(block_hash), height, b2lx(self.block_hash)))
+
+        r = []
+        if pending:
+            r = list(self._scanner(pending).scan(block))
+            for payment in r:
+                self.payments.append((height, block_hash, payment))
+            for stealth_scan_secret in pending:
+                self.cursors[stealth_scan_secret] = height
+
+        if height > self.height:
+            self.height = height
+            self.block_hash = block_hash
+        self._last_block = (height, block_hash)
+
+        return r
+
+    def rewind(self, height, block_hash):
+        """Forget every block above height, as after a reorg
+
+        block_hash - Hash of the block at height, which the next block
+                     scanned has to connect to
+
+        Payments found above height are dropped and scan keys that got
+        further resume at height + 1. The change is written by the next
+        checkpoint.
+        """
+        if height > self.height:
+            raise ScanSessionError('Can not rewind to height %d; last scanned height is %d' %
+                                   (height, self.height))
+        self.payments = [p for p in self.payments if p[0] <= height]
+        for stealth_scan_secret, cursor in self.cursors.items():
+            self.cursors[stealth_scan_secret] = min(cursor, height)
+        self.height = height
+        self.block_hash = block_hash
+        self._last_block = None
+
+    def scan(self, blocks):
+        """Scan blocks, checkpointing every checkpoint_interval blocks
+
+        blocks - Iterable of (height, CBlock), such as returned by
+                 stealthaddress.rescan.iter_blocks()
+
+        Yields StealthPayment's as they are found. A final checkpoint is
+        written once blocks is exhausted.
+        """
+        n = 0
+        for height, block in blocks:
+            for payment in self.scan_block(height, block):
+                yield payment
+
+            n += 1
+            if n % self.checkpoint_interval == 0:
+                self.checkpoint()
+
+        self.checkpoint()
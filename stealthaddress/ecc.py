@@ -0,0 +1,264 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""secp256k1 arithmetic for stealth key derivation
+
+Points are (x, y) tuples of integers in affine coordinates, with None being
+the point at infinity. Internally additions are done in Jacobian coordinates,
+(X, Y, Z), to avoid a modular inversion per addition.
+
+Multiplication of the generator uses a precomputed fixed-base table: the
+scalar is split into 8-bit windows and the table holds every multiple of
+256**i * G for every window i. A multiplication is then at most 32 point
+additions and no doublings. The table is built on first use.
+
+None of this is constant time; don't use it where timing side-channels
+matter.
+"""
+
+import threading
+
+P = 2**256 - 2**32 - 977
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+class ECCError(ValueError):
+    pass
+
+def decompress(pubkey):
+    """Decode a compressed pubkey to a point
+
+    Raises ECCError if the pubkey is not a valid compressed pubkey.
+    """
+    if len(pubkey) != 33 or pubkey[0] not in (2, 3):
+        raise ECCError('Not a compressed pubkey')
+    x = int.from_bytes(pubkey[1:33], 'big')
+    if x >= P:
+        raise ECCError('Pubkey x coordinate out of range')
+    y2 = (x*x*x + 7) % P
+    y = pow(y2, (P + 1) // 4, P)
+    if y*y % P != y2:
+        raise ECCError('Pubkey not on curve')
+    if y & 1 != pubkey[0] & 1:
+        y = P - y
+    return (x, y)
+
+def compress(point):
+    """Encode a point as a compressed pubkey"""
+    if point is None:
+        raise ECCError('Can not encode the point at infinity')
+    x, y = point
+    return bytes([2 | (y & 1)]) + x.to_bytes(32, 'big')
+
+
+def _jacobian_double(p):
+    X, Y, Z = p
+    if not Y:
+        return (0, 0, 0)
+    YY = Y*Y % P
+    S = 4*X*YY % P
+    M = 3*X*X % P
+    X3 = (M*M - 2*S) % P
+    Y3 = (M*(S - X3) - 8*YY*YY) % P
+    Z3 = 2*Y*Z % P
+    return (X3, Y3, Z3)
+
+def _jacobian_add_affine(p, q):
+    """Add affine point q to Jacobian point p"""
+    X1, Y1, Z1 = p
+    if not Z1:
+        return (q[0], q[1], 1)
+    x2, y2 = q
+    Z1Z1 = Z1*Z1 % P
+    H = (x2*Z1Z1 - X1) % P
+    r = (y2*Z1*Z1Z1 - Y1) % P
+    if not H:
+        if not r:
+            return _jacobian_double(p)
+        return (0, 0, 0)
+    HH = H*H % P
+    HHH = H*HH % P
+    V = X1*HH % P
+    X3 = (r*r - HHH - 2*V) % P
+    Y3 = (r*(V - X3) - Y1*HHH) % P
+    Z3 = Z1*H % P
+    return (X3, Y3, Z3)
+
+def _to_affine(p):
+    X, Y, Z = p
+    if not Z:
+        return None
+    zinv = pow(Z, -1, P)
+    zinv2 = zinv*zinv % P
+    return (X*zinv2 % P, Y*zinv2*zinv % P)
+
+def _to_affine_batch(ps):
+    """Convert Jacobian points to affine with a single modular inversion
+
+    Uses Montgomery's trick: invert the product of all the Z's, then recover
+    the individual inverses by multiplying back out.
+    """
+    zs = [p[2] for p in ps if p[2]]
+    products = []
+    acc = 1
+    for z in zs:
+        products.append(acc)
+        acc = acc*z % P
+    acc = pow(acc, -1, P) if zs else 1
+
+    zinvs = [None] * len(zs)
+    for i in range(len(zs) - 1, -1, -1):
+        zinvs[i] = acc*products[i] % P
+        acc = acc*zs[i] % P
+
+    r = []
+    zinvs = iter(zinvs)
+    for X, Y, Z in ps:
+        if not Z:
+            r.append(None)
+            continue
+        zinv = next(zinvs)
+        zinv2 = zinv*zinv % P
+        r.append((X*zinv2 % P, Y*zinv2*zinv % P))
+    return r
+
+
+WINDOW_BITS = 8
+
+_G_table = None
+_G_table_lock = threading.Lock()
+
+def _build_G_table():
+    """Build the fixed-base table for G
+
+    _G_table[i][j] is j * 2**(WINDOW_BITS*i) * G, with index 0 of every row
+    unused.
+    """
+    rows = []
+    base = G
+    for i in range(256 // WINDOW_BITS):
+        row = [(base[0], base[1], 1)]
+        for j in range(2, 1 << WINDOW_BITS):
+            row.append(_jacobian_add_affine(row[-1], base))
+        # 2**WINDOW_BITS * base is the base of the next row
+        next_base = _jacobian_add_affine(row[-1], base)
+        affine = _to_affine_batch(row + [next_base])
+        rows.append([None] + affine[:-1])
+        base = affine[-1]
+    return rows
+
+def _get_G_table():
+    global _G_table
+    if _G_table is None:
+        with _G_table_lock:
+            if _G_table is None:
+                _G_table = _build_G_table()
+    return _G_table
+
+def _jacobian_mul_G(k):
+    table = _get_G_table()
+    mask = (1 << WINDOW_BITS) - 1
+    r = (0, 0, 0)
+    i = 0
+    while k:
+        j = k & mask
+        if j:
+            r = _jacobian_add_affine(r, table[i][j])
+        k >>= WINDOW_BITS
+        i += 1
+    return r
+
+def mul_G(k):
+    """Return k*G"""
+    return _to_affine(_jacobian_mul_G(k % N))
+
+def add_mul_G(point, k):
+    """Return point + k*G
+
+    One table-driven multiplication, one addition, and one inversion.
+    """
+    return _to_affine(_jacobian_add_affine(_jacobian_mul_G(k % N), point))
+
+def add_mul_G_batch(pairs):
+    """Return [point + k*G for point, k in pairs]
+
+    All results share a single modular inversion.
+    """
+    return _to_affine_batch([_jacobian_add_affine(_jacobian_mul_G(k % N), point)
+                             for point, k in pairs])
+
+def mul_G_batch(ks):
+    """Return [k*G for k in ks], sharing a single modular inversion"""
+    return _to_affine_batch([_jacobian_mul_G(k % N) for k in ks])
+
+
+WNAF_BITS = 5
+
+def wnaf(k, w=WNAF_BITS):
+    """Return the width-w non-adjacent form of k
+
+    A list of digits, least significant first, each either zero or odd and
+    in the range -2**(w-1) < d < 2**(w-1); at most one in any w consecutive
+    digits is non-zero.
+    """
+    digits = []
+    while k:
+        if k & 1:
+            d = k & ((1 << w) - 1)
+            if d >= 1 << (w - 1):
+                d -= 1 << w
+            k -= d
+        else:
+            d = 0
+        digits.append(d)
+        k >>= 1
+    return digits
+
+def _odd_multiples(point, w):
+    """Return [point, 3*point, ..., (2**(w-1) - 1)*point] in affine coordinates"""
+    double = _to_affine(_jacobian_double((point[0], point[1], 1)))
+    ps = [(point[0], point[1], 1)]
+    for i in range(1, 1 << (w - 2)):
+        ps.append(_jacobian_add_affine(ps[-1], double))
+    return _to_affine_batch(ps)
+
+def _jacobian_mul_wnaf(odd_multiples, digits):
+    r = (0, 0, 0)
+    for d in reversed(digits):
+        r = _jacobian_double(r)
+        if d > 0:
+            r = _jacobian_add_affine(r, odd_multiples[d >> 1])
+        elif d < 0:
+            x, y = odd_multiples[(-d) >> 1]
+            r = _jacobian_add_affine(r, (x, P - y))
+    return r
+
+def mul(point, k):
+    """Return k*point
+
+    Uses a width-WNAF_BITS NAF of k; about 256 doublings and 43 additions.
+    """
+    k %= N
+    if point is None or not k:
+        return None
+    return _to_affine(_jacobian_mul_wnaf(_odd_multiples(point, WNAF_BITS), wnaf(k)))
+
+def ecdh(point, k):
+    """Return the 32-byte ECDH shared secret of k and point
+
+    That's the x coordinate of k*point, the same as OpenSSL's
+    ECDH_compute_key() and CECKey.get_raw_ecdh_key()
+    """
+    r = mul(point, k)
+    if r is None:
+        raise ECCError('ECDH result is the point at infinity')
+    return r[0].to_bytes(32, 'big')
+
+def add(p, q):
+    """Return p + q"""
+    if p is None:
+        return q
+    if q is None:
+        return p
+    return _to_affine(_jacobian_add_affine((p[0], p[1], 1), q))
@@ -0,0 +1,108 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Process pool for the ECDH step of stealth scanning
+
+ECDH is by far the most expensive part of scanning. ECDHExecutor spreads it
+over a pool of worker processes:
+
+    with ECDHExecutor() as executor:
+        scanner = StealthScanner(secrets, ecdh_executor=executor)
+        for payment in scanner.scan(block):
+            ...
+
+Work is sent as plain (scan_secret, ephem_pubkey) byte strings; CECKey and
+CPubKey wrap ctypes pointers and can't be pickled. Workers keep an EC_KEY per
+scan secret they've seen, so the scan secrets themselves are only decoded
+once per worker.
+
+Every batch is split into chunks that workers pull from a shared queue as
+they become idle; a worker that got cheap chunks simply takes more of them.
+The chunk size is picked per batch so even a small block produces a few
+chunks per worker, while a large one isn't split into needlessly many.
+"""
+
+import multiprocessing
+
+import bitcoin.core.key
+
+# Chunks per worker per batch
+CHUNKS_PER_WORKER = 4
+MIN_CHUNK_SIZE = 8
+MAX_CHUNK_SIZE = 1024
+
+# Maximum number of scan secret EC_KEYs kept per worker
+MAX_WORKER_KEYS = 4096
+
+_worker_keys = {}
+
+def _ecdh_chunk(items):
+    """Compute the shared secrets of a list of (scan_secret, ephem_pubkey)
+
+    Items are grouped by scan secret so each secret's EC_KEY does all of its
+    pubkeys in one get_raw_ecdh_keys() call. Results are in item order.
+    """
+    groups = {}
+    for i, (scan_secret, ephem_pubkey) in enumerate(items):
+        groups.setdefault(scan_secret, []).append(i)
+
+    r = [None] * len(items)
+    for scan_secret, idxs in groups.items():
+        key = _worker_keys.get(scan_secret)
+        if key is None:
+            if len(_worker_keys) >= MAX_WORKER_KEYS:
+                _worker_keys.clear()
+            key = bitcoin.core.key.CECKey()
+            key.set_secretbytes(scan_secret)
+            _worker_keys[scan_secret] = key
+        for i, shared_secret in zip(idxs, key.get_raw_ecdh_keys(items[i][1] for i in idxs)):
+            r[i] = shared_secret
+    return r
+
+class ECDHExecutor(object):
+    """Pool of worker processes computing ECDH shared secrets
+
+    processes - Number of worker processes; defaults to the number of CPUs.
+                If 1 everything is done in this process.
+    """
+
+    def __init__(self, processes=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self._pool = multiprocessing.Pool(processes) if processes > 1 else None
+
+    def chunk_size(self, count):
+        """Return the chunk size a batch of count items is split into"""
+        size = -(-count // (self.processes * CHUNKS_PER_WORKER))
+        return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, size))
+
+    def map(self, items):
+        """Compute the shared secrets of (scan_secret, ephem_pubkey) byte strings
+
+        Returns a list of 32-byte shared secrets in the same order as items,
+        with None in place of any invalid ephemeral pubkey.
+        """
+        items = [(bytes(scan_secret), bytes(ephem_pubkey)) for scan_secret, ephem_pubkey in items]
+        if self._pool is None or len(items) <= MIN_CHUNK_SIZE:
+            return _ecdh_chunk(items)
+
+        size = self.chunk_size(len(items))
+        chunks = [items[i:i+size] for i in range(0, len(items), size)]
+        r = []
+        for chunk_results in self._pool.imap(_ecdh_chunk, chunks):
+            r.extend(chunk_results)
+        return r
+
+    def close(self):
+        """Shut down the worker processes"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
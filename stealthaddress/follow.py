@@ -0,0 +1,137 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Reorg-aware scanning of the chain tip
+
+ChainFollower scans blocks as they arrive at the tip into a PaymentStore,
+optionally extending a notification index as it goes:
+
+    follower = ChainFollower(PaymentStore('payments.sqlite'), secrets)
+    for height, block in new_blocks:
+        follower.add_block(height, block)
+
+Every block goes through PaymentStore.connect_block(), which journals the
+payments it added and spent. A block that doesn't extend the tip but
+connects to an earlier journaled block is a reorg: the blocks above the fork
+point are undone from the journal, then the block is connected as usual.
+Handling a reorg costs as much as its depth, never a rescan.
+
+Blocks already connected are skipped, other than being added to the index if
+it is missing them. Reopening a notification index rolls it back to the
+start of its last block, so after a restart feed blocks from next_height,
+which accounts for the index, rather than from the store's tip.
+"""
+
+import bitcoin.core
+
+import stealthaddress
+
+class ReorgError(Exception):
+    pass
+
+class ChainFollower(object):
+    """Scan blocks at the chain tip into a PaymentStore, handling reorgs
+
+    store                - PaymentStore payments are added to
+    stealth_scan_secrets - Iterable of StealthScanSecret's to scan for
+    index                - Optional NotificationIndexWriter to add the
+                           blocks to as well
+    ecdh_executor        - Optional ECDH executor; see StealthScanner
+    metrics              - Optional Metrics registry; see StealthScanner
+
+    Attributes:
+
+    reorgs          - Number of reorgs handled
+    blocks_undone   - Number of blocks disconnected by reorgs
+    max_reorg_depth - Deepest reorg handled
+    """
+
+    def __init__(self, store, stealth_scan_secrets, index=None, ecdh_executor=None, metrics=None):
+        self.store = store
+        self.index = index
+        self.scanner = stealthaddress.StealthScanner(stealth_scan_secrets,
+                                                     ecdh_executor=ecdh_executor, metrics=metrics)
+
+        self.reorgs = 0
+        self.blocks_undone = 0
+        self.max_reorg_depth = 0
+
+    @property
+    def next_height(self):
+        """Height of the next block to feed add_block()"""
+        tip = self.store.tip()
+        if tip is None:
+            return None if self.index is None else self.index.next_height
+        if self.index is None:
+            return tip[0] + 1
+        return min(tip[0] + 1, self.index.next_height)
+
+    def _disconnect_to(self, height):
+        """Disconnect every block above height"""
+        depth = 0
+        tip = self.store.tip()
+        while tip is not None and tip[0] > height:
+            self.store.disconnect_block()
+            depth += 1
+            tip = self.store.tip()
+        if self.index is not None:
+            self.index.truncate(height + 1)
+        return depth
+
+    def add_block(self, height, block):
+        """Scan a block and connect it, undoing any blocks it replaces
+
+        The block must extend the tip or connect to a journaled block below
+        it; raises ReorgError otherwise, for instance when the fork point is
+        deeper than the store's journal. Returns the list of StealthPayment's
+        found in the block, which is empty if it was already connected.
+        """
+        block_hash = bitcoin.core.Hash(block.get_header().serialize())
+        if self.store.block_hash(height) == block_hash:
+            # Already connected; only the index may be missing it
+            if self.index is not None and height == self.index.next_height:
+                self.index.add_block(height, block)
+            return []
+
+        if self.index is not None and height > self.index.next_height:
+            raise ReorgError('Notification index is missing blocks from height %d; feed blocks from there' %
+                             self.index.next_height)
+
+        tip = self.store.tip()
+        if tip is not None and (height != tip[0] + 1 or block.hashPrevBlock != tip[1]):
+            if height > tip[0] + 1 or self.store.block_hash(height - 1) != block.hashPrevBlock:
+                raise ReorgError('Block %s at height %d connects to no known block' %
+                                 (bitcoin.core.b2lx(block_hash), height))
+            depth = self._disconnect_to(height - 1)
+            self.reorgs += 1
+            self.blocks_undone += depth
+            self.max_reorg_depth = max(self.max_reorg_depth, depth)
+
+        payments = list(self.scanner.scan(block))
+        self.store.connect_block(height, block, payments)
+        if self.index is not None and height >= self.index.next_height:
+            self.index.add_block(height, block)
+        return payments
+
+    def add_blocks(self, blocks):
+        """Add (height, CBlock) tuples; yields the StealthPayment's found"""
+        for height, block in blocks:
+            for payment in self.add_block(height, block):
+                yield payment
+
+    def rewind(self, height):
+        """Disconnect every block above height; returns the number undone"""
+        tip = self.store.tip()
+        if tip is None or height >= tip[0]:
+            return 0
+        if self.store.block_hash(height) is None:
+            raise ReorgError('Can not rewind to height %d; it is below the journal' % height)
+        return self._disconnect_to(height)
+
+    def stats(self):
+        """Return a dict of the follower counters"""
+        tip = self.store.tip()
+        return {'height': None if tip is None else tip[0],
+                'reorgs': self.reorgs,
+                'blocks_undone': self.blocks_undone,
+                'max_reorg_depth': self.max_reorg_depth}
@@ -0,0 +1,243 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Multi-process grinding of notification prefixes
+
+Paying an address with a prefix means trying nonces until the notification
+matches it, 2**prefix_length hashes on average. Grinder spreads that over a
+pool of worker processes:
+
+    with Grinder(timeout=60) as grinder:
+        tx = stealthaddress.pay(payments, grinder=grinder)
+
+The nonce space is split into ranges handed out to workers a few at a time.
+As soon as one worker finds a match every other worker is told to stop,
+through an Event shared by the pool, and the ranges not yet handed out are
+never sent. The same Event stops a grind past its deadline, or one cancelled
+from another thread with cancel().
+"""
+
+import multiprocessing
+import threading
+import time
+
+import bitcoin.core
+import bitcoin.core.script as script
+
+import stealthaddress
+
+# Nonces per range handed out to a worker
+RANGE_SIZE = 1 << 16
+
+# Nonces tried between checks of the stop event and deadline
+CHECK_INTERVAL = 1024
+
+# Ranges in flight per worker
+RANGES_PER_WORKER = 2
+
+class GrindError(Exception):
+    pass
+
+_stop = None
+
+def _init_worker(stop):
+    global _stop
+    _stop = stop
+
+def _grind_range(args, stop_event=None):
+    """Try nonces start to stop exclusive
+
+    stop_event - Event to give up on when set; defaults to the one the pool
+                 worker was initialized with
+
+    Returns (nonce, attempts), nonce being None if no nonce matched before
+    the range ran out, the stop event was set, or the deadline passed.
+    """
+    ephem_pubkey, mask, target, start, stop, deadline = args
+    if stop_event is None:
+        stop_event = _stop
+    head = stealthaddress._NOTIFICATION_HEAD
+    Hash = bitcoin.core.Hash
+    nonce = start
+    while nonce < stop:
+        if stop_event.is_set() or (deadline is not None and time.time() > deadline):
+            break
+        for nonce in range(nonce, min(nonce + CHECK_INTERVAL, stop)):
+            if int.from_bytes(Hash(head + nonce.to_bytes(4, 'big') + ephem_pubkey)[0:4], 'big') & mask == target:
+                return (nonce, nonce - start + 1)
+        nonce += 1
+    return (None, nonce - start)
+
+class Grinder(object):
+    """Pool of worker processes grinding notification prefixes
+
+    processes - Number of worker processes; defaults to the number of CPUs.
+                If 1 everything is done in this process.
+    timeout   - Default number of seconds a grind may take, or None for no
+                limit
+
+    Attributes:
+
+    grinds   - Number of grinds done
+    attempts - Total number of nonces tried
+    seconds  - Total time spent grinding
+    last_attempts_per_sec - Hash rate of the last grind
+    """
+
+    def __init__(self, processes=None, timeout=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.timeout = timeout
+
+        self.grinds = 0
+        self.attempts = 0
+        self.seconds = 0.0
+        self.last_attempts_per_sec = 0.0
+
+        self._lock = threading.Lock()
+        if processes > 1:
+            self._stop = multiprocessing.Event()
+            self._pool = multiprocessing.Pool(processes, _init_worker, (self._stop,))
+        else:
+            self._stop = threading.Event()
+            self._pool = None
+        self._cancelled = False
+
+    def cancel(self):
+        """Stop the grind in progress, if any; it raises GrindError"""
+        self._cancelled = True
+        self._stop.set()
+
+    def _ranges(self, ephem_pubkey, mask, target, start_nonce, max_nonce, deadline):
+        for start in range(start_nonce, max_nonce + 1, RANGE_SIZE):
+            yield (ephem_pubkey, mask, target, start, min(start + RANGE_SIZE, max_nonce + 1), deadline)
+
+    def _run_local(self, ranges):
+        attempts = 0
+        for args in ranges:
+            nonce, n = _grind_range(args, self._stop)
+            attempts += n
+            if nonce is not None or self._stop.is_set():
+                return (nonce, attempts)
+        return (None, attempts)
+
+    def _run_pool(self, ranges):
+        done = threading.Condition()
+        results = []
+
+        def on_result(r):
+            with done:
+                results.append(r)
+                done.notify()
+
+        def on_error(e):
+            with done:
+                results.append(e)
+                done.notify()
+
+        in_flight = 0
+        nonce = None
+        attempts = 0
+        error = None
+        ranges = iter(ranges)
+        with done:
+            while True:
+                while (nonce is None and error is None and not self._stop.is_set()
+                       and in_flight < self.processes * RANGES_PER_WORKER):
+                    args = next(ranges, None)
+                    if args is None:
+                        break
+                    self._pool.apply_async(_grind_range, (args,),
+                                           callback=on_result, error_callback=on_error)
+                    in_flight += 1
+                if not in_flight:
+                    break
+
+                while not results:
+                    done.wait()
+                r = results.pop()
+                in_flight -= 1
+                if isinstance(r, BaseException):
+                    error = r
+                    self._stop.set()
+                    continue
+                attempts += r[1]
+                if r[0] is not None and nonce is None:
+                    nonce = r[0]
+                    # Tell the other workers to give up their ranges
+                    self._stop.set()
+
+        if error is not None:
+            raise error
+        return (nonce, attempts)
+
+    def grind(self, stealth_addr, ephem_pubkey, start_nonce=0, max_nonce=0xffffffff, timeout=None):
+        """Find a notification scriptPubKey whose prefix matches stealth_addr
+
+        timeout - Seconds the grind may take; defaults to the timeout given
+                  to the constructor
+
+        Returns the scriptPubKey, or None if no nonce from start_nonce to
+        max_nonce inclusive matched. Raises GrindError if the deadline passed
+        or the grind was cancelled first. Grinds are done one at a time.
+        """
+        if not stealth_addr.prefix_length:
+            return stealthaddress.make_notification_scriptPubKey(ephem_pubkey, start_nonce)
+        if len(ephem_pubkey) != 33:
+            raise stealthaddress.StealthAddressError('Ephemeral pubkey must be compressed')
+
+        if timeout is None:
+            timeout = self.timeout
+        with self._lock:
+            if self._pool is None and self.processes > 1:
+                raise GrindError('Grinder is closed')
+            self._stop.clear()
+            self._cancelled = False
+
+            start = time.time()
+            deadline = None if timeout is None else start + timeout
+            mask, target = stealthaddress.notification_prefix_target(stealth_addr)
+            ranges = self._ranges(bytes(ephem_pubkey), mask, target, start_nonce, max_nonce, deadline)
+            if self._pool is None:
+                nonce, attempts = self._run_local(ranges)
+            else:
+                nonce, attempts = self._run_pool(ranges)
+            elapsed = time.time() - start
+
+            self.grinds += 1
+            self.attempts += attempts
+            self.seconds += elapsed
+            self.last_attempts_per_sec = attempts / elapsed if elapsed > 0 else 0.0
+
+            if nonce is not None:
+                return script.CScript(stealthaddress._NOTIFICATION_HEAD + nonce.to_bytes(4, 'big')
+                                      + bytes(ephem_pubkey))
+            elif self._cancelled:
+                raise GrindError('Grind for %s cancelled after %d attempts' % (stealth_addr, attempts))
+            elif deadline is not None and time.time() > deadline:
+                raise GrindError('Grind for %s timed out after %d attempts' % (stealth_addr, attempts))
+            return None
+
+    def stats(self):
+        """Return a dict of the grinding counters"""
+        return {'processes': self.processes,
+                'grinds': self.grinds,
+                'attempts': self.attempts,
+                'seconds': self.seconds,
+                'attempts_per_sec': self.attempts / self.seconds if self.seconds > 0 else 0.0,
+                'last_attempts_per_sec': self.last_attempts_per_sec}
+
+    def close(self):
+        """Shut down the worker processes"""
+        if self._pool is not None:
+            self._stop.set()
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,160 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Pool of pre-generated ephemeral keys for stealth payments
+
+Every stealth payment needs a fresh ephemeral key. EphemeralKeyPool keeps a
+supply of them ready, refilled in the background, so that making a payment
+doesn't have to wait for a scalar multiplication:
+
+    pool = EphemeralKeyPool()
+    tx = stealthaddress.pay(payments, ephem_keys=pool.take(len(payments)))
+
+Keys are generated in batches with stealthaddress.make_ephem_keys(), either
+in a background thread or, if an executor such as a ProcessPoolExecutor is
+given, in whatever that executor runs on.
+
+Every key handed out by take() is removed from the pool; a key is never
+handed out twice.
+"""
+
+import collections
+import threading
+
+import stealthaddress
+
+class EphemeralKeyPool(object):
+    """Bounded pool of (ephem_secret, ephem_pubkey) tuples
+
+    maxsize        - Refilling stops once the pool holds this many keys
+    low_watermark  - Refilling starts once the pool drops below this many
+                     keys; defaults to half of maxsize, and must be at
+                     least 1
+    batch_size     - Number of keys generated at once
+    executor       - Optional concurrent.futures executor to generate keys in
+    start          - Start the background refill thread immediately
+
+    Attributes:
+
+    generated - Number of keys generated by refills
+    taken     - Number of keys handed out by take()
+    misses    - Number of keys take() had to generate itself because the
+                pool was empty
+    refills   - Number of batches generated by refills
+    """
+
+    def __init__(self, maxsize=1024, low_watermark=None, batch_size=128,
+                 executor=None, start=True):
+        if low_watermark is None:
+            low_watermark = max(1, maxsize // 2)
+        if not (1 <= low_watermark <= maxsize):
+            raise ValueError('low_watermark must be between 1 and maxsize; got %r' % low_watermark)
+
+        self.maxsize = maxsize
+        self.low_watermark = low_watermark
+        self.batch_size = batch_size
+        self.executor = executor
+
+        self.generated = 0
+        self.taken = 0
+        self.misses = 0
+        self.refills = 0
+
+        self._keys = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+        if start:
+            self.start()
+
+    def _make_batch(self, count):
+        if self.executor is not None:
+            return self.executor.submit(stealthaddress.make_ephem_keys, count).result()
+        return stealthaddress.make_ephem_keys(count)
+
+    def _refill_once(self):
+        """Generate one batch if the pool isn't full; returns False if it was"""
+        with self._cond:
+            count = min(self.batch_size, self.maxsize - len(self._keys))
+        if count <= 0:
+            return False
+
+        keys = self._make_batch(count)
+        with self._cond:
+            # fill() and the background thread may have both generated a
+            # batch for the same room; drop whatever no longer fits.
+            del keys[max(0, self.maxsize - len(self._keys)):]
+            if not keys:
+                return False
+            self._keys.extend(keys)
+            self.generated += len(keys)
+            self.refills += 1
+        return True
+
+    def fill(self):
+        """Fill the pool up to maxsize in the calling thread"""
+        while self._refill_once():
+            pass
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping and len(self._keys) >= self.low_watermark:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+            self.fill()
+
+    def start(self):
+        """Start the background refill thread"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='EphemeralKeyPool', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background refill thread, waiting for it to exit"""
+        with self._cond:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        thread.join()
+        self._thread = None
+
+    def take(self, count=1):
+        """Take count keys from the pool
+
+        If the pool runs dry the remaining keys are generated right away, in
+        the calling thread. Returns a list of (ephem_secret, ephem_pubkey).
+        """
+        with self._cond:
+            n = min(count, len(self._keys))
+            r = [self._keys.popleft() for i in range(n)]
+            self.taken += count
+            self.misses += count - n
+            if len(self._keys) < self.low_watermark:
+                self._cond.notify_all()
+
+        if n < count:
+            r.extend(stealthaddress.make_ephem_keys(count - n))
+        return r
+
+    def __len__(self):
+        with self._cond:
+            return len(self._keys)
+
+    def stats(self):
+        """Return a dict of the pool counters"""
+        with self._cond:
+            return {'size': len(self._keys),
+                    'maxsize': self.maxsize,
+                    'low_watermark': self.low_watermark,
+                    'generated': self.generated,
+                    'taken': self.taken,
+                    'misses': self.misses,
+                    'refills': self.refills}
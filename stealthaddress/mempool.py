@@ -0,0 +1,191 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Asyncio watcher for stealth payments in the mempool
+
+MempoolWatcher consumes transactions as they arrive, for instance from tx
+messages off the p2p network, and calls back once per payment found:
+
+    async def on_payment(payment):
+        ...
+
+    watcher = MempoolWatcher(secrets, on_payment)
+    task = asyncio.ensure_future(watcher.run())
+    async for msg in p2p_messages:
+        await watcher.put(msg)
+
+The prefix filter is cheap and runs inline, on the event loop. Only
+transactions with a notification matching some address's prefix go on to the
+ECDH and derivation steps, which run in an executor so they don't stall the
+loop.
+
+The queue between put() and the workers is bounded. When the workers fall
+behind put() waits, pushing back on whatever feeds the watcher, while
+put_nowait() drops the transaction instead.
+"""
+
+import asyncio
+import inspect
+
+import bitcoin.core
+import bitcoin.messages
+
+import stealthaddress
+
+DEFAULT_MAXSIZE = 1024
+
+class MempoolWatcher(object):
+    """Watch a stream of transactions for stealth payments
+
+    stealth_scan_secrets - Iterable of StealthScanSecret's to scan for
+    callback             - Called with every StealthPayment found; if it
+                           returns an awaitable that is awaited before the
+                           next transaction is processed
+    executor             - concurrent.futures executor the ECDH and
+                           derivation run in; defaults to the loop's default
+                           executor. The scanner is shared, so this must be
+                           a thread, not a process, executor.
+    maxsize              - Maximum number of queued transactions
+    workers              - Number of transactions processed concurrently
+
+    Attributes:
+
+    received           - Number of transactions accepted by put()
+    matched            - Number of transactions that passed the prefix filter
+    payments           - Number of payments found
+    dropped            - Number of transactions put_nowait() dropped because
+                         the queue was full
+    backpressure_waits - Number of times put() had to wait for room
+    max_queue_depth    - Highest number of transactions queued at once
+    """
+
+    def __init__(self, stealth_scan_secrets, callback, executor=None,
+                 maxsize=DEFAULT_MAXSIZE, workers=1):
+        if workers < 1:
+            raise ValueError('workers must be at least 1; got %r' % workers)
+
+        self.scanner = stealthaddress.StealthScanner(stealth_scan_secrets)
+        self.callback = callback
+        self.executor = executor
+        self.maxsize = maxsize
+        self.workers = workers
+
+        self.received = 0
+        self.matched = 0
+        self.payments = 0
+        self.dropped = 0
+        self.backpressure_waits = 0
+        self.max_queue_depth = 0
+
+        self._queue = None
+        self._in_flight = 0
+
+    @property
+    def queue(self):
+        # Created on first use so it binds to the running loop
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.maxsize)
+        return self._queue
+
+    @staticmethod
+    def _get_tx(tx):
+        if isinstance(tx, bitcoin.messages.msg_tx):
+            return tx.tx
+        return tx
+
+    def _queued(self):
+        self.received += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    async def put(self, tx):
+        """Queue a CTransaction or msg_tx, waiting for room if the queue is full"""
+        tx = self._get_tx(tx)
+        if self.queue.full():
+            self.backpressure_waits += 1
+        await self.queue.put(tx)
+        self._queued()
+
+    def put_nowait(self, tx):
+        """Queue a CTransaction or msg_tx; returns False if it was dropped"""
+        try:
+            self.queue.put_nowait(self._get_tx(tx))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self._queued()
+        return True
+
+    async def feed(self, source):
+        """Queue every transaction or tx message from an iterable or async iterable
+
+        Messages other than tx messages are ignored.
+        """
+        if hasattr(source, '__aiter__'):
+            async for msg in source:
+                if isinstance(msg, (bitcoin.core.CTransaction, bitcoin.messages.msg_tx)):
+                    await self.put(msg)
+        else:
+            for msg in source:
+                if isinstance(msg, (bitcoin.core.CTransaction, bitcoin.messages.msg_tx)):
+                    await self.put(msg)
+
+    def prefilter(self, tx):
+        """Return True if any notification in tx matches an address prefix"""
+        return bool(self.scanner.prefilter([tx]))
+
+    async def process(self, tx):
+        """Scan a single transaction, calling back for every payment
+
+        Returns the number of payments found.
+        """
+        if not self.prefilter(tx):
+            return 0
+        self.matched += 1
+
+        loop = asyncio.get_running_loop()
+        payments = await loop.run_in_executor(self.executor,
+                                              lambda: list(self.scanner.scan_tx(tx)))
+        for payment in payments:
+            self.payments += 1
+            r = self.callback(payment)
+            if inspect.isawaitable(r):
+                await r
+        return len(payments)
+
+    async def _worker(self):
+        while True:
+            tx = await self.queue.get()
+            self._in_flight += 1
+            try:
+                await self.process(tx)
+            finally:
+                self._in_flight -= 1
+                self.queue.task_done()
+
+    async def run(self):
+        """Process queued transactions until cancelled
+
+        Exceptions raised by the callback propagate out of run().
+        """
+        tasks = [asyncio.ensure_future(self._worker()) for i in range(self.workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def join(self):
+        """Wait until every queued transaction has been processed"""
+        await self.queue.join()
+
+    def stats(self):
+        """Return a dict of the watcher metrics"""
+        return {'queue_depth': self.queue.qsize(),
+                'maxsize': self.maxsize,
+                'in_flight': self._in_flight,
+                'received': self.received,
+                'matched': self.matched,
+                'payments': self.payments,
+                'dropped': self.dropped,
+                'backpressure_waits': self.backpressure_waits,
+                'max_queue_depth': self.max_queue_depth}
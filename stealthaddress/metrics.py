@@ -0,0 +1,132 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Counters and timers for the stages of stealth scanning
+
+A StealthScanner given a Metrics registry counts the work each stage does,
+and the time it takes:
+
+    metrics = Metrics()
+    scanner = StealthScanner(secrets, metrics=metrics)
+    ...
+    print(metrics.to_prometheus())
+
+Counters:
+
+    outputs_examined   - Outputs looked at by the prefix filter
+    notifications      - Notification outputs found
+    prefix_hits        - Notifications matching some address prefix
+    ecdh               - ECDH operations
+    derive             - Payee pubkey derivations, not counting payee scripts
+                         found in the memo
+    script_comparisons - Payee scripts compared against transaction outputs
+    payments           - Payments found
+
+Timers, in seconds of wall time: prefilter, ecdh and derive.
+
+Scanners not given a registry share DISABLED, whose methods return at once.
+"""
+
+import threading
+import time
+
+COUNTERS = ('outputs_examined', 'notifications', 'prefix_hits', 'ecdh', 'derive',
+            'script_comparisons', 'payments')
+TIMERS = ('prefilter', 'ecdh', 'derive')
+
+class _Timer(object):
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+class Metrics(object):
+    """Registry of scan counters and timers
+
+    enabled - If False nothing is recorded
+
+    Counters and timers other than the ones listed in COUNTERS and TIMERS are
+    created on first use. Safe to share between threads.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Zero every counter and timer"""
+        with self._lock:
+            self._counters = dict.fromkeys(COUNTERS, 0)
+            self._timers = {name: [0, 0.0] for name in TIMERS}
+
+    def incr(self, name, n=1):
+        """Add n to a counter"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        """Record one timed call of a stage"""
+        if not self.enabled:
+            return
+        with self._lock:
+            timer = self._timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    def timer(self, name):
+        """Return a context manager timing the stage name"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def to_dict(self):
+        """Return a snapshot of the counters and timers
+
+        Returns {'counters': {name: count},
+                 'timers': {name: {'count': calls, 'seconds': total}}}
+        """
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'timers': {name: {'count': count, 'seconds': seconds}
+                               for name, (count, seconds) in self._timers.items()}}
+
+    def to_prometheus(self, namespace='stealthaddress'):
+        """Return a snapshot in the Prometheus text exposition format"""
+        snapshot = self.to_dict()
+        lines = []
+        for name, count in sorted(snapshot['counters'].items()):
+            metric = '%s_%s_total' % (namespace, name)
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %d' % (metric, count))
+
+        timers = sorted(snapshot['timers'].items())
+        lines.append('# TYPE %s_stage_seconds_total counter' % namespace)
+        for name, timer in timers:
+            lines.append('%s_stage_seconds_total{stage="%s"} %r' % (namespace, name, timer['seconds']))
+        lines.append('# TYPE %s_stage_calls_total counter' % namespace)
+        for name, timer in timers:
+            lines.append('%s_stage_calls_total{stage="%s"} %d' % (namespace, name, timer['count']))
+        return '\n'.join(lines) + '\n'
+
+DISABLED = Metrics(enabled=False)
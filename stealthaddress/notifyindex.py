@@ -0,0 +1,305 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Index file of stealth notifications
+
+Finding payments to a newly added scan key would otherwise mean parsing every
+block again. The notification index is built once, in a single pass over the
+chain. Every transaction with notifications gets a fixed-width record for
+each of its notification outputs, followed by one for each of its outputs a
+payment could have been made to:
+
+    height       - Height of the block containing the transaction
+    txid         - The transaction
+    n            - Index of the output
+    ephem_pubkey - Ephemeral pubkey; zero for payee outputs
+    prefix       - Prefix of the notification, see notification_prefix();
+                   zero for payee outputs
+    nValue       - Value of a payee output; zero for notifications
+    payee_type   - PAYEE_P2PKH or PAYEE_P2SH for payee outputs, PAYEE_NONE
+                   for notifications
+    payee_hash   - Hash160 of the payee pubkey or redeemScript
+
+As every P2PKH and P2SH output of the transaction is indexed, the index finds
+the same payments recover() does, wherever their outputs are.
+
+The file is append-only and records are in height order. Readers mmap it, so
+a rescan is a sequential read of the index alone.
+"""
+
+import collections
+import mmap
+import os
+import struct
+
+import bitcoin.core
+import bitcoin.core.script as script
+
+import stealthaddress
+
+MAGIC = b'STEALTHNOTIFYIDX'
+VERSION = 2
+
+PAYEE_NONE = 0
+PAYEE_P2PKH = 1
+PAYEE_P2SH = 2
+
+_HEADER = struct.Struct('<16sI')
+_RECORD = struct.Struct('<I32sI33sIqB20s')
+RECORD_SIZE = _RECORD.size
+
+class NotificationIndexError(Exception):
+    pass
+
+class Notification(collections.namedtuple('Notification', 'height txid n ephem_pubkey prefix payees')):
+    """A notification as read back from an index
+
+    payees is a tuple of (n, nValue, scriptPubKey) for every payee output of
+    the transaction.
+    """
+
+    __slots__ = ()
+
+def _payee_from_scriptPubKey(scriptPubKey):
+    if scriptPubKey.is_p2sh():
+        return (PAYEE_P2SH, scriptPubKey[2:22])
+    elif (len(scriptPubKey) == 25
+            and scriptPubKey[0:3] == b'\x76\xa9\x14'
+            and scriptPubKey[23:25] == b'\x88\xac'):
+        return (PAYEE_P2PKH, scriptPubKey[3:23])
+    else:
+        return (PAYEE_NONE, b'\x00' * 20)
+
+def _scriptPubKey_from_payee(payee_type, payee_hash):
+    if payee_type == PAYEE_P2PKH:
+        return script.CScript([script.OP_DUP, script.OP_HASH160, payee_hash,
+                               script.OP_EQUALVERIFY, script.OP_CHECKSIG])
+    elif payee_type == PAYEE_P2SH:
+        return script.CScript([script.OP_HASH160, payee_hash, script.OP_EQUAL])
+    else:
+        return None
+
+def iter_tx_notification_records(height, tx, txid=None):
+    """Yield the packed index record of every notification in a transaction"""
+    for n, ephem_pubkey, prefix in stealthaddress.extract_notifications(tx):
+        if txid is None:
+            txid = bitcoin.core.Hash(tx.serialize())
+        yield _RECORD.pack(height, txid, n, ephem_pubkey, prefix, 0, PAYEE_NONE, b'\x00' * 20)
+
+def iter_tx_records(height, tx, txid=None):
+    """Yield the packed index records of a transaction
+
+    Nothing is yielded for transactions without notifications. Otherwise the
+    notification records are followed by the payee output records.
+    """
+    if txid is None:
+        txid = bitcoin.core.Hash(tx.serialize())
+    records = list(iter_tx_notification_records(height, tx, txid))
+    if not records:
+        return
+    for n, txout in enumerate(tx.vout):
+        payee_type, payee_hash = _payee_from_scriptPubKey(txout.scriptPubKey)
+        if payee_type != PAYEE_NONE:
+            records.append(_RECORD.pack(height, txid, n, b'\x00' * 33, 0,
+                                        txout.nValue, payee_type, payee_hash))
+    for record in records:
+        yield record
+
+def iter_block_records(height, block):
+    """Yield the packed index records of every transaction in a block"""
+    for tx in block.vtx:
+        for record in iter_tx_records(height, tx):
+            yield record
+
+def iter_unpack_records(buf):
+    """Unpack back to back records, as yielded by iter_block_records()"""
+    if len(buf) % _RECORD.size:
+        raise NotificationIndexError('Records truncated')
+    return _RECORD.iter_unpack(buf)
+
+def iter_unpack_txs(records):
+    """Group unpacked records by transaction
+
+    Yields (height, txid, notifications, payees) with notifications a list of
+    (n, ephem_pubkey, prefix), and payees of (n, nValue, scriptPubKey).
+    """
+    tx = None
+    for height, txid, n, ephem_pubkey, prefix, nValue, payee_type, payee_hash in records:
+        if payee_type == PAYEE_NONE:
+            if tx is not None and (tx[1] != txid or tx[3]):
+                yield tx
+                tx = None
+            if tx is None:
+                tx = (height, txid, [], [])
+            tx[2].append((n, ephem_pubkey, prefix))
+        elif tx is not None and tx[1] == txid:
+            tx[3].append((n, nValue, _scriptPubKey_from_payee(payee_type, payee_hash)))
+        else:
+            raise NotificationIndexError('Payee record without a notification')
+    if tx is not None:
+        yield tx
+
+def scan_tx_records(scanner, txid, notifications, payees):
+    """Scan the records of a transaction with a StealthScanner
+
+    notifications and payees are as yielded by iter_unpack_txs(). Yields a
+    StealthPayment for every payment to an address of the scanner.
+    """
+    if not payees:
+        return
+
+    outputs = {}
+    for n, nValue, scriptPubKey in payees:
+        outputs.setdefault(scriptPubKey, []).append((n, nValue))
+
+    for n, ephem_pubkey, prefix in notifications:
+        for stealth_scan_secret, ephem_cpubkey, shared_secret, scriptPubKey, redeemScript \
+                in scanner.scan_notification(ephem_pubkey, prefix):
+            for payee_n, nValue in outputs.get(scriptPubKey, ()):
+                yield stealthaddress.StealthPayment(bitcoin.core.COutPoint(txid, payee_n), nValue,
+                                                    scriptPubKey, redeemScript,
+                                                    ephem_cpubkey, shared_secret, stealth_scan_secret)
+
+def _check_header(buf, path):
+    magic, version = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise NotificationIndexError('%s is not a notification index' % path)
+    if version != VERSION:
+        raise NotificationIndexError('Unsupported notification index version %d' % version)
+
+
+class NotificationIndexWriter(object):
+    """Appends notifications to an index file
+
+    A crash can leave the last block only partly written. Opening an existing
+    index therefore truncates it back to the start of the last block it has
+    records for, and indexing resumes from that block at next_height.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.next_height = 0
+
+        if os.path.exists(path) and os.path.getsize(path) >= _HEADER.size:
+            self._fd = open(path, 'r+b')
+            _check_header(self._fd.read(_HEADER.size), path)
+
+            count = (os.path.getsize(path) - _HEADER.size) // _RECORD.size
+            end = count
+            if count:
+                self.next_height = self._read_height(count - 1)
+                while end > 0 and self._read_height(end - 1) == self.next_height:
+                    end -= 1
+            self._fd.truncate(_HEADER.size + end * _RECORD.size)
+            self._fd.seek(_HEADER.size + end * _RECORD.size)
+        else:
+            self._fd = open(path, 'w+b')
+            self._fd.write(_HEADER.pack(MAGIC, VERSION))
+
+    def _read_height(self, i):
+        self._fd.seek(_HEADER.size + i * _RECORD.size)
+        return _RECORD.unpack(self._fd.read(_RECORD.size))[0]
+
+    def add_block(self, height, block):
+        """Add the records of a block; returns the number added"""
+        if height < self.next_height:
+            raise NotificationIndexError('Block at height %d already indexed; next height is %d' %
+                                         (height, self.next_height))
+        records = list(iter_block_records(height, block))
+        self._fd.write(b''.join(records))
+        self.next_height = height + 1
+        return len(records)
+
+    def truncate(self, height):
+        """Remove the records at or above height, as after a reorg
+
+        Indexing resumes at height. Only the removed records are read.
+        """
+        if height >= self.next_height:
+            return
+        self._fd.flush()
+        end = (os.fstat(self._fd.fileno()).st_size - _HEADER.size) // _RECORD.size
+        while end > 0 and self._read_height(end - 1) >= height:
+            end -= 1
+        self._fd.truncate(_HEADER.size + end * _RECORD.size)
+        self._fd.seek(_HEADER.size + end * _RECORD.size)
+        self.next_height = height
+
+    def add_blocks(self, blocks):
+        """Add (height, CBlock) tuples, such as from rescan.iter_blocks()"""
+        for height, block in blocks:
+            self.add_block(height, block)
+
+    def flush(self):
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+
+    def close(self):
+        self.flush()
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class NotificationIndex(object):
+    """Read-only, memory-mapped view of a notification index file"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fd:
+            _check_header(fd.read(_HEADER.size), path)
+            size = os.fstat(fd.fileno()).st_size
+            # Ignore any partially written trailing record
+            self._count = (size - _HEADER.size) // _RECORD.size
+            self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) if self._count else b''
+
+    def __len__(self):
+        """Number of records, notification and payee records alike"""
+        return self._count
+
+    def _raw(self, i):
+        return _RECORD.unpack_from(self._mmap, _HEADER.size + i * _RECORD.size)
+
+    def _iter_raw(self, start_height=0, end_height=None):
+        for i in range(self.find_height(start_height), self._count):
+            record = self._raw(i)
+            if end_height is not None and record[0] >= end_height:
+                break
+            yield record
+
+    def __iter__(self):
+        """Iterate over the Notification's in the index"""
+        for height, txid, notifications, payees in iter_unpack_txs(self._iter_raw()):
+            payees = tuple(payees)
+            for n, ephem_pubkey, prefix in notifications:
+                yield Notification(height, txid, n, ephem_pubkey, prefix, payees)
+
+    def find_height(self, height):
+        """Return the index of the first record at or above height"""
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._raw(mid)[0] < height:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def scan(self, stealth_scan_secrets, start_height=0, end_height=None):
+        """Scan the index for payments
+
+        stealth_scan_secrets - Iterable of StealthScanSecret's
+        start_height         - Only scan records at or above this height
+        end_height           - Only scan records below this height
+
+        Yields (height, StealthPayment) in height order.
+        """
+        scanner = stealthaddress.StealthScanner(stealth_scan_secrets)
+        for height, txid, notifications, payees \
+                in iter_unpack_txs(self._iter_raw(start_height, end_height)):
+            for payment in scan_tx_records(scanner, txid, notifications, payees):
+                yield (height, payment)
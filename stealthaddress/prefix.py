@@ -0,0 +1,122 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Prefix index for filtering stealth notifications
+
+Finds the stealth addresses a notification could be for, without comparing
+the notification prefix against every address.
+
+If NumPy is available, candidates_many() matches all the notification
+prefixes of a block at once with vectorized operations; otherwise it falls
+back to candidates() per prefix.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAX_PREFIX_LENGTH = 32
+
+class PrefixIndex(object):
+    """Index of stealth addresses by prefix
+
+    Addresses are bucketed by prefix length, and within each bucket by the
+    value of their prefix; a lookup costs one dict lookup per distinct prefix
+    length in use, at most 33, no matter how many addresses are indexed.
+
+    Only the first MAX_PREFIX_LENGTH bits of a prefix are indexed, matching
+    StealthAddress.matches_prefix()
+    """
+
+    def __init__(self, stealth_addrs=()):
+        # prefix_length -> {prefix: [value, ...]}
+        self.buckets = {}
+        self.count = 0
+        # Sorted NumPy arrays of bucket keys, built by candidates_many()
+        self._arrays = None
+        for stealth_addr in stealth_addrs:
+            self.add(stealth_addr)
+
+    @staticmethod
+    def _key(stealth_addr):
+        prefix_length = min(stealth_addr.prefix_length, MAX_PREFIX_LENGTH)
+        prefix = int.from_bytes(stealth_addr.prefix[0:4].ljust(4, b'\x00'), 'big')
+        return (prefix_length, prefix >> (MAX_PREFIX_LENGTH - prefix_length))
+
+    def add(self, stealth_addr, value=None):
+        """Add a stealth address to the index
+
+        value - What candidates() returns for this address; defaults to the
+                address itself.
+        """
+        if value is None:
+            value = stealth_addr
+        prefix_length, prefix = self._key(stealth_addr)
+        self.buckets.setdefault(prefix_length, {}).setdefault(prefix, []).append(value)
+        self.count += 1
+        self._arrays = None
+
+    def remove(self, stealth_addr, value=None):
+        """Remove a stealth address from the index
+
+        Raises KeyError if it isn't in the index.
+        """
+        if value is None:
+            value = stealth_addr
+        prefix_length, prefix = self._key(stealth_addr)
+        try:
+            values = self.buckets[prefix_length][prefix]
+            values.remove(value)
+        except ValueError:
+            raise KeyError(stealth_addr)
+        if not values:
+            del self.buckets[prefix_length][prefix]
+            if not self.buckets[prefix_length]:
+                del self.buckets[prefix_length]
+        self.count -= 1
+        self._arrays = None
+
+    def candidates(self, prefix):
+        """Return the values of all addresses matching a notification prefix
+
+        prefix - 32-bit notification prefix, as returned by
+                 notification_prefix()
+        """
+        r = []
+        for prefix_length, bucket in self.buckets.items():
+            r.extend(bucket.get(prefix >> (MAX_PREFIX_LENGTH - prefix_length), ()))
+        return r
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            self._arrays = []
+            for prefix_length, bucket in self.buckets.items():
+                keys = sorted(bucket)
+                self._arrays.append((numpy.uint64(MAX_PREFIX_LENGTH - prefix_length),
+                                     numpy.array(keys, dtype=numpy.uint64),
+                                     [bucket[key] for key in keys]))
+        return self._arrays
+
+    def candidates_many(self, prefixes):
+        """Return candidates() for every prefix in a sequence, as a list
+
+        With NumPy this costs a shift, a sorted search and a compare over all
+        the prefixes per distinct prefix length, rather than per prefix.
+        """
+        if numpy is None:
+            return [self.candidates(prefix) for prefix in prefixes]
+
+        r = [[] for prefix in prefixes]
+        if not r:
+            return r
+        words = numpy.array(prefixes, dtype=numpy.uint64)
+        for shift, keys, values in self._get_arrays():
+            shifted = words >> shift
+            pos = numpy.minimum(numpy.searchsorted(keys, shifted), len(keys) - 1)
+            for i in numpy.flatnonzero(keys[pos] == shifted).tolist():
+                r[i].extend(values[pos[i]])
+        return r
+
+    def __len__(self):
+        return self.count
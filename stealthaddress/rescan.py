@@ -0,0 +1,179 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Rescan block files for stealth payments
+
+Block files are a sequence of records, each consisting of MESSAGE_START, the
+length of the block as a 4-byte little-endian integer, and the serialized
+block. That's the format of the bootstrap.dat files written by
+examples/make-bootstrap-rpc.py as well as Bitcoin Core's blk*.dat files.
+
+Block files are split into ranges of blocks at record boundaries, and the
+ranges scanned in parallel by a pool of worker processes. Results are merged
+back in block order.
+
+Blocks are numbered in the order they appear in the files given. For a
+bootstrap.dat that's the block height; blk*.dat files however are in the
+order the blocks were received, which isn't necessarily height order.
+"""
+
+import multiprocessing
+import struct
+
+import bitcoin
+import bitcoin.core
+import bitcoin.core.key
+import bitcoin.core.script
+
+import stealthaddress
+
+DEFAULT_BLOCKS_PER_RANGE = 1000
+
+class BlockFileError(Exception):
+    pass
+
+def iter_block_records(fd, message_start=None, start=0, end=None):
+    """Iterate over the records in a block file
+
+    Yields (offset, length) for every block, where offset is the position of
+    the serialized block itself in the file. Reading stops at end, at the end
+    of the file, or at zero-filled padding, which Bitcoin Core leaves at the
+    end of blk*.dat files.
+    """
+    if message_start is None:
+        message_start = bitcoin.params.MESSAGE_START
+
+    fd.seek(start)
+    pos = start
+    while end is None or pos < end:
+        header = fd.read(8)
+        if len(header) < 8 or header[0:4] == b'\x00\x00\x00\x00':
+            break
+        if header[0:4] != message_start:
+            raise BlockFileError('Bad MESSAGE_START at offset %d' % pos)
+
+        length = struct.unpack('<i', header[4:8])[0]
+        if length < 80:
+            raise BlockFileError('Bad block length %d at offset %d' % (length, pos))
+
+        yield (pos + 8, length)
+        pos += 8 + length
+        fd.seek(pos)
+
+def split_block_ranges(paths, blocks_per_range=DEFAULT_BLOCKS_PER_RANGE, message_start=None):
+    """Split block files into ranges of blocks
+
+    Returns a list of (path, start, end, first_height) tuples, with start and
+    end being file offsets at record boundaries.
+    """
+    ranges = []
+    height = 0
+    for path in paths:
+        with open(path, 'rb') as fd:
+            records = list(iter_block_records(fd, message_start))
+        for i in range(0, len(records), blocks_per_range):
+            chunk = records[i:i+blocks_per_range]
+            start = chunk[0][0] - 8
+            end = chunk[-1][0] + chunk[-1][1]
+            ranges.append((path, start, end, height))
+            height += len(chunk)
+    return ranges
+
+def iter_blocks(paths, message_start=None, start_height=0):
+    """Iterate over the blocks in block files
+
+    Yields (height, CBlock) tuples, skipping blocks below start_height without
+    deserializing them.
+    """
+    height = 0
+    for path in paths:
+        with open(path, 'rb') as fd:
+            for offset, length in list(iter_block_records(fd, message_start)):
+                if height >= start_height:
+                    fd.seek(offset)
+                    yield (height, bitcoin.core.CBlock.deserialize(fd.read(length)))
+                height += 1
+
+
+# Scanner for the current worker process; StealthScanSecret's can't be
+# pickled, so each worker recreates them from their base58 form once.
+_worker_scanner = None
+_worker_secret_indexes = None
+_worker_message_start = None
+
+def _init_worker(stealth_scan_secret_strs, message_start):
+    global _worker_scanner, _worker_secret_indexes, _worker_message_start
+    stealth_scan_secrets = [stealthaddress.StealthScanSecret(s) for s in stealth_scan_secret_strs]
+    _worker_scanner = stealthaddress.StealthScanner(stealth_scan_secrets)
+    _worker_secret_indexes = {id(secret): i for i, secret in enumerate(stealth_scan_secrets)}
+    _worker_message_start = message_start
+
+def _scan_range(block_range):
+    """Scan a range of blocks in a worker
+
+    Returns a list of (height, block_hash, payment) tuples, with payment in a
+    picklable tuple form.
+    """
+    path, start, end, height = block_range
+    r = []
+    with open(path, 'rb') as fd:
+        for offset, length in list(iter_block_records(fd, _worker_message_start, start, end)):
+            fd.seek(offset)
+            block = bitcoin.core.CBlock.deserialize(fd.read(length))
+            block_hash = bitcoin.core.Hash(block.get_header().serialize())
+
+            for payment in _worker_scanner.scan(block):
+                r.append((height, block_hash,
+                          (payment.outpoint.hash, payment.outpoint.n, payment.nValue,
+                           bytes(payment.scriptPubKey),
+                           None if payment.redeemScript is None else bytes(payment.redeemScript),
+                           bytes(payment.ephem_pubkey), payment.shared_secret,
+                           _worker_secret_indexes[id(payment.stealth_scan_secret)])))
+            height += 1
+    return r
+
+def _payment_from_tuple(t, stealth_scan_secrets):
+    txid, n, nValue, scriptPubKey, redeemScript, ephem_pubkey, shared_secret, i = t
+    return stealthaddress.StealthPayment(
+                bitcoin.core.COutPoint(txid, n), nValue,
+                bitcoin.core.script.CScript(scriptPubKey),
+                None if redeemScript is None else bitcoin.core.script.CScript(redeemScript),
+                bitcoin.core.key.CPubKey(ephem_pubkey), shared_secret,
+                stealth_scan_secrets[i])
+
+def rescan(paths, stealth_scan_secrets, processes=None,
+           blocks_per_range=DEFAULT_BLOCKS_PER_RANGE, message_start=None):
+    """Rescan block files for stealth payments
+
+    paths                - Block files, in order
+    stealth_scan_secrets - Iterable of StealthScanSecret's
+    processes            - Number of worker processes; defaults to the number
+                           of CPUs. If 1 everything is done in this process.
+    blocks_per_range     - Number of blocks handed to a worker at once
+    message_start        - Defaults to bitcoin.params.MESSAGE_START
+
+    Yields (height, block_hash, StealthPayment) tuples in block order.
+    """
+    if message_start is None:
+        message_start = bitcoin.params.MESSAGE_START
+    stealth_scan_secrets = list(stealth_scan_secrets)
+    stealth_scan_secret_strs = [str(secret) for secret in stealth_scan_secrets]
+
+    ranges = split_block_ranges(paths, blocks_per_range, message_start)
+
+    if processes == 1:
+        _init_worker(stealth_scan_secret_strs, message_start)
+        results = map(_scan_range, ranges)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker,
+                                    (stealth_scan_secret_strs, message_start))
+        results = pool.imap(_scan_range, ranges)
+
+    try:
+        for range_results in results:
+            for height, block_hash, t in range_results:
+                yield (height, block_hash, _payment_from_tuple(t, stealth_scan_secrets))
+    finally:
+        if pool is not None:
+            pool.terminate()
@@ -0,0 +1,449 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Scanning with scan keys sharded across processes and nodes
+
+Scan keys are partitioned into shards by prefix range, see partition(). Each
+shard is served by a ShardServer, which holds that shard's scan secrets and
+does the ECDH work for them. A ShardDispatcher holds only the stealth
+addresses: it extracts every notification in a block as a notification index
+record, see stealthaddress.notifyindex, and sends each record only to the
+shards owning an address whose prefix matches it. No shard does ECDH for an
+address it doesn't own, and the shards work on a block concurrently.
+
+ShardedScanner runs a shard per local worker process. Shards on other nodes
+are served with serve() and connected to with ShardClient.connect().
+
+Replies carry shared secrets, which together with a spend secret are enough
+to spend a payment. serve() therefore defaults to a Unix socket, and only
+listens on TCP with an auth_key: every connection must then answer an
+HMAC-SHA256 challenge keyed with it before anything else is served. The
+connection itself is not encrypted, so a TCP shard must only be bound to a
+trusted interface, or reached through a tunnel.
+
+Shards talk over stream sockets. Every message is a frame: a 4-byte
+little-endian length followed by that many bytes. With an auth_key the
+server first sends a frame with a 32-byte random challenge, the client
+replies with HMAC-SHA256(auth_key, challenge), and the server answers b'OK'
+or closes the connection. Requests then start with a command byte:
+
+    b'A'           - List the stealth addresses served; the reply is a JSON
+                     list of address strings.
+    b'S' + entries - Scan notifications. Every entry is a notification index
+                     record, see stealthaddress.notifyindex, followed by the
+                     outputs of its transaction: a 2-byte count, then for
+                     every output its 8-byte nValue, 2-byte script length,
+                     and scriptPubKey. The reply is a JSON list of the
+                     payments found, each a dict of the entry index and the
+                     payment's output index n, nValue, scriptPubKey,
+                     redeemScript, shared_secret, scan_pubkey and
+                     stealth_addr, with bytes hex-encoded.
+
+Integers are little-endian. A request that can't be handled gets a JSON
+object with an 'error' key as its reply; the connection stays usable.
+"""
+
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import socket
+import struct
+
+import bitcoin.core
+from bitcoin.core import b2x, x
+
+import stealthaddress
+import stealthaddress.notifyindex
+import stealthaddress.prefix
+from stealthaddress.store import StoredPayment
+
+_FRAME_HEADER = struct.Struct('<I')
+_OUTPUT_COUNT = struct.Struct('<H')
+_OUTPUT = struct.Struct('<qH')
+
+# Largest frame accepted, so a bad length can't exhaust memory
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+class ShardError(Exception):
+    pass
+
+def _recv_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            if buf:
+                raise ShardError('Connection closed mid-frame')
+            return None
+        buf += chunk
+    return bytes(buf)
+
+def send_frame(sock, payload):
+    sock.sendall(_FRAME_HEADER.pack(len(payload)) + payload)
+
+def recv_frame(sock):
+    """Receive a frame; returns None if the connection was closed"""
+    header = _recv_exactly(sock, _FRAME_HEADER.size)
+    if header is None:
+        return None
+    length = _FRAME_HEADER.unpack(header)[0]
+    if length > MAX_FRAME_SIZE:
+        raise ShardError('Frame of %d bytes too large' % length)
+    payload = _recv_exactly(sock, length)
+    if payload is None:
+        raise ShardError('Connection closed mid-frame')
+    return payload
+
+
+def shard_of(stealth_addr, shards):
+    """Return the shard, out of shards, owning a stealth address
+
+    The 32-bit prefix space is split into shards equal ranges. An address
+    goes to the shard whose range its prefix falls in; addresses with short
+    prefixes that cover the ranges of several shards are spread over those by
+    scan pubkey.
+    """
+    prefix_length = min(stealth_addr.prefix_length, stealthaddress.prefix.MAX_PREFIX_LENGTH)
+    span = 1 << (stealthaddress.prefix.MAX_PREFIX_LENGTH - prefix_length)
+    start = int.from_bytes(stealth_addr.prefix[0:4].ljust(4, b'\x00'), 'big') // span * span
+    first = start * shards >> 32
+    last = (start + span - 1) * shards >> 32
+    return first + int.from_bytes(stealth_addr[2:6], 'big') % (last - first + 1)
+
+def partition(stealth_scan_secrets, shards):
+    """Partition scan secrets into shards lists by shard_of()"""
+    r = [[] for i in range(shards)]
+    for stealth_scan_secret in stealth_scan_secrets:
+        r[shard_of(stealth_scan_secret.stealth_addr, shards)].append(stealth_scan_secret)
+    return r
+
+
+def pack_outputs(tx):
+    """Pack the outputs of a transaction as sent after every record"""
+    parts = [_OUTPUT_COUNT.pack(len(tx.vout))]
+    for txout in tx.vout:
+        parts.append(_OUTPUT.pack(txout.nValue, len(txout.scriptPubKey)))
+        parts.append(bytes(txout.scriptPubKey))
+    return b''.join(parts)
+
+def iter_unpack_entries(buf):
+    """Unpack the entries of a scan request
+
+    Yields (record, outputs) with record unpacked and outputs a list of
+    (nValue, scriptPubKey). Raises ShardError if buf is malformed.
+    """
+    record_size = stealthaddress.notifyindex.RECORD_SIZE
+    pos = 0
+    while pos < len(buf):
+        if pos + record_size + _OUTPUT_COUNT.size > len(buf):
+            raise ShardError('Scan request truncated')
+        record = next(stealthaddress.notifyindex.iter_unpack_records(buf[pos:pos + record_size]))
+        pos += record_size
+        count = _OUTPUT_COUNT.unpack_from(buf, pos)[0]
+        pos += _OUTPUT_COUNT.size
+
+        outputs = []
+        for i in range(count):
+            if pos + _OUTPUT.size > len(buf):
+                raise ShardError('Scan request truncated')
+            nValue, length = _OUTPUT.unpack_from(buf, pos)
+            pos += _OUTPUT.size
+            if pos + length > len(buf):
+                raise ShardError('Scan request truncated')
+            outputs.append((nValue, buf[pos:pos + length]))
+            pos += length
+        yield (record, outputs)
+
+def _auth_response(auth_key, challenge):
+    return hmac.new(auth_key, challenge, hashlib.sha256).digest()
+
+
+class ShardServer(object):
+    """Serves scan requests for one shard of scan secrets
+
+    stealth_scan_secrets - The shard's StealthScanSecret's
+    auth_key             - If given, connections must authenticate with it;
+                           see the module docstring
+    """
+
+    def __init__(self, stealth_scan_secrets, auth_key=None):
+        self.stealth_scan_secrets = list(stealth_scan_secrets)
+        self.auth_key = auth_key
+        self.scanner = stealthaddress.StealthScanner(self.stealth_scan_secrets)
+
+    def _scan(self, body):
+        r = []
+        for i, (record, outputs) in enumerate(iter_unpack_entries(body)):
+            height, txid, n, ephem_pubkey, prefix, nValue, payee_type, payee_hash = record
+            by_script = {}
+            for out_n, (out_nValue, out_script) in enumerate(outputs):
+                by_script.setdefault(out_script, []).append(out_n)
+
+            for stealth_scan_secret, ephem_cpubkey, shared_secret, scriptPubKey, redeemScript \
+                    in self.scanner.scan_notification(ephem_pubkey, prefix):
+                for out_n in by_script.get(bytes(scriptPubKey), ()):
+                    r.append({'i': i,
+                              'n': out_n,
+                              'nValue': outputs[out_n][0],
+                              'scriptPubKey': b2x(scriptPubKey),
+                              'redeemScript': None if redeemScript is None else b2x(redeemScript),
+                              'shared_secret': b2x(shared_secret),
+                              'scan_pubkey': b2x(stealth_scan_secret.scan_pubkey),
+                              'stealth_addr': str(stealth_scan_secret.stealth_addr)})
+        return r
+
+    def handle(self, request):
+        """Handle a request payload, returning the reply payload
+
+        Raises ShardError if the request is malformed.
+        """
+        command, body = request[0:1], request[1:]
+        if command == b'A':
+            r = [str(secret.stealth_addr) for secret in self.stealth_scan_secrets]
+        elif command == b'S':
+            r = self._scan(body)
+        else:
+            raise ShardError('Unknown command %r' % command)
+        return json.dumps(r).encode('utf8')
+
+    def _authenticate(self, sock):
+        challenge = os.urandom(32)
+        send_frame(sock, challenge)
+        response = recv_frame(sock)
+        if response is None or not hmac.compare_digest(response, _auth_response(self.auth_key, challenge)):
+            return False
+        send_frame(sock, b'OK')
+        return True
+
+    def serve_connection(self, sock):
+        """Serve requests on a connected socket until it's closed
+
+        Malformed requests get an error reply. Broken framing or failed
+        authentication closes the connection, raising ShardError.
+        """
+        with sock:
+            if self.auth_key is not None and not self._authenticate(sock):
+                raise ShardError('Authentication failed')
+            while True:
+                request = recv_frame(sock)
+                if request is None:
+                    return
+                try:
+                    reply = self.handle(request)
+                except (ShardError, ValueError, struct.error) as err:
+                    reply = json.dumps({'error': str(err)}).encode('utf8')
+                send_frame(sock, reply)
+
+    def serve_forever(self, listen_sock):
+        """Accept and serve connections, one at a time
+
+        A connection that fails only ends that connection.
+        """
+        while True:
+            sock, addr = listen_sock.accept()
+            try:
+                self.serve_connection(sock)
+            except (ShardError, OSError):
+                pass
+
+def serve(address, stealth_scan_secrets, auth_key=None):
+    """Serve a shard until killed
+
+    address - A Unix socket path, or a TCP (host, port) tuple. TCP requires
+              an auth_key, and must only be bound to a trusted interface; see
+              the module docstring.
+    """
+    if isinstance(address, str):
+        listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        if auth_key is None:
+            raise ValueError('Serving a shard over TCP requires an auth_key')
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server = ShardServer(stealth_scan_secrets, auth_key)
+    with listen_sock:
+        listen_sock.bind(address)
+        if isinstance(address, str):
+            os.chmod(address, 0o600)
+        listen_sock.listen()
+        server.serve_forever(listen_sock)
+
+
+class ShardClient(object):
+    """Connection to a ShardServer
+
+    auth_key - Key to authenticate with, if the server requires one
+    """
+
+    def __init__(self, sock, auth_key=None):
+        self.sock = sock
+        if auth_key is not None:
+            challenge = recv_frame(sock)
+            if challenge is None:
+                raise ShardError('Shard closed the connection')
+            send_frame(sock, _auth_response(auth_key, challenge))
+            if recv_frame(sock) != b'OK':
+                raise ShardError('Authentication failed')
+
+    @classmethod
+    def connect(cls, address, auth_key=None):
+        """Connect to a Unix socket path or TCP (host, port) address"""
+        if isinstance(address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(address)
+        else:
+            sock = socket.create_connection(address)
+        try:
+            return cls(sock, auth_key)
+        except BaseException:
+            sock.close()
+            raise
+
+    def _recv_json(self):
+        reply = recv_frame(self.sock)
+        if reply is None:
+            raise ShardError('Shard closed the connection')
+        r = json.loads(reply.decode('utf8'))
+        if isinstance(r, dict):
+            raise ShardError('Shard error: %s' % r.get('error'))
+        return r
+
+    def stealth_addrs(self):
+        """Return the StealthAddress's the shard serves"""
+        send_frame(self.sock, b'A')
+        return [stealthaddress.StealthAddress(s) for s in self._recv_json()]
+
+    def send_scan(self, entries):
+        """Send packed entries to scan; see recv_scan()"""
+        send_frame(self.sock, b'S' + b''.join(entries))
+
+    def recv_scan(self):
+        """Receive the reply to send_scan()"""
+        return self._recv_json()
+
+    def close(self):
+        self.sock.close()
+
+
+class ShardDispatcher(object):
+    """Routes notifications to the shards owning matching addresses
+
+    clients - ShardClient's, one per shard
+    """
+
+    def __init__(self, clients):
+        self.clients = list(clients)
+        self.routes = stealthaddress.prefix.PrefixIndex()
+        for i, client in enumerate(self.clients):
+            for stealth_addr in client.stealth_addrs():
+                self.routes.add(stealth_addr, i)
+
+    def scan_block(self, height, block, block_hash=None):
+        """Scan a block, returning a list of StoredPayment's
+
+        Entries are sent to every shard at once, so shards on different
+        processes or nodes work on the block concurrently. Every entry carries
+        the outputs of its transaction, so payments are found wherever their
+        output is, just as with StealthScanner.
+        """
+        if block_hash is None:
+            block_hash = bitcoin.core.Hash(block.get_header().serialize())
+
+        entries = []
+        routed = [[] for client in self.clients]
+        for tx in block.vtx:
+            outputs = None
+            for record in stealthaddress.notifyindex.iter_tx_notification_records(height, tx):
+                unpacked = next(stealthaddress.notifyindex.iter_unpack_records(record))
+                shards = set(self.routes.candidates(unpacked[4]))
+                if not shards:
+                    continue
+                if outputs is None:
+                    outputs = pack_outputs(tx)
+                for shard in shards:
+                    routed[shard].append(len(entries))
+                entries.append((record + outputs, unpacked))
+
+        busy = [i for i, idxs in enumerate(routed) if idxs]
+        for i in busy:
+            self.clients[i].send_scan(entries[j][0] for j in routed[i])
+
+        found = []
+        for i in busy:
+            for d in self.clients[i].recv_scan():
+                j = routed[i][d['i']]
+                txid, ephem_pubkey = entries[j][1][1], entries[j][1][3]
+                found.append(((j, d['n']),
+                              StoredPayment(txid, d['n'], height, block_hash, d['nValue'],
+                                            x(d['scriptPubKey']),
+                                            None if d['redeemScript'] is None else x(d['redeemScript']),
+                                            ephem_pubkey, x(d['shared_secret']),
+                                            x(d['scan_pubkey']), d['stealth_addr'],
+                                            None, None)))
+        found.sort(key=lambda f: f[0])
+        return [payment for i, payment in found]
+
+    def scan(self, blocks):
+        """Scan (height, CBlock) tuples, yielding StoredPayment's in block order"""
+        for height, block in blocks:
+            for payment in self.scan_block(height, block):
+                yield payment
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _serve_local(sock, inherited_socks, stealth_scan_secret_strs):
+    # A forked worker inherits the dispatcher's end of its own and of earlier
+    # shards' connections; holding on to them would keep those open after the
+    # dispatcher closes them.
+    for inherited_sock in inherited_socks:
+        inherited_sock.close()
+    ShardServer(stealthaddress.StealthScanSecret(s) for s in stealth_scan_secret_strs).serve_connection(sock)
+
+class ShardedScanner(ShardDispatcher):
+    """ShardDispatcher with every shard in a local worker process
+
+    stealth_scan_secrets - Iterable of StealthScanSecret's
+    shards               - Number of shards; defaults to the number of CPUs
+    """
+
+    def __init__(self, stealth_scan_secrets, shards=None):
+        if shards is None:
+            shards = multiprocessing.cpu_count()
+
+        self.processes = []
+        clients = []
+        try:
+            for shard_secrets in partition(stealth_scan_secrets, shards):
+                if not shard_secrets:
+                    continue
+                parent_sock, child_sock = socket.socketpair()
+                process = multiprocessing.Process(target=_serve_local, daemon=True,
+                                                  args=(child_sock,
+                                                        [client.sock for client in clients] + [parent_sock],
+                                                        [str(s) for s in shard_secrets]))
+                process.start()
+                child_sock.close()
+                self.processes.append(process)
+                clients.append(ShardClient(parent_sock))
+            super().__init__(clients)
+        except BaseException:
+            for client in clients:
+                client.close()
+            raise
+
+    def close(self):
+        """Close the connections, letting the worker processes exit"""
+        super().close()
+        for process in self.processes:
+            process.join()
@@ -0,0 +1,293 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""Persistent store of found stealth payments
+
+PaymentStore keeps the payments a scan found in an SQLite database, indexed
+for the usual queries: by scan pubkey, by stealth address, by block range, and
+unspent only. Payments are added in batches, each batch a single transaction,
+and are marked spent in bulk by feeding the store the blocks that spend them.
+
+Blocks at the chain tip are added with connect_block() instead, which also
+writes a journal entry recording the payments the block added and the ones
+it spent. disconnect_block() uses it to undo the last block after a reorg,
+so a reorg costs as much as its depth. Only the last journal_depth blocks
+are journaled.
+
+Scan secrets are never stored; payments are returned as StoredPayment's that
+can be turned back into StealthPayment's given the matching scan secret. The
+shared secrets are stored however, and together with the spend secret they
+are enough to spend a payment, so the database is created readable by the
+owner only.
+"""
+
+import collections
+import os
+import sqlite3
+import struct
+
+import bitcoin.core
+import bitcoin.core.key
+import bitcoin.core.script
+
+import stealthaddress
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS payments (
+    txid          BLOB NOT NULL,
+    n             INTEGER NOT NULL,
+    height        INTEGER NOT NULL,
+    block_hash    BLOB NOT NULL,
+    nValue        INTEGER NOT NULL,
+    scriptPubKey  BLOB NOT NULL,
+    redeemScript  BLOB,
+    ephem_pubkey  BLOB NOT NULL,
+    shared_secret BLOB NOT NULL,
+    scan_pubkey   BLOB NOT NULL,
+    stealth_addr  TEXT NOT NULL,
+    spent_txid    BLOB,
+    spent_height  INTEGER,
+    PRIMARY KEY (txid, n)
+);
+CREATE INDEX IF NOT EXISTS payments_scan_pubkey ON payments (scan_pubkey, height);
+CREATE INDEX IF NOT EXISTS payments_stealth_addr ON payments (stealth_addr, height);
+CREATE INDEX IF NOT EXISTS payments_height ON payments (height);
+CREATE INDEX IF NOT EXISTS payments_unspent ON payments (height) WHERE spent_txid IS NULL;
+CREATE TABLE IF NOT EXISTS journal (
+    height     INTEGER PRIMARY KEY,
+    block_hash BLOB NOT NULL,
+    prev_hash  BLOB NOT NULL,
+    added      BLOB NOT NULL,
+    spent      BLOB NOT NULL
+);
+'''
+
+# Journal entries list outpoints as packed (txid, n)
+_OUTPOINT = struct.Struct('<32sI')
+
+DEFAULT_JOURNAL_DEPTH = 100
+
+class PaymentStoreError(Exception):
+    pass
+
+_COLUMNS = ('txid, n, height, block_hash, nValue, scriptPubKey, redeemScript, ephem_pubkey, '
+            'shared_secret, scan_pubkey, stealth_addr, spent_txid, spent_height')
+
+_INSERT = 'INSERT OR IGNORE INTO payments (%s) VALUES (%s)' % (_COLUMNS, ', '.join('?' * 13))
+
+def _payment_row(height, block_hash, payment):
+    return (payment.outpoint.hash, payment.outpoint.n, height, block_hash,
+            payment.nValue, bytes(payment.scriptPubKey),
+            None if payment.redeemScript is None else bytes(payment.redeemScript),
+            bytes(payment.ephem_pubkey), payment.shared_secret,
+            bytes(payment.stealth_scan_secret.scan_pubkey), str(payment.stealth_addr),
+            None, None)
+
+class StoredPayment(collections.namedtuple('StoredPayment', _COLUMNS)):
+    """A payment as stored in a PaymentStore"""
+
+    __slots__ = ()
+
+    @property
+    def outpoint(self):
+        return bitcoin.core.COutPoint(self.txid, self.n)
+
+    @property
+    def is_spent(self):
+        return self.spent_txid is not None
+
+    def to_payment(self, stealth_scan_secret):
+        """Return a StealthPayment, given the scan secret it was found with"""
+        if stealth_scan_secret.scan_pubkey != self.scan_pubkey:
+            raise ValueError('Scan secret does not match the payment')
+        return stealthaddress.StealthPayment(
+                    self.outpoint, self.nValue,
+                    bitcoin.core.script.CScript(self.scriptPubKey),
+                    None if self.redeemScript is None else bitcoin.core.script.CScript(self.redeemScript),
+                    bitcoin.core.key.CPubKey(self.ephem_pubkey), self.shared_secret,
+                    stealth_scan_secret)
+
+class PaymentStore(object):
+    """SQLite-backed store of found stealth payments
+
+    path          - Database file, created if it doesn't exist; ':memory:'
+                    for a temporary in-memory store
+    journal_depth - Number of blocks connect_block() keeps undo entries for
+    """
+
+    def __init__(self, path, journal_depth=DEFAULT_JOURNAL_DEPTH):
+        self.path = path
+        self.journal_depth = journal_depth
+        if path != ':memory:' and not os.path.exists(path):
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        self._db = sqlite3.connect(path)
+        self._db.executescript(_SCHEMA)
+
+    def add_many(self, payments):
+        """Add (height, block_hash, StealthPayment) tuples in one transaction
+
+        Such as yielded by rescan.rescan(). Payments already in the store are
+        left as they are, so overlapping rescans are harmless. Returns the
+        number of payments added.
+        """
+        with self._db:
+            before = self._db.total_changes
+            self._db.executemany(_INSERT, (_payment_row(*p) for p in payments))
+            return self._db.total_changes - before
+
+    def add(self, height, block_hash, payment):
+        """Add a single StealthPayment; see add_many()"""
+        return self.add_many([(height, block_hash, payment)])
+
+    @staticmethod
+    def _spend_rows(height, txs):
+        if isinstance(txs, bitcoin.core.CBlock):
+            txs = txs.vtx
+
+        rows = []
+        for tx in txs:
+            if tx.is_coinbase():
+                continue
+            txid = bitcoin.core.Hash(tx.serialize())
+            for txin in tx.vin:
+                rows.append((txid, height, txin.prevout.hash, txin.prevout.n))
+        return rows
+
+    def mark_spent(self, height, txs):
+        """Mark every payment spent by txs as spent at height
+
+        txs may be a CBlock or an iterable of CTransaction's. All updates are
+        done in one transaction. Returns the number of payments marked spent.
+        """
+        rows = self._spend_rows(height, txs)
+        with self._db:
+            before = self._db.total_changes
+            self._db.executemany('UPDATE payments SET spent_txid = ?, spent_height = ? '
+                                 'WHERE txid = ? AND n = ? AND spent_txid IS NULL', rows)
+            return self._db.total_changes - before
+
+    def tip(self):
+        """Return (height, block_hash) of the last connected block, or None"""
+        return self._db.execute('SELECT height, block_hash FROM journal '
+                                'ORDER BY height DESC LIMIT 1').fetchone()
+
+    def block_hash(self, height):
+        """Return the hash of the connected block at height, or None
+
+        The hash of the block just below the oldest journaled one is known
+        too, from that block's hashPrevBlock.
+        """
+        row = self._db.execute('SELECT block_hash FROM journal WHERE height = ?', (height,)).fetchone()
+        if row is None:
+            row = self._db.execute('SELECT prev_hash FROM journal WHERE height = ?',
+                                   (height + 1,)).fetchone()
+        return None if row is None else row[0]
+
+    def connect_block(self, height, block, payments):
+        """Add the payments found in a block, and mark the ones it spends
+
+        height   - Height of the block
+        block    - The CBlock, which must connect to the current tip
+        payments - StealthPayment's found in the block
+
+        Everything, including the journal entry disconnect_block() undoes the
+        block with, is written in one transaction. Returns the number of
+        payments added.
+        """
+        tip = self.tip()
+        if tip is not None and (height != tip[0] + 1 or block.hashPrevBlock != tip[1]):
+            raise PaymentStoreError('Block at height %d does not connect to the tip at height %d' %
+                                    (height, tip[0]))
+        block_hash = bitcoin.core.Hash(block.get_header().serialize())
+
+        added = []
+        spent = []
+        with self._db:
+            for payment in payments:
+                cursor = self._db.execute(_INSERT, _payment_row(height, block_hash, payment))
+                if cursor.rowcount:
+                    added.append(_OUTPOINT.pack(payment.outpoint.hash, payment.outpoint.n))
+
+            for row in self._spend_rows(height, block):
+                cursor = self._db.execute('UPDATE payments SET spent_txid = ?, spent_height = ? '
+                                          'WHERE txid = ? AND n = ? AND spent_txid IS NULL', row)
+                if cursor.rowcount:
+                    spent.append(_OUTPOINT.pack(row[2], row[3]))
+
+            self._db.execute('INSERT INTO journal (height, block_hash, prev_hash, added, spent) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             (height, block_hash, block.hashPrevBlock, b''.join(added), b''.join(spent)))
+            self._db.execute('DELETE FROM journal WHERE height <= ?', (height - self.journal_depth,))
+        return len(added)
+
+    def disconnect_block(self):
+        """Undo the last connected block
+
+        Removes the payments it added and marks the ones it spent unspent
+        again. Returns the height of the block undone.
+        """
+        row = self._db.execute('SELECT height, added, spent FROM journal '
+                               'ORDER BY height DESC LIMIT 1').fetchone()
+        if row is None:
+            raise PaymentStoreError('No journaled block to disconnect')
+        height, added, spent = row
+
+        with self._db:
+            self._db.executemany('DELETE FROM payments WHERE txid = ? AND n = ?',
+                                 _OUTPOINT.iter_unpack(added))
+            self._db.executemany('UPDATE payments SET spent_txid = NULL, spent_height = NULL '
+                                 'WHERE txid = ? AND n = ?',
+                                 _OUTPOINT.iter_unpack(spent))
+            self._db.execute('DELETE FROM journal WHERE height = ?', (height,))
+        return height
+
+    def find(self, scan_pubkey=None, stealth_addr=None,
+             start_height=None, end_height=None, unspent=False):
+        """Return the StoredPayment's matching every criteria given, in height order
+
+        scan_pubkey  - Only payments found with this scan pubkey
+        stealth_addr - Only payments to this StealthAddress
+        start_height - Only payments at or above this height
+        end_height   - Only payments below this height
+        unspent      - Only payments not marked spent
+        """
+        where = []
+        args = []
+        if scan_pubkey is not None:
+            where.append('scan_pubkey = ?')
+            args.append(bytes(scan_pubkey))
+        if stealth_addr is not None:
+            where.append('stealth_addr = ?')
+            args.append(str(stealth_addr))
+        if start_height is not None:
+            where.append('height >= ?')
+            args.append(start_height)
+        if end_height is not None:
+            where.append('height < ?')
+            args.append(end_height)
+        if unspent:
+            where.append('spent_txid IS NULL')
+
+        sql = 'SELECT %s FROM payments' % _COLUMNS
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY height, txid, n'
+        return [StoredPayment(*row) for row in self._db.execute(sql, args)]
+
+    def get(self, outpoint):
+        """Return the StoredPayment at a COutPoint, or None"""
+        row = self._db.execute('SELECT %s FROM payments WHERE txid = ? AND n = ?' % _COLUMNS,
+                               (outpoint.hash, outpoint.n)).fetchone()
+        return None if row is None else StoredPayment(*row)
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM payments').fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
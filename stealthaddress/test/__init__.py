@@ -1,2 +1,42 @@
 # Distributed under the MIT/X11 software license, see the accompanying
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+from bitcoin.core import Hash, CBlock, CTransaction, CTxOut
+from bitcoin.wallet import CBitcoinSecret
+
+from stealthaddress import StealthAddress, StealthScanSecret, make_notification_scriptPubKey
+
+def make_key(seed):
+    """Make a deterministic CBitcoinSecret from a seed"""
+    return CBitcoinSecret.from_secret_bytes(Hash(seed))
+
+def make_payment_tx(addr, ephem_key, nValue=1):
+    """Make a transaction paying nValue to addr"""
+    shared_secret = ephem_key._cec_key.get_raw_ecdh_key(addr.scan_pubkey._cec_key)
+    scriptPubKey, redeemScript = addr.make_payee_scriptPubKey(shared_secret)
+    return CTransaction(vout=[CTxOut(0, make_notification_scriptPubKey(ephem_key.pub)),
+                              CTxOut(nValue, scriptPubKey)])
+
+def make_scan_secret(seed, prefix_length=0, prefix=b''):
+    """Make a deterministic StealthScanSecret from a seed"""
+    scan_key = make_key(seed)
+    addr = StealthAddress.from_pubkeys(scan_key.pub, prefix_length=prefix_length, prefix=prefix)
+    return StealthScanSecret.from_secret_bytes(scan_key[0:32], addr)
+
+def make_block(prev_hash, nNonce, vtx):
+    """Make a block of transactions vtx on top of prev_hash"""
+    return CBlock(hashPrevBlock=prev_hash,
+                  hashMerkleRoot=CBlock.calc_merkle_root_from_hashes([Hash(tx.serialize()) for tx in vtx]),
+                  nTime=0, nBits=0, nNonce=nNonce, vtx=vtx)
+
+def make_blocks(addrs, start_height=0, prev_hash=b'\x00'*32):
+    """Make a chain of one block per address, each paying that address
+
+    The block at height i pays i. Returns a list of (height, CBlock)
+    """
+    blocks = []
+    for i, addr in enumerate(addrs, start_height):
+        block = make_block(prev_hash, i, [make_payment_tx(addr, make_key(b'ephem%d' % i), i)])
+        prev_hash = Hash(block.get_header().serialize())
+        blocks.append((i, block))
+    return blocks
@@ -0,0 +1,17 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import unittest
+
+from stealthaddress.bench import *
+
+class Test_bench(unittest.TestCase):
+    def test_run_and_compare(self):
+        results = run(scan_key_counts=(3,), repeat=1, names=['recover'])
+        self.assertEqual(list(results['benchmarks']), ['recover_3'])
+        self.assertGreater(results['benchmarks']['recover_3']['ops_per_sec'], 0)
+
+        baseline = {'benchmarks': {'recover_3': {'ops_per_sec': results['benchmarks']['recover_3']['ops_per_sec'] * 2},
+                                   'missing': {'ops_per_sec': 1}}}
+        self.assertEqual([name for name, r, b in compare(results, baseline, 0.2)], ['recover_3'])
+        self.assertEqual(compare(results, baseline, 0.6), [])
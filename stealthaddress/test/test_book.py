@@ -0,0 +1,53 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import os
+import tempfile
+import unittest
+
+from stealthaddress import StealthAddress
+from stealthaddress.book import *
+
+from .test_stealth import load_test_vector
+
+class Test_StealthAddressBook(unittest.TestCase):
+    def setUp(self):
+        self.addrs = [StealthAddress(valid) for comment, valid, attrs in load_test_vector('valid.json')]
+
+    def test_roundtrip(self):
+        book = StealthAddressBook(self.addrs)
+        self.assertEqual(len(book), len(self.addrs))
+        for i, addr in enumerate(self.addrs):
+            self.assertEqual(book[i], addr)
+            self.assertEqual(book[i].all_spend_pubkeys, addr.all_spend_pubkeys)
+        self.assertEqual(list(book), self.addrs)
+
+    def test_lookups(self):
+        book = StealthAddressBook(self.addrs)
+        for addr in self.addrs:
+            self.assertEqual(book.find_by_scan_pubkey(addr.scan_pubkey),
+                             [i for i, other in enumerate(self.addrs) if other.scan_pubkey == addr.scan_pubkey])
+
+        for prefix in (0, 0x80000000, 0xffffffff, 0x12345678):
+            self.assertEqual(book.find_by_prefix(prefix),
+                             [i for i, addr in enumerate(self.addrs) if addr.matches_prefix(prefix)])
+
+    def test_save_load(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            StealthAddressBook(self.addrs).save(path)
+            book = StealthAddressBook.load(path)
+            self.assertEqual(list(book), self.addrs)
+            self.assertEqual(book.find_by_scan_pubkey(self.addrs[0].scan_pubkey)[0], 0)
+
+            # Adding to a loaded book copies it out of the mapping
+            book.add(self.addrs[0])
+            self.assertEqual(book[-1], self.addrs[0])
+
+            with open(path, 'r+b') as fd:
+                fd.truncate(os.path.getsize(path) - 1)
+            with self.assertRaises(StealthAddressBookError):
+                StealthAddressBook.load(path)
+        finally:
+            os.unlink(path)
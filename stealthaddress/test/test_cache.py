@@ -0,0 +1,44 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import unittest
+
+from stealthaddress import StealthAddress, StealthAddressError
+from stealthaddress.cache import StealthAddressCache
+
+from . import make_key
+
+ADDRS = [str(StealthAddress.from_pubkeys(make_key(b'scan%d' % i).pub)) for i in range(3)]
+
+class Test_StealthAddressCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = StealthAddressCache(maxsize=2)
+        addr = cache.get(ADDRS[0])
+        self.assertEqual(addr, StealthAddress(ADDRS[0]))
+        self.assertIs(cache(ADDRS[0]), addr)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        cache = StealthAddressCache(maxsize=2)
+        cache.get(ADDRS[0])
+        cache.get(ADDRS[1])
+        cache.get(ADDRS[0])
+        cache.get(ADDRS[2])
+        self.assertIn(ADDRS[0], cache)
+        self.assertNotIn(ADDRS[1], cache)
+        self.assertEqual(cache.stats(), {'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 3, 'evictions': 1})
+
+    def test_fifo_eviction(self):
+        cache = StealthAddressCache(maxsize=2, eviction='fifo')
+        cache.get(ADDRS[0])
+        cache.get(ADDRS[1])
+        cache.get(ADDRS[0])
+        cache.get(ADDRS[2])
+        self.assertNotIn(ADDRS[0], cache)
+        self.assertIn(ADDRS[1], cache)
+
+    def test_invalid_not_cached(self):
+        cache = StealthAddressCache()
+        with self.assertRaises(StealthAddressError):
+            cache.get('5rMUosj')
+        self.assertEqual(len(cache), 0)
@@ -0,0 +1,111 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from bitcoin.core import Hash
+
+from stealthaddress.checkpoint import *
+
+from . import make_scan_secret, make_blocks
+
+class Test_ScanSession(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'session.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_resume_and_backfill(self):
+        secret1 = make_scan_secret(b'scan1')
+        secret2 = make_scan_secret(b'scan2')
+        blocks = make_blocks([secret1.stealth_addr, secret2.stealth_addr, secret1.stealth_addr])
+
+        session = ScanSession(self.path, checkpoint_interval=2)
+        session.add(secret1)
+        self.assertEqual(session.next_height, 0)
+
+        # Crash while scanning the third block; a checkpoint was written after
+        # the second
+        found = []
+        for payment in session.scan(blocks):
+            found.append(payment.nValue)
+            if len(found) == 2:
+                break
+        self.assertEqual(found, [0, 2])
+        session = ScanSession(self.path)
+        self.assertEqual(session.next_height, 2)
+        self.assertEqual(session.height, 1)
+        self.assertEqual(session.block_hash, Hash(blocks[1][1].get_header().serialize()))
+        self.assertEqual([p.nValue for h, bh, p in session.payments], [0])
+
+        self.assertEqual([p.nValue for p in session.scan(blocks[2:])], [2])
+
+        # Adding a scan key only backfills that key
+        session = ScanSession(self.path)
+        session.add(secret2)
+        self.assertEqual(session.next_height, 0)
+        self.assertEqual([p.nValue for p in session.scan(blocks)], [1])
+        self.assertEqual(session.next_height, 3)
+
+        session = ScanSession(self.path)
+        self.assertEqual(sorted((h, p.nValue, p.stealth_scan_secret) for h, bh, p in session.payments),
+                         [(0, 0, secret1), (1, 1, secret2), (2, 2, secret1)])
+
+    def test_skipped_blocks(self):
+        session = ScanSession(self.path)
+        session.add(make_scan_secret(b'scan1'))
+        blocks = make_blocks([make_scan_secret(b'scan1').stealth_addr] * 2)
+        with self.assertRaises(ScanSessionError):
+            session.scan_block(*blocks[1])
+
+    def test_blocks_must_connect(self):
+        secret1 = make_scan_secret(b'scan1')
+        secret2 = make_scan_secret(b'scan2')
+        chain = make_blocks([secret1.stealth_addr] * 3)
+        fork = make_blocks([secret2.stealth_addr] * 3)
+
+        session = ScanSession(self.path)
+        session.add(secret1)
+        list(session.scan(chain[0:2]))
+        session.checkpoint()
+
+        # Checked against the stored block hash on resume
+        session = ScanSession(self.path)
+        with self.assertRaises(ScanSessionError):
+            session.scan_block(*fork[2])
+        with self.assertRaises(ScanSessionError):
+            session.scan_block(*fork[1])
+        self.assertEqual(session.next_height, 2)
+        self.assertEqual([p.nValue for p in session.scan(chain[2:])], [2])
+
+        # And against the previous block during a backfill
+        session.add(secret2)
+        session.scan_block(*chain[0])
+        with self.assertRaises(ScanSessionError):
+            session.scan_block(*fork[1])
+
+    def test_rewind(self):
+        secret1 = make_scan_secret(b'scan1')
+        chain = make_blocks([secret1.stealth_addr] * 3)
+        fork = make_blocks([make_scan_secret(b'scan2').stealth_addr, secret1.stealth_addr], start_height=1,
+                           prev_hash=Hash(chain[0][1].get_header().serialize()))
+
+        session = ScanSession(self.path)
+        session.add(secret1)
+        list(session.scan(chain))
+        with self.assertRaises(ScanSessionError):
+            session.scan_block(*fork[1])
+        with self.assertRaises(ScanSessionError):
+            session.rewind(3, None)
+
+        session.rewind(0, Hash(chain[0][1].get_header().serialize()))
+        self.assertEqual(session.next_height, 1)
+        self.assertEqual([h for h, bh, p in session.payments], [0])
+        self.assertEqual([p.nValue for p in session.scan(fork)], [2])
+        self.assertEqual([bh for h, bh, p in ScanSession(self.path).payments],
+                         [Hash(b.get_header().serialize()) for h, b in (chain[0], fork[1])])
@@ -0,0 +1,54 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import unittest
+
+from bitcoin.core import x, Hash
+from bitcoin.wallet import CBitcoinSecret
+
+from stealthaddress import StealthAddress
+from stealthaddress.ecc import *
+
+from . import make_key
+
+class Test_ecc(unittest.TestCase):
+    def test_compress_roundtrip(self):
+        for seed in (b'a', b'b', b'c'):
+            pubkey = make_key(seed).pub
+            self.assertEqual(compress(decompress(pubkey)), pubkey)
+
+        with self.assertRaises(ECCError):
+            decompress(x('0478d430274f8c5ec1321338151e9f27f4c676a008bdf8638d07c0b6be9ab35c71'))
+
+    def test_mul_G(self):
+        self.assertEqual(mul_G(1), G)
+        self.assertIsNone(mul_G(N))
+        self.assertEqual(add(mul_G(N - 1), G), None)
+        for seed in (b'a', b'b', b'c'):
+            key = make_key(seed)
+            self.assertEqual(compress(mul_G(int.from_bytes(key[0:32], 'big'))), key.pub)
+
+    def test_add(self):
+        self.assertEqual(add(G, G), mul_G(2))
+        self.assertEqual(add(mul_G(3), mul_G(5)), mul_G(8))
+        self.assertEqual(add(None, G), G)
+        self.assertEqual(add_mul_G(G, 7), mul_G(8))
+
+class Test_derive_pubkey(unittest.TestCase):
+    def test_matches_derived_secret(self):
+        spend_key = make_key(b'spend')
+        shared_secret = b'\x42' * 32
+
+        derived_pubkey = StealthAddress.derive_pubkey(spend_key.pub, shared_secret)
+
+        secret = (int.from_bytes(spend_key[0:32], 'big')
+                  + StealthAddress.derive_tweak(shared_secret)) % N
+        derived_key = CBitcoinSecret.from_secret_bytes(secret.to_bytes(32, 'big'))
+        self.assertEqual(derived_pubkey, derived_key.pub)
+        self.assertTrue(derived_pubkey.is_fullyvalid)
+
+    def test_derive_pubkeys(self):
+        pairs = [(make_key(b'spend%d' % i).pub, Hash(b'shared%d' % i)) for i in range(10)]
+        self.assertEqual(StealthAddress.derive_pubkeys(pairs),
+                         [StealthAddress.derive_pubkey(*pair) for pair in pairs])
+        self.assertEqual(StealthAddress.derive_pubkeys([]), [])
@@ -0,0 +1,52 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import unittest
+
+from bitcoin.core import CBlock
+
+from stealthaddress import StealthScanner
+from stealthaddress.ecdhpool import *
+
+from . import make_key, make_payment_tx, make_scan_secret
+
+class Test_ECDHExecutor(unittest.TestCase):
+    def test_map(self):
+        scan_keys = [make_key(b'scan%d' % i) for i in range(3)]
+        ephem_keys = [make_key(b'ephem%d' % i) for i in range(20)]
+        items = [(scan_key[0:32], ephem_key.pub) for ephem_key in ephem_keys for scan_key in scan_keys]
+        items.append((scan_keys[0][0:32], b'\x02' + b'\xff'*32))
+        expected = [scan_key._cec_key.get_raw_ecdh_key(ephem_key.pub._cec_key)
+                    for ephem_key in ephem_keys for scan_key in scan_keys] + [None]
+
+        for processes in (1, 2):
+            with ECDHExecutor(processes) as executor:
+                self.assertEqual(executor.map(items), expected)
+                self.assertEqual(executor.map([]), [])
+
+    def test_chunk_size(self):
+        executor = ECDHExecutor(1)
+        executor.processes = 4
+        self.assertEqual(executor.chunk_size(1), MIN_CHUNK_SIZE)
+        self.assertEqual(executor.chunk_size(1600), 100)
+        self.assertEqual(executor.chunk_size(10**6), MAX_CHUNK_SIZE)
+
+    def test_scan(self):
+        secrets = [make_scan_secret(b'scan%d' % i) for i in range(3)]
+        vtx = [make_payment_tx(secrets[i % 3].stealth_addr, make_key(b'ephem%d' % i), i) for i in range(12)]
+        block = CBlock(hashPrevBlock=b'\x00'*32, hashMerkleRoot=b'\x00'*32,
+                       nTime=0, nBits=0, nNonce=0, vtx=vtx)
+
+        expected = [(p.outpoint, p.shared_secret) for p in StealthScanner(secrets).scan(block)]
+        self.assertEqual(len(expected), 12)
+        with ECDHExecutor(2) as executor:
+            scanner = StealthScanner(secrets, ecdh_executor=executor)
+
+            # The prefix stage runs once per block, all in candidates_many()
+            calls = []
+            candidates_many = scanner.prefix_index.candidates_many
+            scanner.prefix_index.candidates_many = lambda prefixes: calls.append(prefixes) or candidates_many(prefixes)
+            scanner.prefix_index.candidates = None
+
+            self.assertEqual([(p.outpoint, p.shared_secret) for p in scanner.scan(block)], expected)
+            self.assertEqual(len(calls), 1)
@@ -0,0 +1,114 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from bitcoin.core import Hash, COutPoint, CTransaction, CTxIn, CTxOut
+
+from stealthaddress.follow import *
+from stealthaddress.notifyindex import NotificationIndex, NotificationIndexWriter
+from stealthaddress.store import PaymentStore, PaymentStoreError
+
+from . import make_block, make_blocks, make_scan_secret
+
+def block_hash(block):
+    return Hash(block.get_header().serialize())
+
+class Test_ChainFollower(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.dir, 'payments.sqlite')
+        self.index_path = os.path.join(self.dir, 'notifications.idx')
+
+        self.secret1 = make_scan_secret(b'scan1')
+        self.secret2 = make_scan_secret(b'scan2')
+
+        # Three blocks paying secret1, then one spending the first payment
+        self.chain = make_blocks([self.secret1.stealth_addr] * 3)
+        txid = Hash(self.chain[0][1].vtx[0].serialize())
+        spend = CTransaction(vin=[CTxIn(COutPoint(txid, 1))], vout=[CTxOut(0, b'')])
+        self.chain.append((3, make_block(block_hash(self.chain[2][1]), 3, [spend])))
+        self.spent_outpoint = COutPoint(txid, 1)
+
+        # Fork off after height 1
+        self.fork = make_blocks([self.secret2.stealth_addr, self.secret1.stealth_addr],
+                                start_height=2, prev_hash=block_hash(self.chain[1][1]))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_reorg(self):
+        store = PaymentStore(self.store_path, journal_depth=3)
+        index = NotificationIndexWriter(self.index_path)
+        follower = ChainFollower(store, [self.secret1], index=index)
+
+        self.assertEqual([p.nValue for p in follower.add_blocks(self.chain)], [0, 1, 2])
+        self.assertEqual(store.tip(), (3, block_hash(self.chain[3][1])))
+        self.assertEqual(store.get(self.spent_outpoint).spent_height, 3)
+
+        # Connecting the fork undoes heights 2 and 3, including the spend
+        self.assertEqual(follower.add_block(*self.fork[0]), [])
+        self.assertEqual([p.height for p in store.find()], [0, 1])
+        self.assertFalse(store.get(self.spent_outpoint).is_spent)
+        self.assertEqual([p.nValue for p in follower.add_block(*self.fork[1])], [3])
+        self.assertEqual([(p.height, p.block_hash) for p in store.find(unspent=True)],
+                         [(0, block_hash(self.chain[0][1])), (1, block_hash(self.chain[1][1])),
+                          (3, block_hash(self.fork[1][1]))])
+        self.assertEqual(follower.stats(),
+                         {'height': 3, 'reorgs': 1, 'blocks_undone': 2, 'max_reorg_depth': 2})
+
+        # The index followed the reorg too
+        index.close()
+        self.assertEqual([n.height for n in NotificationIndex(self.index_path)], [0, 1, 2, 3])
+        self.assertEqual([h for h, p in NotificationIndex(self.index_path).scan([self.secret2])], [2])
+
+        # Blocks from the old branch no longer connect
+        with self.assertRaises(ReorgError):
+            follower.add_block(*self.chain[3])
+        store.close()
+
+        # The journal survives reopening, but only covers the last 3 blocks
+        store = PaymentStore(self.store_path, journal_depth=3)
+        follower = ChainFollower(store, [self.secret1])
+        with self.assertRaises(ReorgError):
+            follower.add_block(*make_blocks([self.secret1.stealth_addr], prev_hash=b'\x01'*32)[0])
+        with self.assertRaises(ReorgError):
+            follower.rewind(-1)
+        self.assertEqual(follower.rewind(0), 3)
+        self.assertEqual([p.height for p in store.find()], [0])
+        with self.assertRaises(PaymentStoreError):
+            store.disconnect_block()
+        store.close()
+
+    def test_restart(self):
+        store = PaymentStore(self.store_path)
+        index = NotificationIndexWriter(self.index_path)
+        follower = ChainFollower(store, [self.secret1], index=index)
+        self.assertEqual(follower.next_height, 0)
+        list(follower.add_blocks(self.chain[0:3]))
+
+        # Redelivering the tip is a no-op, not a reorg
+        self.assertEqual(follower.add_block(*self.chain[2]), [])
+        self.assertEqual(follower.stats()['reorgs'], 0)
+        self.assertEqual(len(store), 3)
+        store.close()
+        index.close()
+
+        # The reopened index rolled back its last block
+        store = PaymentStore(self.store_path)
+        index = NotificationIndexWriter(self.index_path)
+        follower = ChainFollower(store, [self.secret1], index=index)
+        self.assertEqual(follower.next_height, 2)
+        with self.assertRaises(ReorgError):
+            follower.add_block(*self.chain[3])
+
+        self.assertEqual(list(follower.add_blocks(self.chain[2:])), [])
+        self.assertEqual(follower.stats(), {'height': 3, 'reorgs': 0, 'blocks_undone': 0,
+                                            'max_reorg_depth': 0})
+        index.close()
+        self.assertEqual([n.height for n in NotificationIndex(self.index_path)], [0, 1, 2])
+        self.assertEqual([p.height for p in store.find()], [0, 1, 2])
+        store.close()
@@ -0,0 +1,100 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import threading
+import time
+import unittest
+
+from stealthaddress import (StealthAddress, StealthScanSecret, grind_notification_scriptPubKey,
+                            notification_prefix, parse_notification_scriptPubKey, pay, recover)
+from stealthaddress.grind import *
+
+from . import make_key
+
+class Test_Grinder(unittest.TestCase):
+    def setUp(self):
+        self.scan_key = make_key(b'scan')
+        self.ephem_pubkey = make_key(b'ephem').pub
+
+    def make_addr(self, prefix_length, prefix):
+        return StealthAddress.from_pubkeys(self.scan_key.pub, prefix_length=prefix_length, prefix=prefix)
+
+    def test_grind(self):
+        addr = self.make_addr(10, b'\xab\xc0')
+        for processes in (1, 2):
+            with Grinder(processes) as grinder:
+                scriptPubKey = grinder.grind(addr, self.ephem_pubkey)
+                self.assertTrue(addr.matches_prefix(notification_prefix(scriptPubKey)))
+                self.assertEqual(parse_notification_scriptPubKey(scriptPubKey)[1], self.ephem_pubkey)
+                if processes == 1:
+                    self.assertEqual(scriptPubKey,
+                                     grind_notification_scriptPubKey(addr, self.ephem_pubkey))
+
+                stats = grinder.stats()
+                self.assertEqual(stats['grinds'], 1)
+                self.assertGreater(stats['attempts'], 0)
+                self.assertGreater(stats['attempts_per_sec'], 0)
+
+    def test_no_prefix(self):
+        addr = self.make_addr(0, b'')
+        with Grinder(1) as grinder:
+            self.assertEqual(parse_notification_scriptPubKey(grinder.grind(addr, self.ephem_pubkey, 5)),
+                             (5, self.ephem_pubkey))
+
+    def test_exhausted(self):
+        addr = self.make_addr(32, b'\x00\x00\x00\x00')
+        for processes in (1, 2):
+            with Grinder(processes) as grinder:
+                self.assertIsNone(grinder.grind(addr, self.ephem_pubkey, max_nonce=RANGE_SIZE * 2))
+                self.assertEqual(grinder.attempts, RANGE_SIZE * 2 + 1)
+
+    def test_timeout(self):
+        addr = self.make_addr(32, b'\x00\x00\x00\x00')
+        for processes in (1, 2):
+            with Grinder(processes, timeout=0.2) as grinder:
+                with self.assertRaises(GrindError):
+                    grinder.grind(addr, self.ephem_pubkey)
+                self.assertLess(grinder.seconds, 5)
+
+    def test_cancel(self):
+        addr = self.make_addr(32, b'\x00\x00\x00\x00')
+        for processes in (1, 2):
+            with Grinder(processes) as grinder:
+                timer = threading.Timer(0.2, grinder.cancel)
+                timer.start()
+                with self.assertRaises(GrindError):
+                    grinder.grind(addr, self.ephem_pubkey)
+                timer.join()
+                self.assertLess(grinder.seconds, 5)
+
+    def test_cancel_concurrent(self):
+        # Cancelling one in-process grinder leaves another, in another thread, alone
+        addr = self.make_addr(32, b'\x00\x00\x00\x00')
+        with Grinder(1) as grinder1, Grinder(1) as grinder2:
+            results = {}
+            def run(name, grinder, max_nonce):
+                try:
+                    results[name] = grinder.grind(addr, self.ephem_pubkey, max_nonce=max_nonce)
+                except GrindError as err:
+                    results[name] = err
+            thread2 = threading.Thread(target=run, args=('exhausted', grinder2, RANGE_SIZE * 8))
+            thread2.start()
+            thread1 = threading.Thread(target=run, args=('cancelled', grinder1, 0xffffffff))
+            thread1.start()
+
+            time.sleep(0.1)
+            grinder1.cancel()
+            thread1.join()
+            thread2.join()
+
+            self.assertIsInstance(results['cancelled'], GrindError)
+            self.assertIsNone(results['exhausted'])
+            self.assertEqual(grinder2.attempts, RANGE_SIZE * 8 + 1)
+
+    def test_pay_with_grinder(self):
+        addr = self.make_addr(12, b'\x5a\x50')
+        secret = StealthScanSecret.from_secret_bytes(self.scan_key[0:32], addr)
+        with Grinder(2) as grinder:
+            tx = pay([(addr, 1)], grinder=grinder)
+        self.assertTrue(addr.matches_prefix(notification_prefix(tx.vout[0].scriptPubKey)))
+        self.assertEqual([p.nValue for p in recover(tx, [secret])], [1])
@@ -0,0 +1,93 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import concurrent.futures
+import threading
+import time
+import unittest
+
+from stealthaddress import StealthAddress, StealthScanSecret, pay, recover
+from stealthaddress.ecc import compress, mul_G
+from stealthaddress.keypool import EphemeralKeyPool
+
+from . import make_key
+
+class Test_EphemeralKeyPool(unittest.TestCase):
+    def test_fill_and_take(self):
+        pool = EphemeralKeyPool(maxsize=10, batch_size=4, start=False)
+        pool.fill()
+        self.assertEqual(len(pool), 10)
+
+        keys = pool.take(12)
+        self.assertEqual(len(keys), 12)
+        self.assertEqual(len(set(keys)), 12)
+        for ephem_secret, ephem_pubkey in keys:
+            self.assertEqual(compress(mul_G(int.from_bytes(ephem_secret, 'big'))), ephem_pubkey)
+
+        stats = pool.stats()
+        self.assertEqual((stats['taken'], stats['misses'], stats['generated'], stats['refills']),
+                         (12, 2, 10, 3))
+
+    def test_concurrent_refills_respect_maxsize(self):
+        pool = None
+        racing = []
+
+        class RacingExecutor(concurrent.futures.ThreadPoolExecutor):
+            # Fill the pool from another thread while the first batch is
+            # being generated
+            def submit(self, fn, *args):
+                if not racing:
+                    racing.append(True)
+                    t = threading.Thread(target=pool.fill)
+                    t.start()
+                    t.join()
+                return super().submit(fn, *args)
+
+        with RacingExecutor(1) as executor:
+            pool = EphemeralKeyPool(maxsize=10, batch_size=8, executor=executor, start=False)
+            pool.fill()
+        self.assertEqual(len(pool), 10)
+        self.assertEqual(pool.stats()['generated'], 10)
+
+    def test_background_refill(self):
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            pool = EphemeralKeyPool(maxsize=8, low_watermark=4, batch_size=8, executor=executor)
+            try:
+                deadline = time.time() + 10
+                while len(pool) < 8 and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(len(pool), 8)
+
+                pool.take(5)
+                deadline = time.time() + 10
+                while len(pool) < 8 and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(len(pool), 8)
+                self.assertEqual(pool.misses, 0)
+            finally:
+                pool.stop()
+
+    def test_low_watermark(self):
+        with self.assertRaises(ValueError):
+            EphemeralKeyPool(maxsize=8, low_watermark=0, start=False)
+        with self.assertRaises(ValueError):
+            EphemeralKeyPool(maxsize=8, low_watermark=9, start=False)
+
+        # The smallest watermark still gets the pool filled in the background
+        pool = EphemeralKeyPool(maxsize=4, low_watermark=1)
+        try:
+            deadline = time.time() + 10
+            while len(pool) < 4 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(len(pool), 4)
+        finally:
+            pool.stop()
+
+    def test_pay_with_pool(self):
+        scan_key = make_key(b'scan')
+        addr = StealthAddress.from_pubkeys(scan_key.pub)
+        pool = EphemeralKeyPool(maxsize=4, start=False)
+        pool.fill()
+        tx = pay([(addr, 1), (addr, 2)], ephem_keys=pool.take(2))
+        secret = StealthScanSecret.from_secret_bytes(scan_key[0:32], addr)
+        self.assertEqual(sorted(p.nValue for p in recover(tx, [secret])), [1, 2])
@@ -0,0 +1,60 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import asyncio
+import unittest
+
+from bitcoin.core import CTransaction, CTxOut
+from bitcoin.messages import msg_tx, msg_ping
+
+from stealthaddress import grind_notification_scriptPubKey, notification_prefix
+from stealthaddress.mempool import MempoolWatcher
+
+from . import make_key, make_payment_tx, make_scan_secret
+
+def make_ground_payment_tx(addr, prefix_addr, ephem_key, nValue):
+    """Make a transaction paying addr, with a notification matching prefix_addr"""
+    tx = make_payment_tx(addr, ephem_key, nValue)
+    return CTransaction(vout=[CTxOut(0, grind_notification_scriptPubKey(prefix_addr, ephem_key.pub)),
+                              tx.vout[1]])
+
+class Test_MempoolWatcher(unittest.TestCase):
+    def test_watch(self):
+        secret1 = make_scan_secret(b'scan1', prefix_length=8, prefix=b'\xa5')
+        secret2 = make_scan_secret(b'scan2')
+        addr1 = secret1.stealth_addr
+
+        msg = msg_tx()
+        msg.tx = make_ground_payment_tx(addr1, addr1, make_key(b'ephem1'), 1)
+        source = [msg, msg_ping(),
+                  make_payment_tx(secret2.stealth_addr, make_key(b'ephem2'), 2),
+                  CTransaction(vout=[CTxOut(3, b'')]),
+                  make_ground_payment_tx(addr1, addr1, make_key(b'ephem3'), 4),
+                  # Matches the prefix of secret1 without paying it
+                  make_ground_payment_tx(secret2.stealth_addr, addr1, make_key(b'ephem4'), 5)]
+
+        # The payment to secret2 is rejected by the inline prefix filter
+        self.assertFalse(addr1.matches_prefix(notification_prefix(source[2].vout[0].scriptPubKey)))
+
+        found = []
+        async def on_payment(payment):
+            found.append(payment.nValue)
+
+        async def main():
+            watcher = MempoolWatcher([secret1], on_payment, maxsize=2)
+            task = asyncio.ensure_future(watcher.run())
+            await watcher.feed(source)
+            await watcher.join()
+            task.cancel()
+
+            # Workers are cancelled, so the queue fills up
+            self.assertTrue(watcher.put_nowait(source[3]))
+            self.assertTrue(watcher.put_nowait(source[3]))
+            self.assertFalse(watcher.put_nowait(source[3]))
+            return watcher.stats()
+
+        stats = asyncio.run(main())
+        self.assertEqual(found, [1, 4])
+        self.assertEqual((stats['received'], stats['matched'], stats['payments'], stats['dropped'],
+                          stats['queue_depth']),
+                         (7, 3, 2, 1, 2))
@@ -0,0 +1,80 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import unittest
+
+from bitcoin.core import CTransaction, CTxOut
+
+from stealthaddress import StealthAddress, StealthScanSecret, StealthScanner
+from stealthaddress.ecdhpool import ECDHExecutor
+from stealthaddress.metrics import *
+
+from . import make_key, make_payment_tx, make_scan_secret
+
+class Test_Metrics(unittest.TestCase):
+    def make_txs(self):
+        return [make_payment_tx(make_scan_secret(b'scan1').stealth_addr, make_key(b'ephem1'), 5),
+                make_payment_tx(make_scan_secret(b'scan2').stealth_addr, make_key(b'ephem2'), 6),
+                CTransaction(vout=[CTxOut(7, b'\x51')])]
+
+    def test_scan(self):
+        for executor in (None, ECDHExecutor(1)):
+            # Making the transactions fills the payee script memo
+            txs = self.make_txs()
+            StealthAddress.payee_scriptPubKey_cache.clear()
+            metrics = Metrics()
+            scanner = StealthScanner([make_scan_secret(b'scan1')], ecdh_executor=executor, metrics=metrics)
+            self.assertEqual([p.nValue for p in scanner.scan(txs)], [5])
+
+            snapshot = metrics.to_dict()
+            self.assertEqual(snapshot['counters'],
+                             {'outputs_examined': 5, 'notifications': 2, 'prefix_hits': 2,
+                              'ecdh': 2, 'derive': 2, 'script_comparisons': 2, 'payments': 1})
+            self.assertEqual(snapshot['timers']['prefilter']['count'], 1)
+            self.assertEqual(snapshot['timers']['derive']['count'], 2)
+            self.assertEqual(snapshot['timers']['ecdh']['count'], 1 if executor else 2)
+            self.assertGreater(snapshot['timers']['ecdh']['seconds'], 0)
+
+            metrics.reset()
+            self.assertEqual(metrics.to_dict()['counters']['payments'], 0)
+
+    def test_derive_counts_memo_misses(self):
+        scan_key = make_key(b'scan')
+        addr = StealthAddress.from_pubkeys(scan_key.pub, [make_key(b'spend1').pub, make_key(b'spend2').pub], m=2)
+        secret = StealthScanSecret.from_secret_bytes(scan_key[0:32], addr)
+        tx = make_payment_tx(addr, make_key(b'ephem'))
+        StealthAddress.payee_scriptPubKey_cache.clear()
+
+        metrics = Metrics()
+        scanner = StealthScanner([secret], metrics=metrics)
+        self.assertEqual(len(list(scanner.scan(tx))), 1)
+        self.assertEqual(metrics.to_dict()['counters']['derive'], 3)
+        self.assertEqual(len(list(scanner.scan(tx))), 1)
+        self.assertEqual(metrics.to_dict()['counters']['derive'], 3)
+
+    def test_disabled(self):
+        metrics = Metrics(enabled=False)
+        scanner = StealthScanner([make_scan_secret(b'scan1')], metrics=metrics)
+        self.assertEqual(len(list(scanner.scan(self.make_txs()))), 1)
+        with metrics.timer('extra'):
+            metrics.incr('extra')
+        snapshot = metrics.to_dict()
+        self.assertEqual(set(snapshot['counters'].values()), {0})
+        self.assertEqual(snapshot['timers']['ecdh'], {'count': 0, 'seconds': 0.0})
+        self.assertNotIn('extra', snapshot['counters'])
+
+        self.assertIs(StealthScanner([]).metrics, DISABLED)
+
+    def test_to_prometheus(self):
+        metrics = Metrics()
+        metrics.incr('payments', 3)
+        metrics.add_time('ecdh', 0.5)
+        text = metrics.to_prometheus()
+        lines = text.splitlines()
+        self.assertTrue(text.endswith('\n'))
+        self.assertIn('# TYPE stealthaddress_payments_total counter', lines)
+        self.assertIn('stealthaddress_payments_total 3', lines)
+        self.assertIn('stealthaddress_ecdh_total 0', lines)
+        self.assertIn('stealthaddress_stage_seconds_total{stage="ecdh"} 0.5', lines)
+        self.assertIn('stealthaddress_stage_calls_total{stage="ecdh"} 1', lines)
+        self.assertIn('scan_payments_total 3', metrics.to_prometheus('scan').splitlines())
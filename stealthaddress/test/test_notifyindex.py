@@ -0,0 +1,98 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from bitcoin.core import CTransaction
+
+import stealthaddress
+from stealthaddress.notifyindex import *
+
+from . import make_key, make_payment_tx, make_scan_secret, make_blocks
+
+class Test_NotificationIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'notify.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_index_and_scan(self):
+        secret1 = make_scan_secret(b'scan1')
+        secret2 = make_scan_secret(b'scan2')
+        blocks = make_blocks([secret1.stealth_addr, secret2.stealth_addr, secret1.stealth_addr])
+
+        with NotificationIndexWriter(self.path) as writer:
+            writer.add_blocks(blocks[0:2])
+
+        # Resuming after a partially written record redoes the last block
+        with open(self.path, 'ab') as fd:
+            fd.write(b'\xff' * 7)
+        with NotificationIndexWriter(self.path) as writer:
+            self.assertEqual(writer.next_height, 1)
+            with self.assertRaises(NotificationIndexError):
+                writer.add_block(*blocks[0])
+            writer.add_blocks(blocks[1:])
+
+        # A notification record and a payee record per block
+        index = NotificationIndex(self.path)
+        self.assertEqual(len(index), 6)
+        self.assertEqual([r.height for r in index], [0, 1, 2])
+        self.assertEqual(list(index)[1].payees,
+                         ((1, 1, blocks[1][1].vtx[0].vout[1].scriptPubKey),))
+        self.assertEqual(index.find_height(1), 2)
+        self.assertEqual(index.find_height(3), 6)
+
+        # Same payments as scanning the blocks themselves
+        expected = [(height, payment.outpoint, payment.nValue, payment.scriptPubKey)
+                    for height, block in blocks
+                    for payment in stealthaddress.recover(block, [secret1])]
+        found = [(height, payment.outpoint, payment.nValue, payment.scriptPubKey)
+                 for height, payment in index.scan([secret1])]
+        self.assertEqual(found, expected)
+        self.assertEqual([h for h, p in index.scan([secret1, secret2], start_height=1, end_height=2)], [1])
+
+    def test_payee_anywhere(self):
+        secret = make_scan_secret(b'scan1')
+        height, block = make_blocks([secret.stealth_addr])[0]
+
+        # Payee output ahead of the notification, with a change output between
+        tx = block.vtx[0]
+        change = make_payment_tx(make_scan_secret(b'scan2').stealth_addr, make_key(b'change')).vout[1]
+        block.vtx[0] = CTransaction(vin=tx.vin, vout=[tx.vout[1], change, tx.vout[0]])
+
+        with NotificationIndexWriter(self.path) as writer:
+            writer.add_block(height, block)
+        index = NotificationIndex(self.path)
+        self.assertEqual([n.n for n in index], [2])
+        self.assertEqual(len(index), 3)
+
+        expected = [(p.outpoint, p.nValue) for p in stealthaddress.recover(block, [secret])]
+        self.assertEqual(len(expected), 1)
+        self.assertEqual([(p.outpoint, p.nValue) for h, p in index.scan([secret])], expected)
+
+    def test_crash_mid_block(self):
+        secret = make_scan_secret(b'scan1')
+        height, block = make_blocks([secret.stealth_addr])[0]
+        block.vtx.append(make_payment_tx(secret.stealth_addr, make_key(b'ephem-second')))
+
+        with NotificationIndexWriter(self.path) as writer:
+            self.assertEqual(writer.add_block(height, block), 4)
+        # Crash after writing only the first of the block's records
+        with open(self.path, 'r+b') as fd:
+            fd.truncate(os.path.getsize(self.path) - RECORD_SIZE)
+
+        with NotificationIndexWriter(self.path) as writer:
+            self.assertEqual(writer.next_height, 0)
+            writer.add_block(height, block)
+        self.assertEqual(len(NotificationIndex(self.path)), 4)
+
+    def test_not_an_index(self):
+        with open(self.path, 'wb') as fd:
+            fd.write(b'\x00' * 100)
+        with self.assertRaises(NotificationIndexError):
+            NotificationIndex(self.path)
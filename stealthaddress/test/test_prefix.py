@@ -0,0 +1,59 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import unittest
+import unittest.mock
+
+from bitcoin.core import x
+from bitcoin.core.key import CPubKey
+from stealthaddress import StealthAddress
+import stealthaddress.prefix
+from stealthaddress.prefix import PrefixIndex
+
+SCAN_PUBKEY = x('0378d430274f8c5ec1321338151e9f27f4c676a008bdf8638d07c0b6be9ab35c71')
+
+def make_addr(prefix_length, prefix):
+    return StealthAddress.from_pubkeys(CPubKey(SCAN_PUBKEY),
+                                       prefix_length=prefix_length, prefix=prefix)
+
+class Test_PrefixIndex(unittest.TestCase):
+    def test_candidates(self):
+        addrs = [make_addr(0, b''),
+                 make_addr(1, x('80')),
+                 make_addr(8, x('ab')),
+                 make_addr(12, x('abc0')),
+                 make_addr(40, x('abcdef0123'))]
+        index = PrefixIndex(addrs)
+        self.assertEqual(len(index), 5)
+
+        for prefix in (0x00000000, 0x7fffffff, 0xab000000, 0xabc12345, 0xabcdef01, 0xffffffff):
+            self.assertEqual(set(index.candidates(prefix)),
+                             set(addr for addr in addrs if addr.matches_prefix(prefix)))
+
+    def test_candidates_many(self):
+        addrs = [make_addr(0, b''),
+                 make_addr(8, x('ab')),
+                 make_addr(8, x('ab')),
+                 make_addr(8, x('cd')),
+                 make_addr(12, x('abc0'))]
+        index = PrefixIndex(addrs)
+        prefixes = [0x00000000, 0xab000000, 0xabc12345, 0xcd000000, 0xffffffff]
+        expected = [index.candidates(prefix) for prefix in prefixes]
+
+        self.assertEqual(index.candidates_many(prefixes), expected)
+        with unittest.mock.patch.object(stealthaddress.prefix, 'numpy', None):
+            self.assertEqual(index.candidates_many(prefixes), expected)
+        self.assertEqual(index.candidates_many([]), [])
+
+        # Modifying the index invalidates the arrays
+        index.remove(addrs[3])
+        self.assertEqual(index.candidates_many([0xcd000000]), [[addrs[0]]])
+
+    def test_remove(self):
+        addr = make_addr(8, x('ab'))
+        index = PrefixIndex([addr])
+        index.remove(addr)
+        self.assertEqual(index.candidates(0xab000000), [])
+        self.assertEqual(len(index), 0)
+        with self.assertRaises(KeyError):
+            index.remove(addr)
@@ -0,0 +1,68 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import os
+import struct
+import tempfile
+import unittest
+
+import bitcoin
+from bitcoin.core import CBlock, CTransaction, CTxOut, Hash
+
+from stealthaddress import StealthAddress, StealthScanSecret
+from stealthaddress.rescan import *
+
+from . import make_key, make_payment_tx
+
+def write_bootstrap(fd, blocks):
+    for block in blocks:
+        block_bytes = block.serialize()
+        fd.write(bitcoin.params.MESSAGE_START)
+        fd.write(struct.pack('<i', len(block_bytes)))
+        fd.write(block_bytes)
+
+def make_block(vtx, nNonce=0):
+    return CBlock(hashPrevBlock=b'\x00'*32, hashMerkleRoot=b'\x00'*32,
+                  nTime=0, nBits=0, nNonce=nNonce, vtx=vtx)
+
+class Test_rescan(unittest.TestCase):
+    def setUp(self):
+        scan_key = make_key(b'scan')
+        self.addr = StealthAddress.from_pubkeys(scan_key.pub)
+        self.secrets = [StealthScanSecret.from_secret_bytes(scan_key[0:32], self.addr)]
+
+        self.blocks = []
+        for i in range(5):
+            vtx = [CTransaction(vout=[CTxOut(i, b'')])]
+            if i % 2:
+                vtx.append(make_payment_tx(self.addr, make_key(b'ephem%d' % i), i))
+            self.blocks.append(make_block(vtx, i))
+
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as fd:
+            write_bootstrap(fd, self.blocks)
+            # Zero padding, as found at the end of blk*.dat files
+            fd.write(b'\x00' * 16)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_split_block_ranges(self):
+        ranges = split_block_ranges([self.path], blocks_per_range=2)
+        self.assertEqual([r[3] for r in ranges], [0, 2, 4])
+        self.assertEqual(ranges[0][1], 0)
+        self.assertEqual(ranges[-1][2], os.path.getsize(self.path) - 16)
+
+    def test_rescan(self):
+        expected = [(1, Hash(self.blocks[1].get_header().serialize()), 1),
+                    (3, Hash(self.blocks[3].get_header().serialize()), 3)]
+
+        for processes in (1, 2):
+            r = [(height, block_hash, payment.nValue)
+                    for height, block_hash, payment
+                    in rescan([self.path], self.secrets, processes=processes, blocks_per_range=2)]
+            self.assertEqual(r, expected)
+
+    def test_bad_message_start(self):
+        with self.assertRaises(BlockFileError):
+            split_block_ranges([self.path], message_start=b'\xde\xad\xbe\xef')
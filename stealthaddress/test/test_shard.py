@@ -0,0 +1,94 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import socket
+import threading
+import unittest
+
+from bitcoin.core import CBlock, CTransaction, CTxOut
+from bitcoin.core.script import CScript, OP_TRUE
+
+import stealthaddress
+from stealthaddress.shard import *
+
+from . import make_key, make_scan_secret
+
+class Test_shard(unittest.TestCase):
+    def setUp(self):
+        self.secrets = [make_scan_secret(b'scan0', 8, b'\x10'),
+                        make_scan_secret(b'scan1', 8, b'\x90'),
+                        make_scan_secret(b'scan2', 1, b'\x80'),
+                        make_scan_secret(b'scan3', 0, b'')]
+        vtx = [stealthaddress.pay([(secret.stealth_addr, i + 1)],
+                                  ephem_keys=[(make_key(b'ephem%d' % i)[0:32], make_key(b'ephem%d' % i).pub)])
+               for i, secret in enumerate(self.secrets)]
+        # Payee output not directly after its notification
+        ephem_key = make_key(b'ephem-split')
+        tx = stealthaddress.pay([(self.secrets[0].stealth_addr, 5)], ephem_keys=[(ephem_key[0:32], ephem_key.pub)])
+        vtx.append(CTransaction(vout=[tx.vout[0], CTxOut(6, CScript([OP_TRUE])), tx.vout[1]]))
+        self.block = CBlock(hashPrevBlock=b'\x00'*32, hashMerkleRoot=b'\x00'*32,
+                            nTime=0, nBits=0, nNonce=0, vtx=vtx)
+
+    def test_shard_of(self):
+        self.assertEqual([shard_of(s.stealth_addr, 2) for s in self.secrets[0:3]], [0, 1, 1])
+        self.assertIn(shard_of(self.secrets[3].stealth_addr, 4), range(4))
+        self.assertEqual(sum(len(p) for p in partition(self.secrets, 3)), 4)
+
+    def test_sharded_scanner(self):
+        expected = [(p.outpoint.hash, p.outpoint.n, p.shared_secret, str(p.stealth_addr))
+                    for p in stealthaddress.recover(self.block, self.secrets)]
+        self.assertEqual(len(expected), 5)
+        with ShardedScanner(self.secrets, shards=2) as scanner:
+            found = [(p.txid, p.n, p.shared_secret, p.stealth_addr)
+                     for p in scanner.scan([(5, self.block)])]
+        self.assertEqual(found, expected)
+
+    def serve_in_thread(self, server):
+        server_sock, client_sock = socket.socketpair()
+        errors = []
+        def run():
+            try:
+                server.serve_connection(server_sock)
+            except ShardError as err:
+                errors.append(err)
+        thread = threading.Thread(target=run)
+        thread.start()
+        return client_sock, thread, errors
+
+    def test_client_server(self):
+        server = ShardServer(self.secrets[0:1])
+        client_sock, thread, errors = self.serve_in_thread(server)
+
+        with ShardDispatcher([ShardClient(client_sock)]) as dispatcher:
+            self.assertEqual(len(dispatcher.routes), 1)
+            payments = dispatcher.scan_block(0, self.block)
+
+            # Malformed requests get an error reply, and the connection
+            # stays usable
+            for request in (b'X', b'S' + b'\x00'*5):
+                send_frame(client_sock, request)
+                with self.assertRaises(ShardError):
+                    dispatcher.clients[0].recv_scan()
+            self.assertEqual(len(dispatcher.clients[0].stealth_addrs()), 1)
+        thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual([(p.nValue, p.n) for p in payments], [(1, 1), (5, 2)])
+
+    def test_auth(self):
+        server = ShardServer(self.secrets[0:1], auth_key=b'key')
+        client_sock, thread, errors = self.serve_in_thread(server)
+        client = ShardClient(client_sock, auth_key=b'key')
+        self.assertEqual(len(client.stealth_addrs()), 1)
+        client.close()
+        thread.join()
+        self.assertEqual(errors, [])
+
+        client_sock, thread, errors = self.serve_in_thread(server)
+        with self.assertRaises(ShardError):
+            ShardClient(client_sock, auth_key=b'wrong')
+        client_sock.close()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+
+        with self.assertRaises(ValueError):
+            serve(('127.0.0.1', 0), self.secrets)
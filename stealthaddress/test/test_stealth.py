@@ -7,9 +7,13 @@ import unittest
 
 import bitcoin.base58
 
-from bitcoin.core import b2x,x
+from bitcoin.core import b2x,x,Hash,Hash160,CTransaction,CTxOut
 from bitcoin.core.key import CPubKey
-from stealthaddress import StealthAddress, StealthAddressError
+from bitcoin.wallet import CBitcoinSecret
+from bitcoin.core.script import CScript, OP_CHECKMULTISIG, OP_RETURN
+from stealthaddress import *
+
+from . import make_key, make_payment_tx
 
 def load_test_vector(name):
     with open(os.path.dirname(__file__) + '/data/' + name, 'r') as fd:
@@ -45,3 +49,198 @@ class Test_StealthAddress(unittest.TestCase):
             self.assertEqual(addr.prefix, prefix)
             self.assertEqual(addr.m, m)
             self.assertEqual(addr.reuse_scan_for_spend, reuse_scan_for_spend)
+
+    def test_lazy_validation(self):
+        for comment, expected_exception, invalid in load_test_vector('invalid.json'):
+            with self.assertRaises(StealthAddressError) as cm:
+                StealthAddress(invalid, validate=False)
+            self.assertEqual(str(cm.exception), expected_exception)
+
+        for comment, valid, expected_attributes in load_test_vector('valid.json'):
+            addr = StealthAddress(valid, validate=False)
+            self.assertFalse(addr.is_validated)
+            self.assertEqual(addr.m, expected_attributes['m'])
+            self.assertEqual(addr.scan_pubkey, x(expected_attributes['scan_pubkey']))
+            self.assertTrue(addr.is_validated)
+            self.assertIsInstance(addr.scan_pubkey, CPubKey)
+
+        # Invalid pubkeys are only noticed on validation
+        bad = str(StealthAddress.from_bytes(b'\x01\x02' + b'\xff'*32 + b'\x00\x01\x00', 42))
+        addr = StealthAddress(bad, validate=False)
+        with self.assertRaises(StealthAddressError) as cm:
+            addr.validate()
+        self.assertEqual(str(cm.exception), 'Invalid scan pubkey')
+        with self.assertRaises(StealthAddressError):
+            addr.all_spend_pubkeys
+        with self.assertRaises(StealthAddressError):
+            StealthAddress(bad)
+
+class Test_make_payee_scriptPubKey(unittest.TestCase):
+    def test_batch_and_cache(self):
+        addrs = [StealthAddress.from_pubkeys(make_key(b'scan').pub),
+                 StealthAddress.from_pubkeys(make_key(b'scan').pub,
+                                             [make_key(b'spend%d' % i).pub for i in range(3)], m=2)]
+        items = [(addr, Hash(b'shared%d' % i)) for i, addr in enumerate(addrs)]
+
+        StealthAddress.payee_scriptPubKey_cache.clear()
+        uncached = StealthAddress.make_payee_scriptPubKeys(items, cache=False)
+        self.assertIsNone(StealthAddress.payee_scriptPubKey_cache.get(items[0]))
+
+        self.assertEqual([addr.make_payee_scriptPubKey(shared_secret) for addr, shared_secret in items],
+                         uncached)
+        self.assertIs(StealthAddress.payee_scriptPubKey_cache.get(items[1]),
+                      addrs[1].make_payee_scriptPubKey(items[1][1]))
+
+        scriptPubKey, redeemScript = uncached[1]
+        derived_pubkeys = sorted(StealthAddress.derive_pubkeys(
+                (spend_pubkey, items[1][1]) for spend_pubkey in addrs[1].all_spend_pubkeys))
+        self.assertEqual(list(redeemScript), [2] + derived_pubkeys + [4, OP_CHECKMULTISIG])
+        self.assertEqual(scriptPubKey, redeemScript.to_p2sh_scriptPubKey())
+
+class Test_recover(unittest.TestCase):
+    def test_recover(self):
+        scan_key = make_key(b'scan')
+        other_scan_key = make_key(b'other scan')
+
+        addr1 = StealthAddress.from_pubkeys(scan_key.pub)
+        addr2 = StealthAddress.from_pubkeys(scan_key.pub, [make_key(b'spend').pub],
+                                            reuse_scan_for_spend=False)
+        addr3 = StealthAddress.from_pubkeys(other_scan_key.pub)
+
+        secrets = [StealthScanSecret.from_secret_bytes(scan_key[0:32], addr1),
+                   StealthScanSecret.from_secret_bytes(scan_key[0:32], addr2),
+                   StealthScanSecret.from_secret_bytes(other_scan_key[0:32], addr3)]
+
+        tx1 = make_payment_tx(addr2, make_key(b'ephem1'), 42)
+        tx2 = make_payment_tx(addr3, make_key(b'ephem2'), 43)
+        tx3 = CTransaction(vout=[CTxOut(1, make_key(b'unrelated').pub)])
+
+        payments = list(recover([tx1, tx2, tx3], secrets))
+        self.assertEqual([(p.stealth_addr, p.nValue, p.outpoint.n) for p in payments],
+                         [(addr2, 42, 1), (addr3, 43, 1)])
+        self.assertEqual(payments[0].outpoint.hash, Hash(tx1.serialize()))
+
+        # Single transactions are accepted too
+        self.assertEqual(len(list(recover(tx2, secrets))), 1)
+
+    def test_scan_secret_mismatch(self):
+        addr = StealthAddress.from_pubkeys(make_key(b'scan').pub)
+        with self.assertRaises(StealthAddressError):
+            StealthScanSecret.from_secret_bytes(make_key(b'wrong')[0:32], addr)
+
+    def test_scan_ecdh_many(self):
+        scan_key = make_key(b'scan')
+        secret = StealthScanSecret.from_secret_bytes(scan_key[0:32], StealthAddress.from_pubkeys(scan_key.pub))
+        ephem_keys = [make_key(seed) for seed in (b'a', b'b', b'c')]
+
+        expected = [scan_key._cec_key.get_raw_ecdh_key(k.pub._cec_key) for k in ephem_keys]
+        self.assertEqual(secret.scan_ecdh_many([k.pub for k in ephem_keys]), expected)
+        self.assertEqual(secret.ecdh(ephem_keys[0].pub), expected[0])
+
+        # Invalid pubkeys are skipped over
+        self.assertEqual(secret.scan_ecdh_many([b'\x02' + b'\xff'*32, bytes(ephem_keys[1].pub)]),
+                         [None, expected[1]])
+        with self.assertRaises(StealthAddressError):
+            secret.ecdh(b'\x02' + b'\xff'*32)
+
+    def test_notification_roundtrip(self):
+        ephem_pubkey = make_key(b'ephem').pub
+        scriptPubKey = make_notification_scriptPubKey(ephem_pubkey, 0xdeadbeef)
+        self.assertEqual(parse_notification_scriptPubKey(scriptPubKey), (0xdeadbeef, ephem_pubkey))
+        self.assertIsNone(parse_notification_scriptPubKey(scriptPubKey[:-1]))
+
+    def test_extract_notifications(self):
+        ephem_pubkeys = [make_key(b'ephem%d' % i).pub for i in range(2)]
+        notifications = [make_notification_scriptPubKey(ephem_pubkeys[0], 1),
+                         make_notification_scriptPubKey(ephem_pubkeys[1], 2)]
+        data = bytes([NOTIFICATION_VERSION]) + b'\x00'*4 + ephem_pubkeys[0]
+        tx = CTransaction(vout=[CTxOut(0, notifications[0]),
+                                CTxOut(1, CScript([OP_RETURN])),
+                                # Non-canonical push of the notification data
+                                CTxOut(0, CScript(b'\x6a\x4c\x26' + data)),
+                                # Wrong version
+                                CTxOut(0, CScript(b'\x6a\x26\x07' + data[1:])),
+                                CTxOut(0, notifications[1])])
+        self.assertEqual(extract_notifications(tx),
+                         [(0, ephem_pubkeys[0], notification_prefix(notifications[0])),
+                          (4, ephem_pubkeys[1], notification_prefix(notifications[1]))])
+        for txout in tx.vout[1:4]:
+            self.assertIsNone(parse_notification_scriptPubKey(txout.scriptPubKey))
+
+        self.assertEqual([(i, n) for i, n, ephem_pubkey, prefix
+                          in iter_block_notifications([CTransaction(), tx, tx])],
+                         [(1, 0), (1, 4), (2, 0), (2, 4)])
+
+class Test_pay(unittest.TestCase):
+    def test_pay_and_recover(self):
+        scan_key = make_key(b'scan')
+        addrs = [StealthAddress.from_pubkeys(scan_key.pub),
+                 StealthAddress.from_pubkeys(scan_key.pub, [make_key(b'spend').pub], m=2),
+                 StealthAddress.from_pubkeys(scan_key.pub, [make_key(b'spend2').pub],
+                                             prefix_length=8, prefix=b'\xab',
+                                             reuse_scan_for_spend=False)]
+        secrets = [StealthScanSecret.from_secret_bytes(scan_key[0:32], addr) for addr in addrs]
+
+        template = CTransaction(vout=[CTxOut(5, b'change')])
+        tx = pay([(addr, i+1) for i, addr in enumerate(addrs)], template)
+        self.assertEqual(len(tx.vout), 7)
+        self.assertEqual(len(template.vout), 1)
+
+        # The prefix was ground to match
+        self.assertTrue(addrs[2].matches_prefix(notification_prefix(tx.vout[5].scriptPubKey)))
+
+        payments = list(recover(tx, secrets))
+        self.assertEqual(sorted((p.stealth_addr, p.nValue, p.outpoint.n) for p in payments),
+                         sorted([(addrs[0], 1, 2), (addrs[1], 2, 4), (addrs[2], 3, 6)]))
+        self.assertIsNotNone(payments[1].redeemScript)
+
+    def test_recover_spend_keys(self):
+        scan_key = make_key(b'scan')
+        spend_key = make_key(b'spend')
+        addrs = [StealthAddress.from_pubkeys(scan_key.pub),
+                 StealthAddress.from_pubkeys(scan_key.pub, [spend_key.pub], m=2),
+                 StealthAddress.from_pubkeys(scan_key.pub, [spend_key.pub], reuse_scan_for_spend=False)]
+        secrets = [StealthScanSecret.from_secret_bytes(scan_key[0:32], addr) for addr in addrs]
+        tx = pay([(addr, i+1) for i, addr in enumerate(addrs)])
+        payments = sorted(recover(tx, secrets), key=lambda p: p.nValue)
+
+        keys = recover_spend_keys(payments, [scan_key, spend_key])
+        self.assertEqual([len(k) for k in keys], [1, 2, 1])
+        for payment, payment_keys in zip(payments, keys):
+            spend_secrets = sorted((k for k in (scan_key, spend_key)
+                                    if k.pub in payment.stealth_addr.all_spend_pubkeys),
+                                   key=lambda k: k.pub)
+            for key, spend_secret in zip(payment_keys, spend_secrets):
+                self.assertEqual(key.pub,
+                                 StealthAddress.derive_pubkey(spend_secret.pub, payment.shared_secret))
+                self.assertTrue(key.is_compressed)
+                # Same key as going through OpenSSL the slow way
+                self.assertEqual(str(key), str(CBitcoinSecret.from_secret_bytes(key[0:32])))
+                self.assertTrue(key.pub.verify(b'\x01'*32, key.sign(b'\x01'*32)))
+
+            if payment.redeemScript is None:
+                self.assertEqual(payment.scriptPubKey[3:23], Hash160(payment_keys[0].pub))
+            else:
+                self.assertEqual(sorted(k.pub for k in payment_keys),
+                                 [op for op in payment.redeemScript if isinstance(op, bytes)])
+
+        with self.assertRaises(StealthAddressError):
+            recover_spend_keys(payments[2:], [scan_key])
+
+        self.assertEqual(StealthAddress.derive_secret(spend_key, payments[2].shared_secret), keys[2][0])
+        with self.assertRaises(StealthAddressError):
+            StealthAddress.derive_secret(spend_key[0:32], payments[2].shared_secret)
+
+    def test_pay_method(self):
+        addr = StealthAddress.from_pubkeys(make_key(b'scan').pub)
+        tx = addr.pay(42)
+        self.assertEqual(tx.vout[1].nValue, 42)
+
+    def test_ephem_keys(self):
+        addr = StealthAddress.from_pubkeys(make_key(b'scan').pub)
+        ephem_key = make_key(b'ephem')
+        tx = pay([(addr, 1)], ephem_keys=[(ephem_key[0:32], ephem_key.pub)])
+        self.assertEqual(tx.vout, make_payment_tx(addr, ephem_key).vout)
+
+        with self.assertRaises(StealthAddressError):
+            pay([(addr, 1)], ephem_keys=[])
@@ -0,0 +1,62 @@
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from bitcoin.core import COutPoint, CTransaction, CTxIn, CTxOut
+
+import stealthaddress
+from stealthaddress.store import *
+
+from . import make_scan_secret, make_blocks
+
+class Test_PaymentStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'payments.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_store(self):
+        secret1 = make_scan_secret(b'scan1')
+        secret2 = make_scan_secret(b'scan2')
+        blocks = make_blocks([secret1.stealth_addr, secret2.stealth_addr, secret1.stealth_addr])
+        found = [(height, b'\x00'*32, payment)
+                 for height, block in blocks
+                 for payment in stealthaddress.recover(block, [secret1, secret2])]
+
+        with PaymentStore(self.path) as store:
+            self.assertEqual(store.add_many(found), 3)
+            # Re-adding is a no-op
+            self.assertEqual(store.add_many(found), 0)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+        store = PaymentStore(self.path)
+        self.assertEqual(len(store), 3)
+        self.assertEqual([p.height for p in store.find(scan_pubkey=secret1.scan_pubkey)], [0, 2])
+        self.assertEqual([p.height for p in store.find(stealth_addr=secret2.stealth_addr)], [1])
+        self.assertEqual([p.height for p in store.find(start_height=1, end_height=3)], [1, 2])
+
+        stored = store.get(found[0][2].outpoint)
+        payment = stored.to_payment(secret1)
+        self.assertEqual((payment.outpoint, payment.scriptPubKey, payment.shared_secret),
+                         (found[0][2].outpoint, found[0][2].scriptPubKey, found[0][2].shared_secret))
+        with self.assertRaises(ValueError):
+            stored.to_payment(secret2)
+
+        # Spend the first and third payments, plus an unrelated outpoint
+        spend = CTransaction(vin=[CTxIn(found[0][2].outpoint),
+                                  CTxIn(found[2][2].outpoint),
+                                  CTxIn(COutPoint(b'\x01'*32, 0))],
+                             vout=[CTxOut(1, b'')])
+        self.assertEqual(store.mark_spent(10, [spend]), 2)
+        self.assertEqual(store.mark_spent(11, [spend]), 0)
+        self.assertEqual([p.height for p in store.find(unspent=True)], [1])
+        self.assertEqual(store.get(found[0][2].outpoint).spent_height, 10)
+        self.assertTrue(store.get(found[0][2].outpoint).is_spent)
+        store.close()